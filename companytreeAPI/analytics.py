@@ -0,0 +1,108 @@
+"""Headcount and reporting-structure aggregates for a company"""
+from collections import Counter
+from django.db import connection, connections, router
+from django.db.models import Count
+from companytreeAPI import hierarchy
+from companytreeAPI.models import Department, Employee
+
+
+def headcount_by_department(company_id):
+    rows = (
+        Employee.objects.filter(company_id=company_id)
+        .values_list('department_id')
+        .annotate(headcount=Count('id'))
+        .order_by('-headcount', 'department_id')
+    )
+    # Names come from the small department table rather than a join on every employee
+    names = dict(Department.objects.filter(pk__in=[row[0] for row in rows]).values_list('id', 'name'))
+    return [
+        {'department_id': department_id, 'name': names.get(department_id), 'headcount': headcount}
+        for department_id, headcount in rows
+    ]
+
+
+def headcount_by_location(company_id):
+    rows = (
+        Employee.objects.filter(company_id=company_id)
+        .values('location')
+        .annotate(headcount=Count('id'))
+        .order_by('-headcount', 'location')
+    )
+    return list(rows)
+
+
+def tree_rows(company_id):
+    """Walk the company's reporting trees from their roots in one recursive query
+    Returns:
+        list -- (id, supervisor_id, depth) tuples, deepest employees first
+    """
+    employee_table = connection.ops.quote_name(Employee._meta.db_table)
+    sql = f"""
+        WITH RECURSIVE tree(id, supervisor_id, depth) AS (
+            SELECT id, supervisor_id, 0 FROM {employee_table}
+            WHERE company_id = %s AND supervisor_id IS NULL
+            UNION ALL
+            SELECT e.id, e.supervisor_id, t.depth + 1 FROM {employee_table} e
+            JOIN tree t ON e.supervisor_id = t.id
+            WHERE e.company_id = %s AND t.depth < %s
+        )
+        SELECT id, supervisor_id, depth FROM tree ORDER BY depth DESC
+    """
+    with connections[router.db_for_read(Employee)].cursor() as cursor:
+        cursor.execute(sql, [company_id, company_id, hierarchy.MAX_TREE_DEPTH])
+        return cursor.fetchall()
+
+
+def report_counts(company_id):
+    """Count direct and total reports of every supervisor and employees per tree level
+    Counting every (manager, report) pair in SQL grows with employees times
+    depth, so the recursive query only labels each employee with their depth
+    and the totals are rolled up from the deepest level in a single pass.
+    Returns:
+        tuple -- (Counter of direct reports, Counter of total reports, Counter of employees per depth)
+    """
+    rows = tree_rows(company_id)
+    direct = Counter(supervisor_id for _, supervisor_id, _ in rows if supervisor_id is not None)
+    levels = Counter(depth for _, _, depth in rows)
+
+    # Deepest first, so a supervisor's total is complete before it is added to their own supervisor's
+    total = Counter(direct)
+    for employee_id, supervisor_id, _ in rows:
+        if employee_id in direct and supervisor_id is not None:
+            total[supervisor_id] += total[employee_id]
+    return direct, total, levels
+
+
+def reporting_structure(company_id):
+    """Direct and total reports per supervisor and depth statistics
+    Returns:
+        tuple -- (list of supervisor dicts, dict of depth statistics)
+    """
+    direct, total, levels = report_counts(company_id)
+    employees = sum(levels.values())
+
+    supervisors = sorted(
+        ({'employee_id': employee_id, 'direct_reports': direct[employee_id], 'total_reports': total[employee_id]}
+         for employee_id in direct),
+        key=lambda row: (-row['total_reports'], row['employee_id']),
+    )
+    depth = {
+        'max': max(levels) if levels else None,
+        'mean': sum(level * count for level, count in levels.items()) / employees if employees else None,
+        'headcount_by_level': [{'depth': level, 'headcount': levels[level]} for level in sorted(levels)],
+        'mean_direct_reports': sum(direct.values()) / len(direct) if direct else None,
+    }
+    return supervisors, depth
+
+
+def company_analytics(company_id):
+    """Every aggregate of the analytics endpoint"""
+    departments = headcount_by_department(company_id)
+    supervisors, depth = reporting_structure(company_id)
+    return {
+        'headcount': sum(row['headcount'] for row in departments),
+        'departments': departments,
+        'locations': headcount_by_location(company_id),
+        'supervisors': supervisors,
+        'depth': depth,
+    }
@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+
+
+def create_search_index(sender, using, **kwargs):
+    from companytreeAPI import search
+    search.ensure_index(using)
 
 
 class CompanytreeapiConfig(AppConfig):
     name = 'companytreeAPI'
+
+    def ready(self):
+        from companytreeAPI import signals  # noqa: F401 registers the receivers
+        post_migrate.connect(create_search_index, sender=self)
+        from companytreeAPI import tenancy
+        post_migrate.connect(tenancy.prepare_database, sender=self)
+        from companytreeAPI import db
+        connection_created.connect(db.tune_sqlite)
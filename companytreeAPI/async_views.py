@@ -0,0 +1,468 @@
+"""Asynchronous handlers for the read-heavy directory endpoints
+
+Django 3.0 has neither async views nor an async ORM. DirectoryHandler is
+Django's ASGI handler with these handlers below its middleware: a GET on
+one of ROUTES goes through every middleware like any other request, then
+its handler answers it, running the database work on a bounded pool of
+threads and independent queries on it concurrently. Any request a handler
+does not recognise, and any request that would end in an error, goes on
+to the URLconf unchanged so status codes and messages stay the same on
+both paths.
+
+Responses share their cache entries and ETags with the synchronous views.
+Streamed bodies, of the handlers and of the views, are read on the pool
+rather than on the event loop.
+
+/events pushes the caller's company's change events (companytreeAPI.push)
+as Server-Sent Events, or as JSON messages over a WebSocket. The request
+opening the stream goes through the middleware too before DirectoryRouter
+serves it. Browsers cannot set headers on either, so the token may come as
+?token= instead.
+"""
+import asyncio
+import contextvars
+import io
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+from companytreeAPI import bootstrap, cache, db, hierarchy, push, tenancy
+from companytreeAPI.authentication import CachedTokenAuthentication
+from companytreeAPI.models import Department, Employee
+from companytreeAPI.streaming import STREAM_CHUNK_ROWS, stream_json_array
+from companytreeAPI.views.department import DEPARTMENT_COLUMNS, department_rows
+from companytreeAPI.views.employee import EmployeeSerializer, employee_rows
+
+_executor = None
+
+# The MetricsMiddleware measurement of the request a handler serves, so the
+# queries run on the pool are counted too
+_measurement = contextvars.ContextVar('companytree_measurement', default=None)
+
+
+def executor():
+    """Thread pool every database call of the async handlers runs on"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'COMPANYTREE_ASGI_DB_THREADS', 8),
+            thread_name_prefix='companytree-db',
+        )
+    return _executor
+
+
+def _call(function, args):
+    close_old_connections()
+    measurement = _measurement.get()
+    try:
+        # Every handler only reads
+        with db.reading(), measurement.watch_queries() if measurement is not None else nullcontext():
+            return function(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_db(function, *args):
+    """Run a blocking function on the database thread pool, in the context of the caller's company"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor(), context.run, _call, function, args)
+
+
+async def gather_db(*calls):
+    """Run independent (function, *args) calls concurrently
+    Returns:
+        list -- the result of every call, in order
+    """
+    return await asyncio.gather(*(run_db(*call) for call in calls))
+
+
+class Request:
+    """The parts of a Django request the handlers read"""
+
+    def __init__(self, request, principal):
+        self.path = request.path
+        self.query = {name: values[-1] for name, values in request.GET.lists()}
+        self.headers = request.headers
+        self.full_path = request.get_full_path()
+        self.principal = principal
+
+
+def json_response(data):
+    return HttpResponse(JSONRenderer().render(data), content_type='application/json')
+
+
+def authenticate(request):
+    """The caller's principal, with their company's database activated, the way the ViewSets authenticate
+    Returns:
+        Principal -- or None when the request has to be answered by Django
+    """
+    try:
+        result = CachedTokenAuthentication().authenticate(request)
+    except APIException:
+        return None
+    if result is None or result[1].principal.company_id is None:
+        return None
+    return result[1].principal
+
+
+def cached(view_name, scope=cache.COMPANY_SCOPE):
+    """Async counterpart of cache.directory_cache, sharing its keys
+    Arguments:
+        view_name -- qualified name of the synchronous view, e.g. "Employees.list"
+    """
+    def decorator(handler):
+        async def wrapper(request, **kwargs):
+            company_id = request.principal.company_id if scope == cache.COMPANY_SCOPE else None
+            if scope == cache.COMPANY_SCOPE:
+                data_version = await run_db(cache.version_token, company_id)
+            else:
+                data_version = await run_db(cache.version, cache.GLOBAL_SCOPE)
+            etag, key = cache.response_key(view_name, company_id, data_version, request.full_path)
+
+            if etag in parse_etags(request.headers.get('if-none-match', '')):
+                cache.stats.record('not_modified')
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+
+            cached_response = await run_db(cache.get_cache().get, key)
+            if cached_response is not None:
+                cache.stats.record('hits')
+                content, content_type = cached_response
+                response = HttpResponse(content, content_type=content_type)
+            else:
+                cache.stats.record('misses')
+                response = await handler(request, **kwargs)
+                if response is None or response.status_code != 200:
+                    return response
+                if response.streaming:
+                    cache.tee(key, response)
+                else:
+                    await run_db(cache.store, key, response.content, response['Content-Type'])
+
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+def _employee_rows(company_id, after_id, limit):
+    rows, to_rows = employee_rows(Employee.objects.filter(company_id=company_id, id__gt=after_id).order_by('id'))
+    return list(to_rows(rows[:limit]))
+
+
+def _employee(employee_id, company_id):
+    employee = Employee.objects.select_related('user').filter(pk=employee_id, company_id=company_id).first()
+    return None if employee is None else EmployeeSerializer(employee).data
+
+
+def _departments(company_id):
+    return department_rows(Department.objects.values(*DEPARTMENT_COLUMNS), company_id)
+
+
+def _paged_employee_rows(company_id):
+    """The company's employee rows, a chunk per query as the body is sent"""
+    after_id = 0
+    while True:
+        # Read as the body is sent, where TenantMiddleware keeps the company but no ViewSet marks the read
+        with db.reading():
+            rows = _employee_rows(company_id, after_id, STREAM_CHUNK_ROWS)
+        yield from rows
+        if len(rows) < STREAM_CHUNK_ROWS:
+            return
+        after_id = rows[-1]['id']
+
+
+@cached('Employees.list')
+async def employee_list(request):
+    rows = _paged_employee_rows(request.principal.company_id)
+    return StreamingHttpResponse(stream_json_array(rows), content_type='application/json')
+
+
+async def employee_detail(request, pk):
+    data = await run_db(_employee, int(pk), request.principal.company_id)
+    return None if data is None else json_response(data)
+
+
+async def employee_tree(request, pk):
+    direction = request.query.get('direction', 'down')
+    depth = request.query.get('depth')
+    if direction not in ('down', 'up') or set(request.query) - {'direction', 'depth'}:
+        return None
+    if depth is not None:
+        if not depth.isdigit():
+            return None
+        depth = int(depth)
+
+    company_id = request.principal.company_id
+    if direction == 'down':
+        tree = hierarchy.nest_reports(await run_db(hierarchy.subtree_rows, int(pk), company_id, depth))
+    else:
+        tree = hierarchy.nest_managers(await run_db(hierarchy.manager_rows, int(pk), company_id, depth))
+    return None if tree is None else json_response(tree)
+
+
+@cached('Departments.list')
+async def department_list(request):
+    return json_response(await run_db(_departments, request.principal.company_id))
+
+
+@cached('Bootstrap.list')
+async def bootstrap_list(request):
+    """The bootstrap sections, each queried concurrently"""
+    try:
+        sections, fields, since = bootstrap.parse(request.query)
+    except bootstrap.BootstrapError:
+        return None
+
+    principal = request.principal
+    token, wanted, unchanged = await run_db(bootstrap.plan, principal.company_id, sections, since)
+    names = bootstrap.queries(wanted)
+    results = await gather_db(*((bootstrap.BUILDERS[name], principal, fields) for name in names))
+    return json_response(bootstrap.finish(principal, token, wanted, dict(zip(names, results)), unchanged))
+
+
+# Path pattern, handler, whether requests with a query string are served,
+# and the view and action MetricsMiddleware records them under, those of the
+# ViewSet answering the same request. Lists with parameters (search,
+# pagination) are left to the ViewSets.
+ROUTES = (
+    (re.compile(r'^/employees$'), employee_list, False, ('Employees', 'list')),
+    (re.compile(r'^/employees/(?P<pk>\d+)$'), employee_detail, False, ('Employees', 'retrieve')),
+    (re.compile(r'^/employees/(?P<pk>\d+)/tree$'), employee_tree, True, ('Employees', 'tree')),
+    (re.compile(r'^/departments$'), department_list, False, ('Departments', 'list')),
+    (re.compile(r'^/bootstrap$'), bootstrap_list, True, ('Bootstrap', 'list')),
+)
+
+
+def _route(request):
+    for pattern, handler, accepts_query, metrics_name in ROUTES:
+        match = pattern.match(request.path)
+        if match and (accepts_query or not request.META.get('QUERY_STRING')):
+            return handler, match.groupdict(), metrics_name
+    return None, None, None
+
+
+EVENTS_PATH = '/events'
+
+
+def _response_start(response):
+    """The http.response.start message of a Django response, as ASGIHandler.send_response builds it"""
+    headers = [(name.encode('ascii'), value.encode('latin-1')) for name, value in response.items()]
+    headers.extend((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()) for cookie in response.cookies.values())
+    return {'type': 'http.response.start', 'status': response.status_code, 'headers': headers}
+
+
+class DirectoryHandler(ASGIHandler):
+    """Django's ASGI handler answering ROUTES and the opening of /events below its middleware"""
+
+    def _get_response(self, request):
+        if request.method == 'GET':
+            if request.path == EVENTS_PATH:
+                return self._open_events(request)
+            handler, kwargs, metrics_name = _route(request)
+            if handler is not None:
+                response = self._serve(request, handler, kwargs, metrics_name)
+                if response is not None:
+                    return response
+        return super()._get_response(request)
+
+    def _serve(self, request, handler, kwargs, metrics_name):
+        principal = authenticate(request)
+        if principal is None:
+            return None
+        measurement = getattr(request, 'companytree_metrics', None)
+        if measurement is not None:
+            measurement.view, measurement.action = metrics_name
+        token = _measurement.set(measurement)
+        try:
+            # Runs the handler on the event loop, this thread waits for its answer
+            return async_to_sync(handler)(Request(request, principal), **kwargs)
+        finally:
+            _measurement.reset(token)
+
+    def _open_events(self, request):
+        token = request.GET.get('token')
+        if token and 'HTTP_AUTHORIZATION' not in request.META:
+            request.META['HTTP_AUTHORIZATION'] = f'Token {token}'
+        principal = authenticate(request)
+        if principal is None:
+            return HttpResponse(
+                JSONRenderer().render({'detail': 'Authentication credentials were not provided.'}),
+                status=401, content_type='application/json',
+            )
+        response = HttpResponse(content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Tells nginx not to buffer the stream
+        response['X-Accel-Buffering'] = 'no'
+        response.principal = principal
+        return response
+
+    async def open_events(self, scope):
+        """The response of the middleware to the request opening an /events stream or WebSocket
+        Its principal attribute is set when the stream may be served.
+        """
+        request, error_response = self.create_request({**scope, 'type': 'http', 'method': 'GET'}, io.BytesIO())
+        if request is None:
+            return error_response
+        return await sync_to_async(self.get_response)(request)
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            await super().send_response(response, send)
+            return
+        await send(_response_start(response))
+        loop = asyncio.get_running_loop()
+
+        def pump():
+            # One thread reads the whole body, a server-side cursor stays on its connection
+            try:
+                for part in response:
+                    for chunk, _ in self.chunk_bytes(part):
+                        message = {'type': 'http.response.body', 'body': chunk, 'more_body': True}
+                        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+            finally:
+                close_old_connections()
+
+        try:
+            await loop.run_in_executor(executor(), contextvars.copy_context().run, pump)
+            await send({'type': 'http.response.body'})
+        finally:
+            response.close()
+
+
+async def _disconnected(receive, message_type):
+    while (await receive())['type'] != message_type:
+        pass
+
+
+async def _pump(subscription, send_event):
+    """Send every event of a subscription, and a heartbeat whenever none came for a while
+    A client that takes longer than COMPANYTREE_PUSH_SEND_TIMEOUT to accept a
+    message is dropped, so a stalled connection is not kept open forever.
+    """
+    heartbeat = getattr(settings, 'COMPANYTREE_PUSH_HEARTBEAT', 15)
+    timeout = getattr(settings, 'COMPANYTREE_PUSH_SEND_TIMEOUT', 10)
+    # wait_for can swallow a cancellation that lands as its awaitable finishes
+    while not subscription.closed:
+        event = await subscription.get(heartbeat)
+        await asyncio.wait_for(send_event(event or {'type': push.HEARTBEAT}), timeout)
+
+
+async def _close(send, message):
+    # A client that stopped reading may never take the last message either
+    try:
+        await asyncio.wait_for(send(message), getattr(settings, 'COMPANYTREE_PUSH_SEND_TIMEOUT', 10))
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _subscribed(principal, receive, disconnect_type, send_event):
+    """Push the company's events until the client disconnects or stops reading
+    The first event is "ready", sent once subscribed: a client that syncs
+    from /changes when it arrives cannot miss a change.
+    Returns:
+        bool -- whether the client disconnected
+    """
+    push.get_backend().listen()
+    broker = push.get_broker()
+    database = await run_db(tenancy.database_for, principal.company_id) if tenancy.sharded() else None
+    subscription = broker.subscribe(principal.company_id, database)
+    subscription.put({'type': 'ready'})
+    tasks = [
+        asyncio.ensure_future(_pump(subscription, send_event)),
+        asyncio.ensure_future(_disconnected(receive, disconnect_type)),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        return tasks[1] in done
+    finally:
+        broker.unsubscribe(subscription)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _sse(event):
+    if event['type'] == push.HEARTBEAT:
+        # A comment line, ignored by EventSource, keeps proxies from timing the stream out
+        return b': heartbeat\n\n'
+    return f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'.encode()
+
+
+async def stream_events(scope, receive, send, principal, headers=None):
+    """Serve a company's events as Server-Sent Events"""
+    headers = {
+        **(headers or {}),
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        # Tells nginx not to buffer the stream
+        'X-Accel-Buffering': 'no',
+    }
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()],
+    })
+
+    async def send_event(event):
+        await send({'type': 'http.response.body', 'body': _sse(event), 'more_body': True})
+
+    if not await _subscribed(principal, receive, 'http.disconnect', send_event):
+        await _close(send, {'type': 'http.response.body', 'body': b''})
+
+
+async def socket_events(scope, receive, send, principal):
+    """Serve a company's events as JSON messages over an accepted WebSocket"""
+    async def send_event(event):
+        await send({'type': 'websocket.send', 'text': json.dumps(event)})
+
+    if not await _subscribed(principal, receive, 'websocket.disconnect', send_event):
+        await _close(send, {'type': 'websocket.close', 'code': 1000})
+
+
+async def events(handler, scope, receive, send):
+    """Open an /events connection through the middleware of handler and serve it as SSE or WebSocket"""
+    response = await handler.open_events(scope)
+    principal = getattr(response, 'principal', None)
+
+    if scope['type'] == 'websocket':
+        await receive()
+        if principal is None:
+            # Closing before accepting rejects the handshake with a 403
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        await send({'type': 'websocket.accept'})
+        await socket_events(scope, receive, send, principal)
+    elif principal is None:
+        await handler.send_response(response, send)
+    else:
+        await stream_events(scope, receive, send, principal, dict(response.items()))
+
+
+class DirectoryRouter:
+    """ASGI application serving /events itself and everything else through handler, a DirectoryHandler"""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] in ('http', 'websocket') and scope['path'] == EVENTS_PATH:
+            if scope['type'] == 'websocket' or scope['method'] == 'GET':
+                await events(self.handler, scope, receive, send)
+                return
+        await self.handler(scope, receive, send)
+
+
+def get_application():
+    """The ASGI application of the project, once Django is set up"""
+    return DirectoryRouter(DirectoryHandler())
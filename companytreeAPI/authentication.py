@@ -0,0 +1,135 @@
+"""Token authentication that resolves the caller in one query and caches it
+
+Authenticating a request also routes the rest of it to the database of
+the caller's company (companytreeAPI.tenancy).
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from django.conf import settings
+from rest_framework import status
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import APIException, AuthenticationFailed
+from rest_framework.permissions import SAFE_METHODS
+from companytreeAPI import tenancy
+
+# What the views need to know about the caller. employee_id, company_id and
+# is_admin are None for users without an Employee row.
+Principal = namedtuple('Principal', ('user_id', 'employee_id', 'company_id', 'is_admin'))
+
+
+class TokenCache:
+    """In-process LRU of resolved tokens with a time to live"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = OrderedDict()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'COMPANYTREE_AUTH_CACHE_TTL', 60)
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'COMPANYTREE_AUTH_CACHE_SIZE', 10000)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry is None:
+                return None
+            expires, token = entry
+            if expires < time.monotonic():
+                del self._tokens[key]
+                return None
+            self._tokens.move_to_end(key)
+            return token
+
+    def set(self, key, token):
+        with self._lock:
+            self._tokens[key] = (time.monotonic() + self.ttl, token)
+            self._tokens.move_to_end(key)
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._tokens.pop(key, None)
+
+    def discard_user(self, user_id):
+        with self._lock:
+            for key in [key for key, (_, token) in self._tokens.items() if token.user_id == user_id]:
+                del self._tokens[key]
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+token_cache = TokenCache()
+
+
+def resolve(key):
+    """Load a token with its user and employee in a single query
+    Returns:
+        Token -- with a principal attribute, or None if the key is unknown
+    """
+    # A token lives with its user in the database of the user's company, and
+    # while the company moves, in the one the registry names
+    for alias in tenancy.databases():
+        with tenancy.using(alias):
+            token = Token.objects.select_related('user__employee').filter(key=key).first()
+        employee = getattr(token.user, 'employee', None) if token is not None else None
+        if token is not None and tenancy.database_for(employee and employee.company_id) == alias:
+            break
+    else:
+        return None
+
+    if employee is None:
+        token.principal = Principal(token.user_id, None, None, None)
+    else:
+        token.principal = Principal(token.user_id, employee.id, employee.company_id, employee.is_admin)
+    return token
+
+
+class TenantMoving(APIException):
+    """Raised for writes to a company while manage.py move_company copies its last changes"""
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Your company is moving to another database, try again in a few seconds.'
+    default_code = 'tenant_moving'
+
+    def __init__(self):
+        super().__init__()
+        # Sent as Retry-After
+        self.wait = tenancy.tenant_cache.ttl + 1
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that serves repeat requests from the token cache
+
+    request.auth is the Token, and request.auth.principal describes the
+    caller so views never need to look the employee up again.
+    """
+
+    def authenticate(self, request):
+        result = super().authenticate(request)
+        if result is not None:
+            tenant = tenancy.tenant(result[1].principal.company_id)
+            tenancy.activate(tenant.database)
+            if tenant.frozen and request.method not in SAFE_METHODS:
+                raise TenantMoving()
+        return result
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            token = resolve(key)
+            if token is None:
+                raise AuthenticationFailed('Invalid token.')
+            token_cache.set(key, token)
+
+        if not token.user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+
+        return (token.user, token)
@@ -0,0 +1,84 @@
+"""PostgreSQL backend that hands out connections from a per-process pool
+
+Use it as the ENGINE of a database with CONN_MAX_AGE = 0: every request
+takes a connection from the pool when it first queries and gives it back
+when Django closes it at the end of the request, so connections are
+reused without each thread holding one open. OPTIONS may set
+pool_min_size, pool_max_size and pool_timeout, the seconds to wait for a
+free connection when all of them are in use.
+"""
+import threading
+from django.db.backends.postgresql import base
+from psycopg2 import OperationalError
+from psycopg2.pool import ThreadedConnectionPool
+
+POOL_OPTIONS = ('pool_min_size', 'pool_max_size', 'pool_timeout')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class Pool:
+    """ThreadedConnectionPool that waits for a free connection instead of failing at once"""
+
+    def __init__(self, conn_params, min_size, max_size, timeout):
+        self.connections = ThreadedConnectionPool(min_size, max_size, **conn_params)
+        self.available = threading.BoundedSemaphore(max_size)
+        self.timeout = timeout
+
+    def get(self):
+        if not self.available.acquire(timeout=self.timeout):
+            raise OperationalError(f'No database connection became free within {self.timeout} seconds')
+        try:
+            return self.connections.getconn()
+        except Exception:
+            self.available.release()
+            raise
+
+    def put(self, connection, close=False):
+        try:
+            # Rolls back an unfinished transaction before the connection is reused
+            self.connections.putconn(connection, close=close)
+        finally:
+            self.available.release()
+
+
+def _pool(alias, conn_params, options):
+    with _pools_lock:
+        if alias not in _pools:
+            _pools[alias] = Pool(
+                conn_params,
+                options.get('pool_min_size', 1),
+                options.get('pool_max_size', 20),
+                options.get('pool_timeout', 30),
+            )
+        return _pools[alias]
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        conn_params = super().get_connection_params()
+        for option in POOL_OPTIONS:
+            conn_params.pop(option, None)
+        return conn_params
+
+    def get_new_connection(self, conn_params):
+        options = self.settings_dict['OPTIONS']
+        connection = _pool(self.alias, conn_params, options).get()
+
+        # Same isolation level handling as the stock backend
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            # A connection that saw errors is discarded rather than handed out again
+            with self.wrap_database_errors:
+                _pools[self.alias].put(self.connection, close=self.errors_occurred or bool(self.connection.closed))
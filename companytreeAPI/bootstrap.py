@@ -0,0 +1,118 @@
+"""Everything the client loads on startup, built in as few queries as possible
+
+A bootstrap response is made of sections. Each section reads the
+caller's company data, the shared departments, or both for the
+departments with the company's employee count in each, so a client that
+sends back the version token of its last bootstrap only gets the
+sections whose data changed since.
+"""
+from companytreeAPI import cache
+from companytreeAPI.models import Company, Department, Employee
+from companytreeAPI.views.company import CompanySerializer
+from companytreeAPI.views.department import DEPARTMENT_COLUMNS, department_rows
+from companytreeAPI.views.employee import EMPLOYEE_ROW_FIELDS, employee_rows
+
+COMPANY = 'company'
+DEPARTMENTS = 'departments'
+EMPLOYEES = 'employees'
+SELF = 'self'
+SECTIONS = (COMPANY, DEPARTMENTS, EMPLOYEES, SELF)
+
+# Cache version scopes each section is read from, the shared departments
+# come with the company's employee count in each
+SCOPES = {
+    COMPANY: (cache.COMPANY_SCOPE,),
+    DEPARTMENTS: (cache.COMPANY_SCOPE, cache.GLOBAL_SCOPE),
+    EMPLOYEES: (cache.COMPANY_SCOPE,),
+    SELF: (cache.COMPANY_SCOPE,),
+}
+
+# Fields of an employee row in the employees and self sections
+EMPLOYEE_FIELDS = tuple(name for name, _ in EMPLOYEE_ROW_FIELDS)
+
+
+class BootstrapError(ValueError):
+    """A query parameter of a bootstrap request is invalid"""
+
+
+def _split(value):
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+def parse(query_params):
+    """Read the include, fields and since query parameters
+    Returns:
+        tuple -- (sections, employee fields or None for all, since token or None)
+    """
+    sections = _split(query_params.get('include', '')) or list(SECTIONS)
+    unknown = [section for section in sections if section not in SECTIONS]
+    if unknown:
+        raise BootstrapError(f'include must be a list of {", ".join(SECTIONS)}')
+
+    fields = _split(query_params.get('fields', '')) or None
+    if fields and any(field not in EMPLOYEE_FIELDS for field in fields):
+        raise BootstrapError(f'fields must be a list of {", ".join(EMPLOYEE_FIELDS)}')
+
+    return sections, fields, query_params.get('since') or None
+
+
+def plan(company_id, sections, since):
+    """Decide which sections have to be built
+    Returns:
+        tuple -- (current version token, sections to build, sections unchanged since the token)
+    """
+    versions = {
+        cache.COMPANY_SCOPE: str(cache.version(cache.COMPANY_SCOPE, company_id)),
+        cache.GLOBAL_SCOPE: str(cache.version(cache.GLOBAL_SCOPE)),
+    }
+    token = f'{versions[cache.COMPANY_SCOPE]}.{versions[cache.GLOBAL_SCOPE]}'
+
+    seen = dict(zip((cache.COMPANY_SCOPE, cache.GLOBAL_SCOPE), (since or '').split('.')))
+    unchanged = [
+        section for section in sections
+        if all(seen.get(scope) == versions[scope] for scope in SCOPES[section])
+    ]
+    return token, [section for section in sections if section not in unchanged], unchanged
+
+
+def company(principal, fields=None):
+    return Company.objects.filter(pk=principal.company_id).values(*CompanySerializer.Meta.fields).first()
+
+
+def departments(principal, fields=None):
+    return department_rows(Department.objects.values(*DEPARTMENT_COLUMNS), principal.company_id)
+
+
+def employees(principal, fields=None):
+    rows, to_rows = employee_rows(Employee.objects.filter(company_id=principal.company_id), fields)
+    return list(to_rows(rows))
+
+
+def caller(principal, fields=None):
+    rows, to_rows = employee_rows(Employee.objects.filter(pk=principal.employee_id), fields)
+    return next(to_rows(rows), None)
+
+
+BUILDERS = {COMPANY: company, DEPARTMENTS: departments, EMPLOYEES: employees, SELF: caller}
+
+
+def queries(sections):
+    """Sections that need a query of their own: self is picked out of employees when both are built"""
+    return [section for section in sections if not (section == SELF and EMPLOYEES in sections)]
+
+
+def build(principal, sections, fields, since):
+    """Build a bootstrap response one query at a time
+    Returns:
+        dict -- the version token, every built section and the unchanged ones
+    """
+    token, wanted, unchanged = plan(principal.company_id, sections, since)
+    built = {section: BUILDERS[section](principal, fields) for section in queries(wanted)}
+    return finish(principal, token, wanted, built, unchanged)
+
+
+def finish(principal, token, wanted, built, unchanged):
+    """Fill in the self section from employees when it was not queried on its own"""
+    if SELF in wanted and SELF not in built:
+        built[SELF] = next((row for row in built[EMPLOYEES] if row['id'] == principal.employee_id), None)
+    return {'version': token, **{section: built[section] for section in wanted}, 'unchanged': unchanged}
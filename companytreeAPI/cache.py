@@ -0,0 +1,209 @@
+"""Read cache for the directory endpoints
+
+Every company has a version number in the cache, and departments, which
+are shared by every company, have one more. Responses are cached under a
+key built from those versions, so bumping a version from the signal
+handlers invalidates exactly the responses that could have changed. The
+same key doubles as the ETag, letting clients revalidate with
+If-None-Match and get an empty 304.
+
+Versions are bumped once the transaction making the change commits.
+Bumped earlier, a concurrent request could still read the rows as they
+were before it and cache them under the new version for the whole
+timeout.
+"""
+import functools
+import hashlib
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router, transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+from companytreeAPI.models import Employee
+
+COMPANY_SCOPE = 'company'
+GLOBAL_SCOPE = 'global'
+
+
+class CacheStats:
+    """Hit and miss counters for this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.not_modified = 0
+            self.invalidations = 0
+
+    def record(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.not_modified
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified,
+                'invalidations': self.invalidations,
+                'hit_ratio': (self.hits + self.not_modified) / lookups if lookups else None,
+            }
+
+
+stats = CacheStats()
+
+
+def get_cache():
+    return caches[getattr(settings, 'COMPANYTREE_DIRECTORY_CACHE', 'default')]
+
+
+def _version_key(scope, company_id=None):
+    return f'directory:version:{scope}:{company_id}'
+
+
+def version(scope, company_id=None):
+    """Current version of a company's data, or of the shared data for GLOBAL_SCOPE"""
+    cache = get_cache()
+    key = _version_key(scope, company_id)
+    current = cache.get(key)
+    if current is None:
+        # Start from the clock so a restarted process never reuses old versions
+        current = time.time_ns()
+        if not cache.add(key, current, timeout=None):
+            current = cache.get(key, current)
+    return current
+
+
+def _bump(key):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+    stats.record('invalidations')
+
+
+def invalidate(scope, company_id=None, using=None):
+    """Bump a version so every response built from the old one is ignored, once the transaction commits
+    Arguments:
+        using -- database of the transaction, the current company's when None
+    """
+    if using is None:
+        using = router.db_for_write(Employee)
+    key = _version_key(scope, company_id)
+    transaction.on_commit(lambda: _bump(key), using=using)
+
+
+def invalidate_company(company_id, using=None):
+    if company_id is not None:
+        invalidate(COMPANY_SCOPE, company_id, using)
+
+
+def version_token(company_id):
+    """Opaque token that changes whenever anything a company can read changes"""
+    return f'{version(COMPANY_SCOPE, company_id)}.{version(GLOBAL_SCOPE)}'
+
+
+def _current_company_id(request):
+    if request.auth is None:
+        return None
+    return request.auth.principal.company_id
+
+
+def response_key(view_name, company_id, data_version, full_path):
+    """ETag and cache key of a response
+    Arguments:
+        view_name -- qualified name of the view, e.g. "Employees.list"
+        company_id -- caller's company, None for shared data
+        data_version -- version_token() or version() the response is built from
+        full_path -- request path with its query string
+    Returns:
+        tuple -- (etag, cache key)
+    """
+    fingerprint = f'{view_name}:{company_id}:{data_version}:{full_path}'
+    digest = hashlib.sha1(fingerprint.encode()).hexdigest()
+    return f'"{digest}"', f'directory:response:{digest}'
+
+
+def store(key, content, content_type):
+    get_cache().set(key, (content, content_type), getattr(settings, 'COMPANYTREE_DIRECTORY_CACHE_TIMEOUT', 3600))
+
+
+def _store(key, response):
+    store(key, response.content, response['Content-Type'])
+
+
+def tee(key, response):
+    """Cache a streaming response once the client has read all of it, if it is small enough"""
+    limit = getattr(settings, 'COMPANYTREE_DIRECTORY_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+    content_type = response['Content-Type']
+
+    def stream(chunks):
+        parts = []
+        size = 0
+        for chunk in chunks:
+            if parts is not None:
+                size += len(chunk)
+                if size <= limit:
+                    parts.append(chunk)
+                else:
+                    parts = None
+            yield chunk
+        if parts is not None:
+            store(key, b''.join(parts), content_type)
+
+    response.streaming_content = stream(response.streaming_content)
+
+
+def directory_cache(scope=COMPANY_SCOPE):
+    """Cache the successful responses of a ViewSet action
+    Arguments:
+        scope -- COMPANY_SCOPE when the response depends on the caller's
+                 company, GLOBAL_SCOPE when it only reads shared data
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(self, request, *args, **kwargs):
+            company_id = _current_company_id(request) if scope == COMPANY_SCOPE else None
+            if scope == COMPANY_SCOPE:
+                data_version = version_token(company_id)
+            else:
+                data_version = version(GLOBAL_SCOPE)
+
+            etag, key = response_key(view.__qualname__, company_id, data_version, request.get_full_path())
+
+            if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                stats.record('not_modified')
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+
+            cached = get_cache().get(key)
+            if cached is not None:
+                stats.record('hits')
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+            else:
+                stats.record('misses')
+                response = view(self, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                if response.streaming:
+                    tee(key, response)
+                elif hasattr(response, 'add_post_render_callback'):
+                    response.add_post_render_callback(functools.partial(_store, key))
+                else:
+                    _store(key, response)
+
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,148 @@
+"""Append-only change log behind the /changes feed
+
+Every save and delete of an employee, department, company or hobby
+appends a Change row: from the model signals for single rows, and from
+update() for the queryset updates and bulk writes that bypass them. The
+feed reads a company's changes after a client's cursor, keeps the last
+change of every row, and answers with the current state of the rows that
+still exist and tombstones for the ones that do not.
+
+Cursors are Change ids. On SQLite writers are serialized, so ids commit
+in order. On PostgreSQL a transaction can commit a lower id after a
+reader has moved past it, so keep writing transactions short.
+
+Every database of companytreeAPI.tenancy keeps the log of its own
+companies, and the changes of the shared departments are logged in all
+of them. A department whose employee count changed in one company is
+logged for that company only. The events pushed to clients carry the
+cursor of the change they report. A company moved to another database starts its log there above
+every cursor handed out before, and those cursors expire.
+"""
+from django.db import router
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+from companytreeAPI import push, tenancy
+from companytreeAPI.models import Change, Company, Department, Employee, EmployeeHobby
+
+EMPLOYEE = 'employee'
+DEPARTMENT = 'department'
+COMPANY = 'company'
+HOBBY = 'hobby'
+
+# Change kind of each model and the lookup of the company its rows belong to
+KINDS = {
+    Employee: (EMPLOYEE, 'company_id'),
+    Department: (DEPARTMENT, None),
+    Company: (COMPANY, 'id'),
+    EmployeeHobby: (HOBBY, 'employee__company_id'),
+}
+
+
+class CursorExpired(ValueError):
+    """Raised when the changes after a cursor have been pruned from the log"""
+
+
+def record(model, rows, deleted=False, using=None):
+    """Append a change for every (id, company id) pair of model and push them to the companies' clients"""
+    kind = KINDS[model][0]
+    if using is None:
+        using = router.db_for_write(model)
+    cursors = {}
+    for alias in tenancy.databases():
+        # Rows shared by every company, logged without one, are in every company's feed
+        logged = [(object_id, company_id) for object_id, company_id in rows if company_id is None or alias == using]
+        Change.objects.using(alias).bulk_create(
+            Change(kind=kind, object_id=object_id, company_id=company_id, deleted=deleted)
+            for object_id, company_id in logged
+        )
+        if logged:
+            cursors[alias] = cursor(alias)
+
+    changed = {}
+    for object_id, company_id in rows:
+        changed.setdefault(company_id, []).append({'kind': kind, 'id': object_id, 'deleted': deleted})
+    for company_id, company_changes in changed.items():
+        if company_id is None:
+            # Every database numbers its own log, so its companies get its own cursor
+            for alias, latest in cursors.items():
+                push.publish(None, company_changes, using, latest, alias)
+        else:
+            push.publish(company_id, company_changes, using, cursors[using])
+
+
+def record_instance(instance, deleted=False, using=None):
+    """Append a change for one saved or deleted model instance"""
+    model = type(instance)
+    if model is Employee:
+        company_id = instance.company_id
+    elif model is Company:
+        company_id = instance.id
+    elif model is EmployeeHobby:
+        company_id = Employee.objects.using(using).filter(pk=instance.employee_id).values_list('company_id', flat=True).first()
+    else:
+        company_id = None
+    record(model, [(instance.id, company_id)], deleted, using)
+
+
+def update(queryset, **values):
+    """queryset.update() that also stamps updated_at and logs a change for every updated row
+    Without values it only marks the rows as changed, e.g. after a bulk_update.
+    Returns:
+        int -- number of rows updated
+    """
+    model = queryset.model
+    lookup = KINDS[model][1]
+    if lookup is None:
+        rows = [(object_id, None) for object_id in queryset.values_list('id', flat=True)]
+    else:
+        rows = list(queryset.values_list('id', lookup))
+    if not rows:
+        return 0
+    # Updating the rows that are logged rather than whatever the filter matches by now
+    count = model.objects.filter(pk__in=[object_id for object_id, _ in rows]).update(updated_at=timezone.now(), **values)
+    record(model, rows)
+    return count
+
+
+def cursor(using=None):
+    """The cursor of the newest change, 0 when the log is empty"""
+    return Change.objects.using(using).aggregate(latest=Max('id'))['latest'] or 0
+
+
+def since(company_id, after, limit):
+    """The changes a company can see after a cursor, the last one per row
+    Arguments:
+        company_id -- the reader's company
+        after -- cursor of the reader's previous sync
+        limit -- most changes to read
+    Raises:
+        CursorExpired -- when changes after the cursor were pruned
+    Returns:
+        tuple -- (dict of kind to {id: deleted}, next cursor, whether more changes remain)
+    """
+    oldest = Change.objects.aggregate(oldest=Min('id'))['oldest']
+    if (oldest is not None and after < oldest - 1) or after < tenancy.tenant(company_id).cursor_floor:
+        raise CursorExpired(f'Changes after {after} are no longer kept, fetch the directory again')
+
+    changes = list(
+        Change.objects.filter(Q(company_id=company_id) | Q(company_id=None), id__gt=after)
+        .order_by('id').values_list('id', 'kind', 'object_id', 'deleted')[:limit + 1]
+    )
+    more = len(changes) > limit
+    changes = changes[:limit]
+
+    latest = {}
+    for _, kind, object_id, deleted in changes:
+        latest.setdefault(kind, {})[object_id] = deleted
+    return latest, changes[-1][0] if changes else after, more
+
+
+def prune(before):
+    """Delete the changes made before a datetime from every database, always keeping the newest
+    Returns:
+        int -- number of changes deleted
+    """
+    def prune_database():
+        deleted, _ = Change.objects.filter(created_at__lt=before, id__lt=cursor()).delete()
+        return deleted
+    return sum(tenancy.fan_out(prune_database))
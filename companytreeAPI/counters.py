@@ -0,0 +1,130 @@
+"""Maintained counters: a company's employees per department, direct and total reports per employee
+
+The hierarchy functions adjust the counters in the same transaction as the
+change that moves them, with F() updates so concurrent changes never lose
+an increment. recount_company() recomputes them from scratch to find and
+repair drift, e.g. after a cascade deleted rows.
+
+Departments are shared by every company, but each company only sees its
+own employees in them: the counts are DepartmentCount rows of the company,
+kept in its database. A hire changes its own company's version and change
+log and nobody else's.
+"""
+from django.db import IntegrityError, router
+from django.db.models import Count, F
+from companytreeAPI import analytics, cache, changes, tenancy
+from companytreeAPI.models import Department, DepartmentCount, Employee
+
+EMPLOYEE_COUNTERS = ('direct_report_count', 'total_report_count')
+
+
+def add_subtree(ancestor_ids, size):
+    """Add size reports to the total of every ancestor, negative when a subtree leaves them"""
+    if ancestor_ids and size:
+        changes.update(Employee.objects.filter(pk__in=ancestor_ids), total_report_count=F('total_report_count') + size)
+
+
+def add_direct_reports(supervisor_id, count):
+    if supervisor_id is not None and count:
+        changes.update(Employee.objects.filter(pk=supervisor_id), direct_report_count=F('direct_report_count') + count)
+
+
+def add_to_department(company_id, department_id, count):
+    """Add count employees of a company to a department, negative when they leave it"""
+    if department_id is None or not count:
+        return
+    counts = DepartmentCount.objects.filter(company_id=company_id, department_id=department_id)
+    if not counts.update(employee_count=F('employee_count') + count):
+        try:
+            # The company's first employee in the department, unless a concurrent one got there first
+            with tenancy.atomic():
+                DepartmentCount.objects.create(company_id=company_id, department_id=department_id, employee_count=count)
+        except IntegrityError:
+            counts.update(employee_count=F('employee_count') + count)
+    # Only the company's own feed shows the new count
+    changes.record(Department, [(department_id, company_id)], using=router.db_for_write(DepartmentCount))
+
+
+def change_department(employee, department_id):
+    """Move an employee's department count from their current department to department_id"""
+    department_id = int(department_id) if department_id not in (None, '') else None
+    if department_id == employee.department_id:
+        return
+    add_to_department(employee.company_id, employee.department_id, -1)
+    add_to_department(employee.company_id, department_id, 1)
+
+
+def count_departments(company_id, department_ids):
+    """Add the employees of a freshly inserted batch, given as a list of their department ids"""
+    counts = {}
+    for department_id in department_ids:
+        if department_id is not None:
+            counts[department_id] = counts.get(department_id, 0) + 1
+    for department_id, count in counts.items():
+        add_to_department(company_id, department_id, count)
+
+
+def department_counts(company_id):
+    """Employees of a company per department id, departments without any are left out"""
+    return dict(DepartmentCount.objects.filter(company_id=company_id).values_list('department_id', 'employee_count'))
+
+
+def _repair(model, stored, actual, fields, repair):
+    """Compare stored and actual counter tuples keyed by id
+    Returns:
+        list -- (model name, id, field, stored, actual) for every drifted counter
+    """
+    drift = []
+    fixed = []
+    for object_id, values in stored.items():
+        expected = actual.get(object_id, (0,) * len(fields))
+        if values != expected:
+            drift += [
+                (model.__name__, object_id, field, value, correct)
+                for field, value, correct in zip(fields, values, expected) if value != correct
+            ]
+            fixed.append(model(id=object_id, **dict(zip(fields, expected))))
+    if repair and fixed:
+        model.objects.bulk_update(fixed, fields, batch_size=500)
+        changes.update(model.objects.filter(pk__in=[instance.id for instance in fixed]))
+    return drift
+
+
+def recount_company(company_id, repair=True):
+    """Recompute the report counters of a company's employees and its employees per department"""
+    direct, total, _ = analytics.report_counts(company_id)
+    stored = {
+        employee_id: (direct_count, total_count)
+        for employee_id, direct_count, total_count in
+        Employee.objects.filter(company_id=company_id).values_list('id', *EMPLOYEE_COUNTERS).iterator()
+    }
+    actual = {employee_id: (direct[employee_id], total[employee_id]) for employee_id in direct}
+    drift = _repair(Employee, stored, actual, EMPLOYEE_COUNTERS, repair)
+    drift += recount_departments(company_id, repair)
+    if repair and drift:
+        cache.invalidate_company(company_id)
+    return drift
+
+
+def recount_departments(company_id, repair=True):
+    """Recompute the employees of a company in every department"""
+    actual = dict(
+        Employee.objects.filter(company_id=company_id).exclude(department_id=None)
+        .values_list('department_id').annotate(Count('id')).order_by()
+    )
+    stored = department_counts(company_id)
+    drifted = sorted(
+        department_id for department_id in actual.keys() | stored.keys()
+        if stored.get(department_id, 0) != actual.get(department_id, 0)
+    )
+    if repair and drifted:
+        DepartmentCount.objects.filter(company_id=company_id).delete()
+        DepartmentCount.objects.bulk_create(
+            DepartmentCount(company_id=company_id, department_id=department_id, employee_count=count)
+            for department_id, count in actual.items()
+        )
+        changes.record(Department, [(department_id, company_id) for department_id in drifted], using=router.db_for_write(DepartmentCount))
+    return [
+        ('Department', department_id, f'employee_count in company {company_id}', stored.get(department_id, 0), actual.get(department_id, 0))
+        for department_id in drifted
+    ]
@@ -0,0 +1,123 @@
+"""SQLite connection tuning and routing of read-only requests to a read alias
+
+Every new SQLite connection gets the PRAGMAs in COMPANYTREE_SQLITE_PRAGMAS.
+WAL lets readers carry on while a write is in progress, and busy_timeout
+makes a second writer wait for the lock instead of failing with "database
+is locked".
+
+ReadOnlyActionMiddleware marks the list and retrieve actions of the
+ViewSets as reads, and ReadAliasRouter sends their queries to the read
+alias COMPANYTREE_READ_DATABASES gives the default alias. On SQLite that
+alias is a second connection to the same file, so reads never queue
+behind a request that holds the default connection in a write
+transaction; in production it can point at a replica. Everything else
+keeps using the default alias. Each database of companytreeAPI.tenancy
+has a read alias of its own.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Order matters: busy_timeout has to be set before journal_mode, which takes a lock
+DEFAULT_PRAGMAS = {
+    'busy_timeout': 5000,
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'memory',
+}
+
+READ_ACTIONS = ('list', 'retrieve')
+
+_reading = ContextVar('companytree_reading', default=False)
+
+
+def tune_sqlite(sender, connection, **kwargs):
+    """connection_created receiver applying the configured PRAGMAs to SQLite connections"""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'COMPANYTREE_SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+    # An in-memory database (the test database) has no journal file to switch to WAL
+    in_memory = connection.is_in_memory_db()
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            if name == 'journal_mode' and in_memory:
+                continue
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def read_alias(alias=DEFAULT_DB_ALIAS):
+    """The alias reads of a database go to, or the database itself inside a transaction so it sees its own writes"""
+    read = getattr(settings, 'COMPANYTREE_READ_DATABASES', {DEFAULT_DB_ALIAS: 'read'}).get(alias)
+    if read not in connections.databases or connections[alias].in_atomic_block:
+        return alias
+    return read
+
+
+def is_reading():
+    """Whether the current request only reads"""
+    return _reading.get()
+
+
+@contextmanager
+def reading():
+    """Send the reads made inside the block to the read alias"""
+    token = _reading.set(True)
+    try:
+        yield
+    finally:
+        _reading.reset(token)
+
+
+def _read_stream(chunks):
+    # Streamed bodies run their queries after the view has returned
+    chunks = iter(chunks)
+    while True:
+        with reading():
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+class ReadAliasRouter:
+    """Route reads made while serving a read-only action to the read alias"""
+
+    def db_for_read(self, model, **hints):
+        return read_alias() if is_reading() else None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReadOnlyActionMiddleware:
+    """Mark requests routed to the list or retrieve action of a ViewSet as reads"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.companytree_read = None
+        try:
+            response = self.get_response(request)
+        finally:
+            if request.companytree_read is not None:
+                _reading.reset(request.companytree_read)
+        if request.companytree_read is not None and response.streaming:
+            response.streaming_content = _read_stream(response.streaming_content)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # ViewSet.as_view() keeps its method to action mapping on the view function
+        action = getattr(view_func, 'actions', {}).get(request.method.lower())
+        if action in READ_ACTIONS:
+            request.companytree_read = _reading.set(True)
@@ -0,0 +1,109 @@
+"""Streaming export of a company's employees as JSON lines or CSV"""
+import csv
+import io
+import json
+import zlib
+from django.core.serializers.json import DjangoJSONEncoder
+from companytreeAPI.models import Employee
+
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = (CSV, JSONL)
+CONTENT_TYPES = {CSV: 'text/csv', JSONL: 'application/x-ndjson'}
+
+# Column name and the Employee lookup it is read from
+COLUMNS = (
+    ('id', 'id'),
+    ('username', 'user__username'),
+    ('first_name', 'user__first_name'),
+    ('last_name', 'user__last_name'),
+    ('email', 'user__email'),
+    ('position', 'position'),
+    ('location', 'location'),
+    ('bio', 'bio'),
+    ('image_url', 'image_url'),
+    ('tasks', 'tasks'),
+    ('phone', 'phone'),
+    ('slack', 'slack'),
+    ('is_admin', 'is_admin'),
+    ('company_id', 'company_id'),
+    ('department_id', 'department_id'),
+    ('department_name', 'department__name'),
+    ('supervisor_id', 'supervisor_id'),
+    ('supervisor_username', 'supervisor__user__username'),
+)
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+
+# Rows are read from the database and flushed to the output in groups of this size
+EXPORT_CHUNK_ROWS = 2000
+
+
+def rows(company_id, chunk_size=EXPORT_CHUNK_ROWS):
+    """Yield one tuple per employee from a server-side cursor, in COLUMNS order"""
+    return (
+        Employee.objects.filter(company_id=company_id)
+        .order_by('id')
+        .values_list(*(lookup for _, lookup in COLUMNS))
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def _encode_jsonl(rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(dict(zip(COLUMN_NAMES, row))) + '\n'
+
+
+def _encode_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMN_NAMES)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(company_id, file_format=JSONL, compress=False, chunk_size=EXPORT_CHUNK_ROWS):
+    """Stream a company's employees, holding at most one chunk of rows in memory
+    Arguments:
+        company_id -- company to export
+        file_format -- "jsonl" or "csv"
+        compress -- gzip the output on the fly
+        chunk_size -- rows fetched and written at a time
+    Yields:
+        bytes -- pieces of the file
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}')
+    encode = _encode_csv if file_format == CSV else _encode_jsonl
+
+    def chunks():
+        lines = []
+        for line in encode(rows(company_id, chunk_size)):
+            lines.append(line)
+            if len(lines) >= chunk_size:
+                yield ''.join(lines).encode()
+                lines = []
+        if lines:
+            yield ''.join(lines).encode()
+
+    return _gzip(chunks()) if compress else chunks()
+
+
+def filename(company_id, file_format, compress):
+    return f'company-{company_id}-employees.{file_format}' + ('.gz' if compress else '')
+
+
+def content_type(file_format, compress):
+    return 'application/gzip' if compress else CONTENT_TYPES[file_format]
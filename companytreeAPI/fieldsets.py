@@ -0,0 +1,66 @@
+"""Sparse fieldsets and fast row serialization for the ViewSets
+
+Any GET can add ?fields=a,b to trim every object in the response to
+those top-level fields; id is always kept so rows can still be told
+apart. List endpoints also build their rows straight from .values()
+dicts instead of model instances and serializer fields, which is several
+times faster on large lists and only ever reads the columns named in the
+row definition, so no other column can leak out.
+"""
+from rest_framework.response import Response
+
+FIELDS_QUERY_PARAM = 'fields'
+
+
+def requested_fields(request):
+    """Fields asked for with ?fields=, or None for every field"""
+    fields = [field.strip() for field in request.query_params.get(FIELDS_QUERY_PARAM, '').split(',') if field.strip()]
+    return tuple(fields) or None
+
+
+def _trim(item, fields):
+    if not isinstance(item, dict):
+        return item
+    return {field: value for field, value in item.items() if field in fields or field == 'id'}
+
+
+def project(data, fields):
+    """Trim a response body to fields, keeping pagination envelopes intact"""
+    if isinstance(data, list):
+        return [_trim(item, fields) for item in data]
+    if isinstance(data, dict) and isinstance(data.get('results'), list) and 'next' in data:
+        return {**data, 'results': project(data['results'], fields)}
+    return _trim(data, fields)
+
+
+class SparseFieldsMixin:
+    """ViewSet mixin applying ?fields= to every successful Response"""
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        fields = requested_fields(request)
+        if fields is not None and isinstance(response, Response) and response.status_code == 200:
+            response.data = project(response.data, fields)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+def columns(row_fields, fields=None, always=('id',)):
+    """Pick the (row field, lookup) pairs of the requested fields
+    Arguments:
+        row_fields -- (row field, model lookup) pairs in output order
+        fields -- requested row fields, None for all
+        always -- fields kept regardless, e.g. the keyset pagination key
+    """
+    if fields is None:
+        return tuple(row_fields)
+    return tuple((name, lookup) for name, lookup in row_fields if name in fields or name in always)
+
+
+def values(queryset, row_columns):
+    """A .values() queryset reading only the given columns"""
+    return queryset.values(*(lookup for _, lookup in row_columns))
+
+
+def rows(values_rows, row_columns):
+    """Rename .values() dicts to their row fields"""
+    for row in values_rows:
+        yield {name: row[lookup] for name, lookup in row_columns}
@@ -0,0 +1,40 @@
+"""Password hashers whose cost comes from settings
+
+They keep the algorithm names of Django's own hashers, so existing hashes
+still verify. When the configured cost differs from the one a stored hash
+was made with, Django rehashes the password on the user's next login.
+COMPANYTREE_PASSWORD_HASHERS in the settings names them.
+"""
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+
+    @property
+    def iterations(self):
+        return getattr(settings, 'COMPANYTREE_PBKDF2_ITERATIONS', hashers.PBKDF2PasswordHasher.iterations)
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    """Argon2i, like Django 3.0's own hasher, through argon2-cffi, which has to be installed to use it"""
+
+    @property
+    def time_cost(self):
+        return getattr(settings, 'COMPANYTREE_ARGON2_TIME_COST', hashers.Argon2PasswordHasher.time_cost)
+
+    @property
+    def memory_cost(self):
+        return getattr(settings, 'COMPANYTREE_ARGON2_MEMORY_COST', hashers.Argon2PasswordHasher.memory_cost)
+
+    @property
+    def parallelism(self):
+        return getattr(settings, 'COMPANYTREE_ARGON2_PARALLELISM', hashers.Argon2PasswordHasher.parallelism)
+
+
+class BCryptSHA256PasswordHasher(hashers.BCryptSHA256PasswordHasher):
+    """bcrypt through the bcrypt package, which has to be installed to use it"""
+
+    @property
+    def rounds(self):
+        return getattr(settings, 'COMPANYTREE_BCRYPT_ROUNDS', hashers.BCryptSHA256PasswordHasher.rounds)
@@ -0,0 +1,297 @@
+"""Helpers for walking the Employee.supervisor reporting hierarchy"""
+from django.contrib.auth.models import User
+from django.db import connection, connections, router
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from companytreeAPI import changes, counters, tenancy
+from companytreeAPI.models import Employee
+
+# Guards the recursive queries against supervisor cycles in the data.
+MAX_TREE_DEPTH = 256
+
+TREE_COLUMNS = ('id', 'supervisor_id', 'department_id', 'position', 'location', 'image_url', 'first_name', 'last_name', 'depth')
+
+
+def _tables():
+    return (
+        connection.ops.quote_name(Employee._meta.db_table),
+        connection.ops.quote_name(User._meta.db_table),
+    )
+
+
+def _fetch(sql, params):
+    with connections[router.db_for_read(Employee)].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [dict(zip(TREE_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def subtree_rows(employee_id, company_id, depth=None):
+    """Load an employee and everyone reporting to them in a single recursive query
+    Arguments:
+        employee_id -- root of the subtree
+        company_id -- only employees of this company are visited
+        depth -- how many levels of reports to include (None for all)
+    Returns:
+        list -- one dict per employee ordered by depth, root first
+    """
+    employee_table, user_table = _tables()
+    max_depth = MAX_TREE_DEPTH if depth is None else min(depth, MAX_TREE_DEPTH)
+
+    sql = f"""
+        WITH RECURSIVE subtree(id, depth) AS (
+            SELECT id, 0 FROM {employee_table}
+            WHERE id = %s AND company_id = %s
+            UNION ALL
+            SELECT e.id, s.depth + 1 FROM {employee_table} e
+            JOIN subtree s ON e.supervisor_id = s.id
+            WHERE e.company_id = %s AND s.depth < %s
+        )
+        SELECT e.id, e.supervisor_id, e.department_id, e.position, e.location, e.image_url,
+               u.first_name, u.last_name, s.depth
+        FROM subtree s
+        JOIN {employee_table} e ON e.id = s.id
+        JOIN {user_table} u ON u.id = e.user_id
+        ORDER BY s.depth, e.id
+    """
+    return _fetch(sql, [employee_id, company_id, company_id, max_depth])
+
+
+def manager_rows(employee_id, company_id, depth=None):
+    """Load an employee and their chain of supervisors in a single recursive query
+    Arguments:
+        employee_id -- employee to start from
+        company_id -- only employees of this company are visited
+        depth -- how many levels of managers to include (None for all)
+    Returns:
+        list -- one dict per employee, the employee first and the top manager last
+    """
+    employee_table, user_table = _tables()
+    max_depth = MAX_TREE_DEPTH if depth is None else min(depth, MAX_TREE_DEPTH)
+
+    sql = f"""
+        WITH RECURSIVE chain(id, supervisor_id, depth) AS (
+            SELECT id, supervisor_id, 0 FROM {employee_table}
+            WHERE id = %s AND company_id = %s
+            UNION ALL
+            SELECT e.id, e.supervisor_id, c.depth + 1 FROM {employee_table} e
+            JOIN chain c ON e.id = c.supervisor_id
+            WHERE e.company_id = %s AND c.depth < %s
+        )
+        SELECT e.id, e.supervisor_id, e.department_id, e.position, e.location, e.image_url,
+               u.first_name, u.last_name, c.depth
+        FROM chain c
+        JOIN {employee_table} e ON e.id = c.id
+        JOIN {user_table} u ON u.id = e.user_id
+        ORDER BY c.depth
+    """
+    return _fetch(sql, [employee_id, company_id, company_id, max_depth])
+
+
+def nest_reports(rows):
+    """Turn subtree rows into a nested dict with a "reports" list on every node
+    Returns:
+        dict -- the root node, or None when there are no rows
+    """
+    nodes = {}
+    root = None
+    for row in rows:
+        # A node reached twice can only come from a cycle, keep the shallowest
+        if row['id'] in nodes:
+            continue
+        node = dict(row, reports=[])
+        nodes[row['id']] = node
+        if root is None:
+            root = node
+        else:
+            nodes[row['supervisor_id']]['reports'].append(node)
+    return root
+
+
+def nest_managers(rows):
+    """Turn manager chain rows into a nested dict linked through "supervisor"
+    Returns:
+        dict -- the starting employee, or None when there are no rows
+    """
+    root = None
+    current = None
+    seen = set()
+    for row in rows:
+        if row['id'] in seen:
+            break
+        seen.add(row['id'])
+        node = dict(row, supervisor=None)
+        if current is None:
+            root = node
+        else:
+            current['supervisor'] = node
+        current = node
+    return root
+
+
+class HierarchyError(ValueError):
+    """Raised when a supervisor change would break the reporting tree"""
+
+
+def _path_of(employee_id):
+    """Return the stored path of an employee, rebuilding it from the database when missing"""
+    if employee_id is None:
+        return '/'
+    path = Employee.objects.filter(pk=employee_id).values_list('path', flat=True).first()
+    if path is None:
+        raise HierarchyError(f'Supervisor {employee_id} does not exist')
+    if not path:
+        chain = manager_rows(employee_id, Employee.objects.get(pk=employee_id).company_id)
+        path = '/' + ''.join(f'{row["id"]}/' for row in reversed(chain))
+        Employee.objects.filter(pk=employee_id).update(path=path)
+    return path
+
+
+def ancestor_ids(employee):
+    """Ids of every supervisor above an employee, top manager first, without a query"""
+    return [int(part) for part in employee.path.strip('/').split('/')[:-1] if part]
+
+
+def is_under(employee, ancestor):
+    """Check whether employee reports to ancestor directly or transitively"""
+    return employee.pk != ancestor.pk and employee.path.startswith(ancestor.path)
+
+
+def _below(prefix):
+    """Lookups of the paths starting with prefix, as a range the path index serves
+    startswith becomes LIKE, which SQLite only serves from an index when it is
+    case-sensitive. Paths end in "/", and "0" is the next character in byte
+    order, so on PostgreSQL the range needs a database created with the C collation.
+    """
+    return {'path__gte': prefix, 'path__lt': prefix[:-1] + '0'}
+
+
+def descendants(employee):
+    """Queryset of everyone reporting to an employee, served by a range scan on path"""
+    return Employee.objects.filter(**_below(employee.path)).exclude(pk=employee.pk)
+
+
+def _rewrite_prefix(old_prefix, new_prefix):
+    """Swap the leading old_prefix for new_prefix on every path below old_prefix"""
+    Employee.objects.filter(**_below(old_prefix)).update(
+        path=Concat(Value(new_prefix), Substr('path', len(old_prefix) + 1))
+    )
+
+
+def _path_ids(path):
+    return {int(part) for part in path.strip('/').split('/') if part}
+
+
+def attach(employee):
+    """Set the path of a newly saved employee from their supervisor and count them
+    in their supervisors' and department's counters"""
+    with tenancy.atomic():
+        employee.path = f'{_path_of(employee.supervisor_id)}{employee.id}/'
+        Employee.objects.filter(pk=employee.pk).update(path=employee.path)
+        counters.add_subtree(ancestor_ids(employee), 1)
+        counters.add_direct_reports(employee.supervisor_id, 1)
+        counters.add_to_department(employee.company_id, employee.department_id, 1)
+
+
+def parse_supervisor_id(value):
+    """The supervisor id a request sent, None for no supervisor
+    Raises:
+        HierarchyError -- when the value is not an integer
+    """
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HierarchyError('supervisor_id must be an integer')
+
+
+def check_supervisor(employee, supervisor_id):
+    """Raise HierarchyError if employee cannot report to supervisor_id"""
+    supervisor_id = parse_supervisor_id(supervisor_id)
+    if supervisor_id is None:
+        return
+    if supervisor_id == employee.id:
+        raise HierarchyError('An employee cannot supervise themselves')
+    if not Employee.objects.filter(pk=supervisor_id, company_id=employee.company_id).exists():
+        raise HierarchyError(f'Supervisor {supervisor_id} does not exist')
+    # A new employee has no reports yet to form a cycle with
+    if employee.pk is None:
+        return
+    supervisor_path = _path_of(supervisor_id)
+    if supervisor_path.startswith(_path_of(employee.id)):
+        raise HierarchyError('Supervisor reports to this employee, the change would create a cycle')
+
+
+def move(employee, supervisor_id):
+    """Give an employee a new supervisor and rewrite the paths of their whole subtree
+    Raises:
+        HierarchyError -- when the new supervisor is the employee or one of their reports
+    """
+    supervisor_id = parse_supervisor_id(supervisor_id)
+    with tenancy.atomic():
+        check_supervisor(employee, supervisor_id)
+        old_path = _path_of(employee.id)
+        new_path = f'{_path_of(supervisor_id)}{employee.id}/'
+        old_supervisor_id = Employee.objects.filter(pk=employee.pk).values_list('supervisor_id', flat=True).get()
+        changes.update(Employee.objects.filter(pk=employee.pk), supervisor_id=supervisor_id)
+        _rewrite_prefix(old_path, new_path)
+
+        # The subtree leaves the supervisors only above its old position and joins those only above the new one
+        size = 1 + Employee.objects.filter(pk=employee.pk).values_list('total_report_count', flat=True).get()
+        old_ancestors = _path_ids(old_path) - {employee.id}
+        new_ancestors = _path_ids(new_path) - {employee.id}
+        counters.add_subtree(old_ancestors - new_ancestors, -size)
+        counters.add_subtree(new_ancestors - old_ancestors, size)
+        counters.add_direct_reports(old_supervisor_id, -1)
+        counters.add_direct_reports(supervisor_id, 1)
+
+        employee.supervisor_id = supervisor_id
+        employee.path = new_path
+
+
+def detach(employee):
+    """Prepare an employee for deletion by moving their direct reports up to their supervisor
+    and taking them out of their supervisors' and department's counters"""
+    with tenancy.atomic():
+        old_path = _path_of(employee.id)
+        direct_reports = changes.update(Employee.objects.filter(supervisor_id=employee.id), supervisor_id=employee.supervisor_id)
+        _rewrite_prefix(old_path, _path_of(employee.supervisor_id))
+        counters.add_subtree(_path_ids(old_path) - {employee.id}, -1)
+        counters.add_direct_reports(employee.supervisor_id, direct_reports - 1)
+        counters.add_to_department(employee.company_id, employee.department_id, -1)
+
+
+def build_paths(edges):
+    """Compute paths for a whole company from (id, supervisor_id) pairs
+    Supervisors outside the given pairs are treated as missing, so those
+    employees become roots. Employees caught in a supervisor cycle are cut
+    loose at their lowest id.
+    Returns:
+        tuple -- (dict of id to path, list of ids whose supervisor link was cut)
+    """
+    reports = {}
+    for employee_id, supervisor_id in edges:
+        reports.setdefault(supervisor_id, []).append(employee_id)
+
+    paths = {}
+    cut = []
+
+    def walk(root_ids, prefix):
+        pending = [(root_id, prefix) for root_id in root_ids]
+        while pending:
+            current_id, parent_path = pending.pop()
+            if current_id in paths:
+                continue
+            paths[current_id] = f'{parent_path}{current_id}/'
+            pending.extend((report_id, paths[current_id]) for report_id in reports.get(current_id, ()))
+
+    ids = {employee_id for employee_id, _ in edges}
+    walk([employee_id for employee_id, supervisor_id in edges if supervisor_id not in ids], '/')
+
+    # Whatever is left is only reachable through a cycle
+    for employee_id in sorted(ids - paths.keys()):
+        if employee_id not in paths:
+            cut.append(employee_id)
+            walk([employee_id], '/')
+
+    return paths, cut
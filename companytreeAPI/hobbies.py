@@ -0,0 +1,240 @@
+"""In-memory inverted index of a company's hobbies
+
+Each process keeps, for the last companies asked about, the sorted array
+of employee ids behind every hobby and the hobbies of every employee.
+"Who likes chess" is one array. The colleagues sharing an employee's
+hobbies are counted by adding up bitsets of those hobbies over the
+company's employees bit-parallel, a handful of big integer operations per
+hobby however many employees share them, without joining EmployeeHobby to
+itself.
+
+A bitset takes an eighth of a byte per employee of the company and an
+array eight bytes per employee with the hobby, so only hobbies shared by
+at least one employee in DENSE_RATIO keep their bitset. No bitset is then
+bigger than its array and an index takes memory in proportion to the
+company's hobby rows. The bitsets of rarer hobbies are packed from their
+arrays when a colleagues query needs them, which costs about as much as
+adding them up.
+
+An index is read from the database the first time a company is queried
+and tagged with the company's cache version and a change log cursor.
+When the version moves on, only the hobby rows changed since the cursor
+are read and applied; too many changes, or a pruned cursor, read the
+company again. Hobbies match case-insensitively.
+"""
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from django.conf import settings
+from companytreeAPI import cache, changes
+from companytreeAPI.models import Employee, EmployeeHobby
+
+# Default number of colleagues returned
+COLLEAGUE_LIMIT = 10
+
+# Hobbies of at least one employee in this many keep a bitset
+DENSE_RATIO = 64
+
+
+def normalize(hobby):
+    """The index key of a hobby"""
+    return ' '.join(hobby.split()).casefold()
+
+
+class HobbyIndex:
+    """Hobby to employee ids of one company, with the version and cursor it was read at"""
+
+    def __init__(self, company_id):
+        self.company_id = company_id
+        self.lock = threading.Lock()
+        self.version = None
+        self.cursor = None
+        self._clear()
+
+    def _clear(self):
+        # Hobby row id to (employee id, hobby key)
+        self.rows = {}
+        # Employee id to a count of every hobby key, an employee can list a hobby twice
+        self.employees = {}
+        # Hobby key to the sorted ids of the employees with it
+        self.postings = {}
+        # Hobby key to the bitset of the same employees, bit numbers from slots,
+        # for the hobbies dense enough to keep one
+        self.bitsets = {}
+        # Hobby key to the name shown for it, the first spelling seen
+        self.names = {}
+        # Employee id to their bit, and bit to employee id. Every employee gets
+        # a bit in id order on a full read and new employees have higher ids,
+        # so bit order stays id order
+        self.slots = {}
+        self.members = []
+
+    def refresh(self):
+        """Bring the index up to date with the company's current version"""
+        current = cache.version(cache.COMPANY_SCOPE, self.company_id)
+        if current == self.version:
+            return
+        if self.version is None or not self._apply_changes():
+            # The cursor is read first, so nothing written while reading is skipped later
+            self.cursor = changes.cursor()
+            self._read()
+        self.version = current
+
+    def _read(self):
+        self._clear()
+        employee_ids = Employee.objects.filter(company_id=self.company_id).order_by('id').values_list('id', flat=True)
+        self.members = list(employee_ids.iterator())
+        self.slots = {employee_id: slot for slot, employee_id in enumerate(self.members)}
+
+        rows = EmployeeHobby.objects.filter(employee__company_id=self.company_id).order_by('employee_id')
+        for row_id, employee_id, hobby in rows.values_list('id', 'employee_id', 'hobby').iterator():
+            self._add(row_id, employee_id, hobby, load=True)
+
+        # Rows came in employee order, so the posting arrays are already sorted
+        for key, ids in self.postings.items():
+            if self._dense(ids):
+                self.bitsets[key] = self._pack(ids)
+
+    def _dense(self, ids):
+        return len(ids) * DENSE_RATIO >= len(self.members)
+
+    def _pack(self, ids):
+        """The bitset of employee ids, setting bits in a byte array beats growing an int per id"""
+        bits = bytearray((len(self.members) + 7) // 8)
+        for employee_id in ids:
+            slot = self.slots[employee_id]
+            bits[slot >> 3] |= 1 << (slot & 7)
+        return int.from_bytes(bits, 'little')
+
+    def _bitset(self, key):
+        bits = self.bitsets.get(key)
+        return self._pack(self.postings[key]) if bits is None else bits
+
+    def _apply_changes(self):
+        limit = getattr(settings, 'COMPANYTREE_HOBBY_INCREMENTAL_LIMIT', 1000)
+        try:
+            latest, cursor, more = changes.since(self.company_id, self.cursor, limit)
+        except changes.CursorExpired:
+            return False
+        if more:
+            return False
+        changed = list(latest.get(changes.HOBBY, {}))
+        for row_id in changed:
+            self._remove(row_id)
+        saved = EmployeeHobby.objects.filter(employee__company_id=self.company_id, pk__in=changed)
+        for row_id, employee_id, hobby in saved.values_list('id', 'employee_id', 'hobby'):
+            self._add(row_id, employee_id, hobby)
+        self.cursor = cursor
+        return True
+
+    def _add(self, row_id, employee_id, hobby, load=False):
+        key = normalize(hobby)
+        self.rows[row_id] = (employee_id, key)
+        self.names.setdefault(key, hobby)
+        counts = self.employees.setdefault(employee_id, Counter())
+        counts[key] += 1
+        if counts[key] > 1:
+            return
+        ids = self.postings.setdefault(key, array('q'))
+        if load:
+            ids.append(employee_id)
+            return
+        ids.insert(bisect_left(ids, employee_id), employee_id)
+        if employee_id not in self.slots:
+            self.slots[employee_id] = len(self.members)
+            self.members.append(employee_id)
+        if key in self.bitsets:
+            self.bitsets[key] |= 1 << self.slots[employee_id]
+        elif self._dense(ids):
+            self.bitsets[key] = self._pack(ids)
+
+    def _remove(self, row_id):
+        if row_id not in self.rows:
+            return
+        employee_id, key = self.rows.pop(row_id)
+        counts = self.employees[employee_id]
+        counts[key] -= 1
+        if counts[key]:
+            return
+        del counts[key]
+        if not counts:
+            del self.employees[employee_id]
+        ids = self.postings[key]
+        del ids[bisect_left(ids, employee_id)]
+        if not ids:
+            del self.postings[key]
+            self.bitsets.pop(key, None)
+            del self.names[key]
+        elif key in self.bitsets:
+            if self._dense(ids):
+                self.bitsets[key] &= ~(1 << self.slots[employee_id])
+            else:
+                del self.bitsets[key]
+
+    def hobbies(self):
+        """(name, number of employees) of every hobby, most popular first"""
+        return sorted(((self.names[key], len(ids)) for key, ids in self.postings.items()), key=lambda item: (-item[1], item[0]))
+
+    def employees_with(self, hobby):
+        """Sorted ids of the employees with a hobby"""
+        return self.postings.get(normalize(hobby), array('q'))
+
+    def colleagues(self, employee_id, limit=COLLEAGUE_LIMIT):
+        """The colleagues sharing most hobbies with an employee, ties by id
+        Returns:
+            list -- (colleague id, names of the shared hobbies) pairs
+        """
+        keys = sorted(self.employees.get(employee_id, ()))
+        if not keys:
+            return []
+        everyone = (1 << len(self.members)) - 1
+        others = everyone ^ 1 << self.slots[employee_id]
+
+        # planes[n] holds bit n of every employee's shared hobby count, added up like binary numbers
+        planes = []
+        for key in keys:
+            carry = self._bitset(key) & others
+            for plane, bits in enumerate(planes):
+                planes[plane], carry = bits ^ carry, bits & carry
+                if not carry:
+                    break
+            if carry:
+                planes.append(carry)
+
+        best = []
+        for count in range(min(len(keys), (1 << len(planes)) - 1), 0, -1):
+            # Employees whose count is exactly count
+            matches = everyone
+            for plane, bits in enumerate(planes):
+                matches &= bits if count >> plane & 1 else everyone ^ bits
+            while matches and len(best) < limit:
+                lowest = matches & -matches
+                best.append(self.members[lowest.bit_length() - 1])
+                matches ^= lowest
+            if len(best) == limit:
+                break
+        return [
+            (colleague_id, [self.names[key] for key in keys if key in self.employees[colleague_id]])
+            for colleague_id in best
+        ]
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def company_index(company_id):
+    """The up to date hobby index of a company, least recently used companies are forgotten
+    Read it while holding its lock, a refresh changes it in place.
+    """
+    with _indexes_lock:
+        index = _indexes.get(company_id)
+        if index is None:
+            index = _indexes[company_id] = HobbyIndex(company_id)
+            if len(_indexes) > getattr(settings, 'COMPANYTREE_HOBBY_CACHE_SIZE', 32):
+                _indexes.popitem(last=False)
+        _indexes.move_to_end(company_id)
+    with index.lock:
+        index.refresh()
+    return index
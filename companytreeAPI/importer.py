@@ -0,0 +1,265 @@
+"""Bulk import of employees from CSV or JSON lines"""
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
+from companytreeAPI import cache, changes, counters, search, tenancy
+from companytreeAPI.hierarchy import build_paths
+from companytreeAPI.models import Department, Employee
+
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = (CSV, JSONL)
+
+USER_FIELDS = ('username', 'email', 'first_name', 'last_name')
+EMPLOYEE_FIELDS = ('position', 'location', 'bio', 'image_url', 'tasks', 'phone', 'slack')
+REQUIRED_FIELDS = ('username', 'position', 'location')
+
+
+class ImportResult:
+    """Outcome of an import"""
+
+    def __init__(self):
+        self.created = 0
+        self.errors = []
+        self.seconds = 0.0
+
+    def error(self, row_number, message):
+        self.errors.append({'row': row_number, 'message': message})
+
+    @property
+    def rows_per_second(self):
+        return self.created / self.seconds if self.seconds else None
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'errors': self.errors,
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': round(self.rows_per_second, 1) if self.rows_per_second else None,
+        }
+
+
+def _lines(stream):
+    for line in stream:
+        yield line.decode('utf-8-sig') if isinstance(line, bytes) else line
+
+
+def parse(stream, file_format):
+    """Lazily read rows from a binary or text stream
+    Yields:
+        tuple -- (row number, dict of values, or None with an error message)
+    """
+    if file_format == CSV:
+        for row_number, row in enumerate(csv.DictReader(_lines(stream)), start=1):
+            yield row_number, row, None
+    elif file_format == JSONL:
+        row_number = 0
+        for line in _lines(stream):
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                row = json.loads(line)
+            except ValueError as ex:
+                yield row_number, None, f'Invalid JSON: {ex}'
+                continue
+            if not isinstance(row, dict):
+                yield row_number, None, 'Each line must be a JSON object'
+                continue
+            yield row_number, row, None
+    else:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}')
+
+
+def _max_lengths():
+    lengths = {}
+    for model, fields in ((User, USER_FIELDS), (Employee, EMPLOYEE_FIELDS)):
+        for name in fields:
+            lengths[name] = model._meta.get_field(name).max_length
+    return lengths
+
+
+def _clean(row, department_ids, max_lengths):
+    """Validate one row
+    Returns:
+        tuple -- (cleaned dict, list of error messages)
+    """
+    errors = []
+    cleaned = {}
+    for name in USER_FIELDS + EMPLOYEE_FIELDS + ('password', 'supervisor_username'):
+        value = row.get(name)
+        cleaned[name] = str(value).strip() if value not in (None, '') else None
+        if cleaned[name] and max_lengths.get(name) and len(cleaned[name]) > max_lengths[name]:
+            errors.append(f'{name} is longer than {max_lengths[name]} characters')
+
+    for name in REQUIRED_FIELDS:
+        if not cleaned[name]:
+            errors.append(f'{name} is required')
+
+    department_id = row.get('department_id')
+    if department_id in (None, ''):
+        cleaned['department_id'] = None
+    else:
+        try:
+            cleaned['department_id'] = int(department_id)
+        except (TypeError, ValueError):
+            cleaned['department_id'] = None
+        if cleaned['department_id'] not in department_ids:
+            errors.append(f'department {department_id} does not exist')
+
+    is_admin = row.get('is_admin', False)
+    if isinstance(is_admin, str):
+        is_admin = is_admin.strip().lower() in ('1', 'true', 'yes')
+    cleaned['is_admin'] = bool(is_admin)
+
+    return cleaned, errors
+
+
+def hash_passwords(passwords):
+    """Hash a batch of passwords on COMPANYTREE_IMPORT_HASH_WORKERS threads
+    A hash costs the configured hasher's full work factor, about 0.1s with
+    Django's PBKDF2 defaults, which makes it most of the cost of an imported
+    row. The hashers release the GIL, so threads divide it by their number.
+    Rows without a password get an unusable one, which costs nothing.
+    """
+    unusable = make_password(None)
+    workers = getattr(settings, 'COMPANYTREE_IMPORT_HASH_WORKERS', min(8, os.cpu_count() or 1))
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        return list(pool.map(lambda password: make_password(password) if password else unusable, passwords))
+
+
+def _insert(batch, company_id, result):
+    """Insert one batch of cleaned rows, skipping usernames that are already taken
+    Returns:
+        dict -- username to (row number, employee id, supervisor username)
+    """
+    taken = tenancy.taken_usernames([row['username'] for _, row in batch])
+    rows = []
+    for row_number, row in batch:
+        if row['username'] in taken:
+            result.error(row_number, f'username {row["username"]} already exists')
+        else:
+            rows.append((row_number, row))
+    if not rows:
+        return {}
+
+    # Hashed before the transaction opens so it holds no locks while they are computed
+    passwords = hash_passwords([row['password'] for _, row in rows])
+    with tenancy.atomic():
+        User.objects.bulk_create(
+            User(password=password, **{name: row[name] or '' for name in USER_FIELDS})
+            for password, (_, row) in zip(passwords, rows)
+        )
+        # bulk_create does not hand back primary keys on every backend
+        user_ids = dict(User.objects.filter(username__in=[row['username'] for _, row in rows]).values_list('username', 'id'))
+
+        Employee.objects.bulk_create(
+            Employee(
+                user_id=user_ids[row['username']],
+                department_id=row['department_id'],
+                company_id=company_id,
+                is_admin=row['is_admin'],
+                **{name: row[name] for name in EMPLOYEE_FIELDS}
+            )
+            for _, row in rows
+        )
+        employee_ids = dict(Employee.objects.filter(user_id__in=user_ids.values()).values_list('user_id', 'id'))
+        counters.count_departments(company_id, [row['department_id'] for _, row in rows])
+
+        Token.objects.bulk_create(Token(key=Token().generate_key(), user_id=user_id) for user_id in user_ids.values())
+        search.index_employees(Employee.objects.filter(pk__in=employee_ids.values()))
+
+    result.created += len(rows)
+    return {
+        row['username']: (row_number, employee_ids[user_ids[row['username']]], row['supervisor_username'])
+        for row_number, row in rows
+    }
+
+
+def _link_supervisors(imported, company_id, result, batch_size):
+    """Second pass: point every imported employee at their supervisor by username"""
+    wanted = {supervisor for _, _, supervisor in imported.values() if supervisor}
+    existing = dict(
+        Employee.objects.filter(company_id=company_id, user__username__in=wanted - imported.keys())
+        .values_list('user__username', 'id')
+    )
+
+    updates = []
+    for username, (row_number, employee_id, supervisor) in imported.items():
+        if not supervisor:
+            continue
+        if supervisor in imported:
+            updates.append(Employee(id=employee_id, supervisor_id=imported[supervisor][1]))
+        elif supervisor in existing:
+            updates.append(Employee(id=employee_id, supervisor_id=existing[supervisor]))
+        else:
+            result.error(row_number, f'supervisor {supervisor} does not exist')
+
+    with tenancy.atomic():
+        Employee.objects.bulk_update(updates, ['supervisor_id'], batch_size=batch_size)
+
+        # Rebuild the company's hierarchy paths, cutting any cycle the file introduced
+        rows = list(Employee.objects.filter(company_id=company_id).values_list('id', 'supervisor_id', 'path'))
+        paths, cut = build_paths([(employee_id, supervisor_id) for employee_id, supervisor_id, _ in rows])
+        if cut:
+            changes.update(Employee.objects.filter(pk__in=cut), supervisor_id=None)
+            row_numbers = {employee_id: row_number for row_number, employee_id, _ in imported.values()}
+            for employee_id in cut:
+                result.error(row_numbers.get(employee_id), f'supervisor of employee {employee_id} formed a cycle and was removed')
+        Employee.objects.bulk_update(
+            [Employee(id=employee_id, path=paths[employee_id]) for employee_id, _, path in rows if paths[employee_id] != path],
+            ['path'],
+            batch_size=batch_size,
+        )
+        # The file can hang new employees anywhere in the trees, so recount the company's reports
+        counters.recount_company(company_id)
+
+
+def import_employees(rows, company_id, batch_size=500):
+    """Validate and insert parsed rows for a company
+    Arguments:
+        rows -- iterable of (row number, dict, error) from parse()
+        company_id -- company the employees join
+        batch_size -- rows per INSERT transaction
+    Returns:
+        ImportResult
+    """
+    result = ImportResult()
+    started = time.perf_counter()
+    department_ids = set(Department.objects.values_list('id', flat=True))
+    max_lengths = _max_lengths()
+
+    imported = {}
+    batch = []
+    seen = set()
+    for row_number, row, error in rows:
+        if error:
+            result.error(row_number, error)
+            continue
+        cleaned, errors = _clean(row, department_ids, max_lengths)
+        if cleaned['username'] in seen:
+            errors.append(f'username {cleaned["username"]} appears more than once')
+        if errors:
+            result.error(row_number, '; '.join(errors))
+            continue
+        seen.add(cleaned['username'])
+        batch.append((row_number, cleaned))
+        if len(batch) >= batch_size:
+            imported.update(_insert(batch, company_id, result))
+            batch = []
+    if batch:
+        imported.update(_insert(batch, company_id, result))
+
+    if imported:
+        _link_supervisors(imported, company_id, result, batch_size)
+        changes.update(Employee.objects.filter(pk__in=[employee_id for _, employee_id, _ in imported.values()]))
+        cache.invalidate_company(company_id)
+
+    result.seconds = time.perf_counter() - started
+    return result
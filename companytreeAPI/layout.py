@@ -0,0 +1,354 @@
+"""Precomputed org-chart layout of a company's reporting tree
+
+The layout is a Reingold-Tilford tidy tree over Employee.supervisor:
+every subtree is laid out once relative to its own top, from its left and
+right contours (the outermost x on each level below it), and a supervisor
+packs their reports' subtrees left to right as tightly as those contours
+allow and sits centred above them. Every subtree keeps its own copy of
+its contours, one entry per level, so laying out a whole company takes
+O(n * d) time and memory for n employees and a tree d levels deep, d
+being at most hierarchy.MAX_TREE_DEPTH. Sharing contours between levels,
+as the linear-time algorithm does, would save the copies but lose the
+untouched subtrees the incremental updates below reuse.
+
+Each process keeps the per-subtree results of the last companies laid
+out, tagged with the company's cache version and the change log cursor
+they were built from. When the version moves on, the employees changed
+since the cursor are read from the change log and only they, their old
+and new supervisors and the chains of supervisors above them are laid
+out again; every other subtree is reused as it is. Too many changes, or
+a pruned cursor, start over from scratch.
+
+Coordinates are in layout units, one unit between neighbouring
+employees and one level per depth, and are scaled to pixels with
+COMPANYTREE_LAYOUT_NODE_WIDTH and COMPANYTREE_LAYOUT_LEVEL_HEIGHT.
+"""
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from companytreeAPI import cache, changes
+from companytreeAPI.models import Employee
+
+# Horizontal distance between neighbouring subtrees, in units
+SEPARATION = 1
+
+
+class Subtree:
+    """Layout of one subtree relative to its top employee"""
+    __slots__ = ('offsets', 'left', 'right', 'size')
+
+    def __init__(self, offsets, left, right, size):
+        # x of every direct report relative to the top, in child order
+        self.offsets = offsets
+        # Smallest and largest relative x on each level, the top's level first
+        self.left = left
+        self.right = right
+        # Employees in the subtree, the top included
+        self.size = size
+
+
+LEAF = Subtree((), (0,), (0,), 1)
+
+
+def pack(subtrees):
+    """Place subtrees left to right as close as their contours allow
+    Returns:
+        tuple -- (x of every subtree relative to the first, left contour, right contour)
+    """
+    offsets = []
+    left = []
+    right = []
+    for subtree in subtrees:
+        shift = 0
+        if offsets:
+            shift = max(right[level] - subtree.left[level] for level in range(min(len(right), len(subtree.left))))
+            shift += SEPARATION
+        offsets.append(shift)
+        for level, (low, high) in enumerate(zip(subtree.left, subtree.right)):
+            if level < len(left):
+                # Where a later subtree reaches, it is the rightmost so far
+                right[level] = high + shift
+            else:
+                left.append(low + shift)
+                right.append(high + shift)
+    return offsets, left, right
+
+
+def lay_out(subtrees):
+    """The subtree of an employee from the subtrees of their direct reports"""
+    if not subtrees:
+        return LEAF
+    offsets, left, right = pack(subtrees)
+    centre = (offsets[0] + offsets[-1]) / 2
+    return Subtree(
+        tuple(offset - centre for offset in offsets),
+        (0, *(x - centre for x in left)),
+        (0, *(x - centre for x in right)),
+        1 + sum(subtree.size for subtree in subtrees),
+    )
+
+
+class Tree:
+    """A company's reporting tree with every subtree laid out"""
+
+    def __init__(self, edges):
+        """
+        Arguments:
+            edges -- (employee id, supervisor id) pairs of every employee of the company
+        """
+        self.parents = {}
+        self.children = {}
+        self.subtrees = {}
+        for employee_id, supervisor_id in edges:
+            self.parents[employee_id] = supervisor_id
+            self.children.setdefault(employee_id, [])
+        self._link()
+        for employee_id in reversed(self._breadth_first()):
+            self._lay_out(employee_id)
+        self.place()
+
+    def _link(self):
+        """Fill in children and roots from parents, cutting supervisor cycles like hierarchy.build_paths"""
+        for employee_id in self.children:
+            self.children[employee_id] = []
+        for employee_id, supervisor_id in sorted(self.parents.items()):
+            if supervisor_id not in self.parents:
+                self.parents[employee_id] = None
+            else:
+                self.children[supervisor_id].append(employee_id)
+
+        self.roots = [employee_id for employee_id, supervisor_id in sorted(self.parents.items()) if supervisor_id is None]
+        reached = set(self._breadth_first())
+        for employee_id in sorted(self.parents.keys() - reached):
+            if employee_id not in reached:
+                self.children[self.parents[employee_id]].remove(employee_id)
+                self.parents[employee_id] = None
+                self.roots.append(employee_id)
+                reached.update(self._breadth_first([employee_id]))
+        self.roots.sort()
+
+    def _breadth_first(self, roots=None):
+        order = list(self.roots if roots is None else roots)
+        for employee_id in order:
+            order.extend(self.children[employee_id])
+        return order
+
+    def _lay_out(self, employee_id):
+        reports = self.children[employee_id]
+        self.subtrees[employee_id] = lay_out([self.subtrees[report_id] for report_id in reports])
+
+    def depth(self, employee_id):
+        """Levels above an employee, None when their supervisors lead round in a cycle"""
+        depth = 0
+        while self.parents[employee_id] is not None:
+            employee_id = self.parents[employee_id]
+            depth += 1
+            if depth > len(self.parents):
+                return None
+        return depth
+
+    def update(self, saved, deleted):
+        """Apply changed supervisors and lay out again only the subtrees they touch
+        Arguments:
+            saved -- (employee id, supervisor id) pairs of new and changed employees
+            deleted -- ids of employees that are gone
+        Returns:
+            bool -- False when the change cannot be applied and the tree has to be rebuilt
+        """
+        dirty = set()
+        for employee_id in deleted:
+            if employee_id not in self.parents:
+                continue
+            if self.children[employee_id]:
+                # Reports left pointing at a deleted supervisor, a full rebuild sorts them out
+                return False
+            supervisor_id = self.parents.pop(employee_id)
+            del self.children[employee_id]
+            del self.subtrees[employee_id]
+            if supervisor_id is not None:
+                self.children[supervisor_id].remove(employee_id)
+                dirty.add(supervisor_id)
+            else:
+                self.roots.remove(employee_id)
+
+        for employee_id, supervisor_id in saved:
+            if employee_id not in self.parents:
+                self.parents[employee_id] = None
+                self.children[employee_id] = []
+                self.subtrees[employee_id] = LEAF
+                self.roots.append(employee_id)
+            if supervisor_id not in self.parents:
+                supervisor_id = None
+            old_supervisor_id = self.parents[employee_id]
+            if supervisor_id == old_supervisor_id:
+                continue
+            if old_supervisor_id is None:
+                self.roots.remove(employee_id)
+            else:
+                self.children[old_supervisor_id].remove(employee_id)
+                dirty.add(old_supervisor_id)
+            self.parents[employee_id] = supervisor_id
+            if supervisor_id is None:
+                self.roots.append(employee_id)
+            else:
+                self.children[supervisor_id].append(employee_id)
+                self.children[supervisor_id].sort()
+                dirty.add(supervisor_id)
+        self.roots.sort()
+
+        # Everyone above a changed subtree packs it again, deepest first
+        depths = {}
+        for employee_id in dirty:
+            while employee_id is not None and employee_id not in depths:
+                depth = self.depth(employee_id)
+                if depth is None:
+                    return False
+                depths[employee_id] = depth
+                employee_id = self.parents[employee_id]
+        for employee_id in sorted(depths, key=depths.get, reverse=True):
+            self._lay_out(employee_id)
+        self.place()
+        return True
+
+    def place(self):
+        """Place the top managers side by side, the leftmost employee at x = 0
+        Everyone else's coordinates follow from their supervisor's when read,
+        so a change only costs the subtrees laid out again.
+        """
+        offsets, left, right = pack([self.subtrees[root_id] for root_id in self.roots])
+        start = -min(left, default=0)
+        self.tops = [(root_id, offset + start, 0) for root_id, offset in zip(self.roots, offsets)]
+        self.width = max(right, default=0) + start
+        self.height = len(left)
+        self._positions = None
+
+    @property
+    def positions(self):
+        """(x, depth) of every employee"""
+        if self._positions is None:
+            positions = {}
+            pending = list(self.tops)
+            for employee_id, x, depth in pending:
+                positions[employee_id] = (x, depth)
+                for report_id, offset in zip(self.children[employee_id], self.subtrees[employee_id].offsets):
+                    pending.append((report_id, x + offset, depth + 1))
+            self._positions = positions
+        return self._positions
+
+    def window(self, x0, y0, x1, y1):
+        """Employees inside a rectangle of layout units
+        Only subtrees whose contours reach into the rectangle are walked.
+        Returns:
+            tuple -- (ids inside, dict of (x, depth) of them and every supervisor above them)
+        """
+        inside = []
+        placed = {}
+        pending = list(self.tops)
+        while pending:
+            employee_id, x, depth = pending.pop()
+            subtree = self.subtrees[employee_id]
+            first = max(depth, y0)
+            last = min(depth + len(subtree.left) - 1, y1)
+            levels = range(int(first) if first == int(first) else int(first) + 1, int(last) + 1)
+            if not any(x + subtree.left[level - depth] <= x1 and x + subtree.right[level - depth] >= x0 for level in levels):
+                continue
+            placed[employee_id] = (x, depth)
+            if y0 <= depth <= y1 and x0 <= x <= x1:
+                inside.append(employee_id)
+            for report_id, offset in zip(self.children[employee_id], subtree.offsets):
+                pending.append((report_id, x + offset, depth + 1))
+        return inside, placed
+
+    def collapsed(self, depth=None, collapse=()):
+        """The tree with everything below depth and below the collapse ids folded into their top employee
+        Returns:
+            tuple -- (Tree of the visible employees, dict of folded employee id to (hidden employees, hidden levels))
+        """
+        folded = {}
+        visible = []
+        pending = [(root_id, 0) for root_id in self.roots]
+        for employee_id, level in pending:
+            visible.append((employee_id, self.parents[employee_id]))
+            if (depth is not None and level >= depth) or employee_id in collapse:
+                if self.children[employee_id]:
+                    subtree = self.subtrees[employee_id]
+                    folded[employee_id] = (subtree.size - 1, len(subtree.left) - 1)
+            else:
+                pending.extend((report_id, level + 1) for report_id in self.children[employee_id])
+        return Tree(visible), folded
+
+
+class CompanyLayout:
+    """A company's tree with the cache version and change log cursor it was read at"""
+
+    def __init__(self, company_id):
+        self.company_id = company_id
+        self.lock = threading.Lock()
+        self.tree = None
+        self.version = None
+        self.cursor = None
+        self.views = OrderedDict()
+
+    def refresh(self):
+        """Bring the tree up to date with the company's current version"""
+        current = cache.version(cache.COMPANY_SCOPE, self.company_id)
+        if current == self.version:
+            return
+        if self.tree is None or not self._apply_changes():
+            # The cursor is read first, so nothing written while reading is skipped later
+            self.cursor = changes.cursor()
+            edges = Employee.objects.filter(company_id=self.company_id).values_list('id', 'supervisor_id')
+            self.tree = Tree(edges.iterator())
+        self.version = current
+        self.views.clear()
+
+    def _apply_changes(self):
+        limit = getattr(settings, 'COMPANYTREE_LAYOUT_INCREMENTAL_LIMIT', 1000)
+        try:
+            latest, cursor, more = changes.since(self.company_id, self.cursor, limit)
+        except changes.CursorExpired:
+            return False
+        if more:
+            return False
+        changed = latest.get(changes.EMPLOYEE, {})
+        saved = list(
+            Employee.objects.filter(company_id=self.company_id, pk__in=list(changed)).values_list('id', 'supervisor_id')
+        )
+        deleted = changed.keys() - {employee_id for employee_id, _ in saved}
+        if not self.tree.update(saved, deleted):
+            return False
+        self.cursor = cursor
+        return True
+
+    def view(self, depth=None, collapse=()):
+        """The tree as seen with some subtrees folded, cached for the current version
+        Returns:
+            tuple -- (Tree, dict of folded employee id to (hidden employees, hidden levels))
+        """
+        if depth is None and not collapse:
+            return self.tree, {}
+        key = (depth, frozenset(collapse))
+        if key not in self.views:
+            self.views[key] = self.tree.collapsed(depth, key[1])
+            if len(self.views) > getattr(settings, 'COMPANYTREE_LAYOUT_VIEWS', 8):
+                self.views.popitem(last=False)
+        self.views.move_to_end(key)
+        return self.views[key]
+
+
+_layouts = OrderedDict()
+_layouts_lock = threading.Lock()
+
+
+def company_layout(company_id):
+    """The up to date layout of a company, least recently used companies are forgotten"""
+    with _layouts_lock:
+        layout = _layouts.get(company_id)
+        if layout is None:
+            layout = _layouts[company_id] = CompanyLayout(company_id)
+            if len(_layouts) > getattr(settings, 'COMPANYTREE_LAYOUT_CACHE_SIZE', 32):
+                _layouts.popitem(last=False)
+        _layouts.move_to_end(company_id)
+    with layout.lock:
+        layout.refresh()
+    return layout
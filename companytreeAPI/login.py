@@ -0,0 +1,63 @@
+"""Per-username login rate limiting and the user to token mapping login hands out
+
+Both live in the cache, so a login attempt never writes to the database.
+Attempts are counted in fixed windows of COMPANYTREE_LOGIN_RATE_WINDOW
+seconds; with a cache shared between worker processes the limit holds
+across all of them.
+"""
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authtoken.models import Token
+
+
+def get_cache():
+    return caches[getattr(settings, 'COMPANYTREE_LOGIN_CACHE', 'default')]
+
+
+def throttle(username):
+    """Count a login attempt for username
+    Returns:
+        int -- seconds until the next attempt is allowed, 0 when this one is
+    """
+    limit = getattr(settings, 'COMPANYTREE_LOGIN_RATE_LIMIT', 10)
+    window = getattr(settings, 'COMPANYTREE_LOGIN_RATE_WINDOW', 60)
+    if not limit:
+        return 0
+
+    now = time.time()
+    # Hashed so any username makes a valid cache key
+    key = f'companytree:login:{hashlib.sha1(username.lower().encode()).hexdigest()}:{int(now // window)}'
+    login_cache = get_cache()
+    if login_cache.add(key, 1, window):
+        attempts = 1
+    else:
+        try:
+            attempts = login_cache.incr(key)
+        except ValueError:
+            # The window expired between add and incr
+            login_cache.add(key, 1, window)
+            attempts = 1
+    return 0 if attempts <= limit else int(window - now % window) + 1
+
+
+def _token_key(user_id):
+    return f'companytree:login-token:{user_id}'
+
+
+def token_for(user):
+    """The key of a user's token, from the cache when login handed it out recently"""
+    key = get_cache().get(_token_key(user.id))
+    if key is None:
+        key = Token.objects.filter(user=user).values_list('key', flat=True).get()
+        remember_token(user.id, key)
+    return key
+
+
+def remember_token(user_id, key):
+    get_cache().set(_token_key(user_id), key, getattr(settings, 'COMPANYTREE_LOGIN_TOKEN_TTL', 300))
+
+
+def forget_token(user_id):
+    get_cache().delete(_token_key(user_id))
@@ -0,0 +1,56 @@
+"""Time the analytics aggregates on a synthetic company"""
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from companytreeAPI import analytics
+from companytreeAPI.models import Employee
+from companytreeAPI.synthetic import seed_company
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Seed a company inside a rolled-back transaction and time /analytics cold and cached'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', type=int, default=50000)
+        parser.add_argument('--fan-out', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def time(self, call, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - started)
+        return min(timings) * 1000
+
+    def run(self, options):
+        self.stdout.write(f'Seeding {options["employees"]} employees...')
+        company, employee_ids = seed_company('Bench Analytics', options['employees'], options['fan_out'])
+
+        for label, call in (
+            ('headcount by department', lambda: analytics.headcount_by_department(company.id)),
+            ('headcount by location', lambda: analytics.headcount_by_location(company.id)),
+            ('reporting structure', lambda: analytics.reporting_structure(company.id)),
+            ('all aggregates', lambda: analytics.company_analytics(company.id)),
+        ):
+            self.stdout.write(f'{label:<24} {self.time(call, options["repeat"]):>8.1f}ms')
+
+        client = APIClient(HTTP_HOST='localhost')
+        top = Employee.objects.get(pk=employee_ids[0])
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.get(user_id=top.user_id).key}')
+        client.get('/analytics')
+        self.stdout.write(f'{"GET /analytics cached":<24} {self.time(lambda: client.get("/analytics"), options["repeat"]):>8.1f}ms')
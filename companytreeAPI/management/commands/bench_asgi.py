@@ -0,0 +1,91 @@
+"""Compare requests per second of the directory reads under WSGI and ASGI"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.test import Client
+from rest_framework.authtoken.models import Token
+from companytreeAPI.async_views import get_application
+from companytreeAPI.models import Employee
+from companytreeAPI.synthetic import delete_company, seed_company
+
+
+class Command(BaseCommand):
+    help = 'Seed a company and load test the hot GET endpoints in process through WSGI threads and the ASGI router'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', type=int, default=2000)
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument('--concurrency', type=int, default=16)
+
+    def handle(self, *args, **options):
+        # The ASGI handlers query from their own threads, so the data has to be committed
+        self.stdout.write(f'Seeding {options["employees"]} employees...')
+        company, employee_ids = seed_company('Bench ASGI', options['employees'])
+        try:
+            top = Employee.objects.get(pk=employee_ids[0])
+            token = Token.objects.get(user_id=top.user_id).key
+            self.run(options, token, employee_ids)
+        finally:
+            delete_company(company)
+
+    def run(self, options, token, employee_ids):
+        middle = employee_ids[len(employee_ids) // 2]
+        scenarios = (
+            ('employee', [f'/employees/{middle}']),
+            ('tree', [f'/employees/{employee_ids[0]}/tree?depth=2']),
+            ('departments', ['/departments']),
+            ('employees', ['/employees']),
+            ('bootstrap', ['/bootstrap']),
+        )
+        for label, paths in scenarios:
+            wsgi = self.wsgi(paths, token, options)
+            asgi = asyncio.run(self.asgi(paths, token, options))
+            self.stdout.write(f'{label:<12} wsgi {wsgi:>8.0f} req/s  asgi {asgi:>8.0f} req/s')
+
+    def wsgi(self, paths, token, options):
+        def call(_):
+            client = Client(HTTP_HOST='localhost', HTTP_AUTHORIZATION=f'Token {token}')
+            for path in paths:
+                response = client.get(path)
+                assert response.status_code == 200, (path, response.status_code)
+                b''.join(response) if response.streaming else response.content
+
+        # Warm the directory cache so both sides measure the same steady state
+        call(None)
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            started = time.perf_counter()
+            list(pool.map(call, range(options['requests'])))
+        return options['requests'] / (time.perf_counter() - started)
+
+    async def asgi(self, paths, token, options):
+        application = get_application()
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def call(path):
+            path, _, query = path.partition('?')
+            scope = {
+                'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+                'headers': [(b'host', b'localhost'), (b'authorization', f'Token {token}'.encode())],
+                'scheme': 'http', 'server': ('localhost', 80), 'client': ('127.0.0.1', 0),
+            }
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            async with semaphore:
+                await application(scope, receive, send)
+            assert messages[0]['status'] == 200, (path, messages[0]['status'])
+
+        async def client():
+            for path in paths:
+                await call(path)
+
+        await client()
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(options['requests'])))
+        return options['requests'] / (time.perf_counter() - started)
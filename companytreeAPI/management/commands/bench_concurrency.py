@@ -0,0 +1,94 @@
+"""Measure read and write throughput of the configured database under concurrent load"""
+import random
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, connections, transaction
+from django.test.utils import override_settings
+from companytreeAPI import db, hierarchy
+from companytreeAPI.models import Employee
+from companytreeAPI.synthetic import delete_company, seed_company
+from companytreeAPI.views.employee import employee_rows
+
+# SQLite's own defaults: rollback journal, full sync, and no separate read connection
+BASELINE = {
+    'COMPANYTREE_SQLITE_PRAGMAS': {'journal_mode': 'delete', 'synchronous': 'full'},
+    'COMPANYTREE_READ_DATABASES': {},
+}
+
+
+class Command(BaseCommand):
+    help = 'Seed a company and run reader and writer threads against the configured database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', type=int, default=10000)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument(
+            '--compare', action='store_true',
+            help='On SQLite, run once with the default journal and no read alias, then with the configured tuning',
+        )
+
+    def handle(self, *args, **options):
+        # Every thread opens its own connection, so the data has to be committed
+        self.stdout.write(f'Seeding {options["employees"]} employees on {connection.vendor}...')
+        company, employee_ids = seed_company('Bench Concurrency', options['employees'])
+        try:
+            if options['compare'] and connection.vendor == 'sqlite':
+                with override_settings(**BASELINE):
+                    self.run(options, company, employee_ids, 'baseline')
+            self.run(options, company, employee_ids, 'tuned' if connection.vendor == 'sqlite' else connection.vendor)
+        finally:
+            delete_company(company)
+
+    def run(self, options, company, employee_ids, label):
+        # New connections pick up the PRAGMAs of this run
+        connections.close_all()
+        connection.ensure_connection()
+        deadline = time.monotonic() + options['seconds']
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        lock = threading.Lock()
+
+        def read():
+            # A page of the directory and a small reporting tree, like the client's hot paths
+            with db.reading():
+                rows, to_rows = employee_rows(Employee.objects.filter(company=company, id__gt=random.choice(employee_ids)))
+                list(to_rows(rows[:100]))
+                hierarchy.subtree_rows(random.choice(employee_ids), company.id, 2)
+
+        def write():
+            with transaction.atomic():
+                Employee.objects.filter(pk=random.choice(employee_ids)).update(position=f'Position {random.random():.6f}')
+
+        def worker(operation, counter):
+            done = errors = 0
+            try:
+                while time.monotonic() < deadline:
+                    try:
+                        operation()
+                        done += 1
+                    except DatabaseError:
+                # "database is locked" once a lock wait runs out
+                        errors += 1
+            finally:
+                connection.close()
+            with lock:
+                counts[counter] += done
+                counts['errors'] += errors
+
+        threads = (
+            [threading.Thread(target=worker, args=(read, 'reads')) for _ in range(options['readers'])]
+            + [threading.Thread(target=worker, args=(write, 'writes')) for _ in range(options['writers'])]
+        )
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.monotonic() - started
+
+        self.stdout.write(
+            f'{label}: {counts["reads"] / seconds:.0f} reads/s, {counts["writes"] / seconds:.0f} writes/s, '
+            f'{counts["errors"]} errors with {options["readers"]} readers and {options["writers"]} writers'
+        )
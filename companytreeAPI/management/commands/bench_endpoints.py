@@ -0,0 +1,189 @@
+"""Time every API endpoint at several company sizes, with JSON results for regression comparison"""
+import json
+import platform
+import statistics
+import time
+from contextlib import ExitStack
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from companytreeAPI import cache
+from companytreeAPI.models import Department, Employee
+from companytreeAPI.synthetic import delete_company, seed_company, seed_departments
+
+PASSWORD = 'bench-password'
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[round(fraction * (len(ordered) - 1))]
+
+
+class Command(BaseCommand):
+    help = 'Seed companies of several sizes and time every endpoint against each of them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='100,1000,10000', help='Comma separated employee counts')
+        parser.add_argument('--repeat', type=int, default=10, help='Timed requests per endpoint and scale')
+        parser.add_argument('--warm', action='store_true', help='Keep the directory cache between requests')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare medians against')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Slowdown over the baseline reported as a regression')
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(scale) for scale in options['scales'].split(',')]
+        except ValueError:
+            raise CommandError('--scales must be a comma separated list of integers')
+
+        results = []
+        for scale in scales:
+            self.stdout.write(f'Seeding {scale} employees...')
+            department_ids = seed_departments(f'Bench Endpoints {scale}', 10)
+            company, employee_ids = seed_company(
+                f'Bench Endpoints {scale}', scale, department_ids=department_ids, hobbies=2, password=PASSWORD,
+            )
+            try:
+                for result in self.run(scale, company, employee_ids, department_ids, options):
+                    results.append(result)
+                    self.stdout.write(
+                        f'{scale:>8} {result["endpoint"]:<24} median {result["median_ms"]:8.2f} ms  '
+                        f'p95 {result["p95_ms"]:8.2f} ms  {result["queries"]:3} queries  {result["bytes"]:>9} bytes'
+                    )
+            finally:
+                delete_company(company)
+                Department.objects.filter(pk__in=department_ids).delete()
+
+        report = {
+            'environment': {
+                'vendor': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'warm_cache': options['warm'],
+                'repeat': options['repeat'],
+                'finished': timezone.now().isoformat(),
+            },
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def cases(self, company, employee_ids, department_ids, top):
+        """(endpoint, method, path, body factory) for every request timed"""
+        middle = employee_ids[len(employee_ids) // 2]
+        leaf = Employee.objects.get(pk=employee_ids[-1])
+        update = {
+            'department_id': leaf.department_id, 'supervisor_id': leaf.supervisor_id, 'position': leaf.position,
+            'location': leaf.location, 'bio': 'Benchmarked', 'image_url': None, 'tasks': None, 'phone': None,
+            'slack': None, 'is_admin': False,
+        }
+        registered = iter(range(10 ** 9))
+
+        def register():
+            username = f'bench_register_{company.id}_{next(registered)}'
+            return {
+                'username': username, 'email': f'{username}@example.com', 'password': PASSWORD,
+                'first_name': 'Bench', 'last_name': 'Register', 'department_id': department_ids[0],
+                'supervisor_id': top.id, 'position': 'Engineer', 'location': 'Remote', 'bio': None,
+                'image_url': None, 'tasks': None, 'phone': None, 'slack': None,
+                'company_id': company.id, 'is_admin': False,
+            }
+
+        offset = max(len(employee_ids) // 2 - 50, 0)
+        return (
+            ('Employees.list', 'get', '/employees', None),
+            ('Employees.list offset', 'get', f'/employees?limit=50&offset={offset}', None),
+            ('Employees.list cursor', 'get', '/employees?pagination=cursor&page_size=50', None),
+            ('Employees.retrieve', 'get', f'/employees/{middle}', None),
+            ('Employees.tree', 'get', f'/employees/{top.id}/tree?depth=2', None),
+            ('Layout.list', 'get', '/layout', None),
+            ('Layout.list viewport', 'get', '/layout?x0=0&y0=0&x1=1920&y1=1080', None),
+            ('Hobbies.employees', 'get', '/hobbies/employees?hobby=chess&fields=id', None),
+            ('Hobbies.colleagues', 'get', f'/hobbies/colleagues?employee={middle}', None),
+            ('Employees.update', 'put', f'/employees/{leaf.id}', lambda: update),
+            ('Companies.list', 'get', '/companies', None),
+            ('Companies.retrieve', 'get', f'/companies/{company.id}', None),
+            ('Departments.list', 'get', '/departments', None),
+            ('Departments.retrieve', 'get', f'/departments/{department_ids[0]}', None),
+            ('login', 'post', '/login', lambda: {'username': top.user.username, 'password': PASSWORD}),
+            ('register', 'post', '/register', register),
+        )
+
+    def run(self, scale, company, employee_ids, department_ids, options):
+        top = Employee.objects.select_related('user').get(pk=employee_ids[0])
+        client = Client(HTTP_HOST='localhost', HTTP_AUTHORIZATION=f'Token {Token.objects.get(user=top.user).key}')
+
+        for endpoint, method, path, body in self.cases(company, employee_ids, department_ids, top):
+            def request():
+                if body is None:
+                    response = getattr(client, method)(path)
+                else:
+                    response = getattr(client, method)(path, json.dumps(body()), content_type='application/json')
+                content = b''.join(response.streaming_content) if response.streaming else response.content
+                if response.status_code >= 400:
+                    raise CommandError(f'{method.upper()} {path} answered {response.status_code}: {content[:200]}')
+                return content
+
+            request()
+            timings = []
+            for _ in range(options['repeat']):
+                if not options['warm']:
+                    cache.get_cache().clear()
+                queries = QueryCounter()
+                # Reads of the list and retrieve actions go to the read alias
+                with ExitStack() as stack:
+                    for alias in connections:
+                        stack.enter_context(connections[alias].execute_wrapper(queries))
+                    started = time.perf_counter()
+                    content = request()
+                    timings.append((time.perf_counter() - started) * 1000)
+
+            yield {
+                'scale': scale,
+                'endpoint': endpoint,
+                'method': method.upper(),
+                'path': path,
+                'runs': len(timings),
+                'min_ms': min(timings),
+                'median_ms': statistics.median(timings),
+                'p95_ms': percentile(timings, 0.95),
+                'mean_ms': statistics.mean(timings),
+                'queries': queries.count,
+                'bytes': len(content),
+            }
+
+    def compare(self, results, path, tolerance):
+        with open(path) as baseline_file:
+            baseline = {(row['scale'], row['endpoint']): row for row in json.load(baseline_file)['results']}
+
+        regressions = []
+        for result in results:
+            before = baseline.get((result['scale'], result['endpoint']))
+            if before is None:
+                continue
+            change = result['median_ms'] / before['median_ms'] - 1 if before['median_ms'] else 0
+            line = (f'{result["scale"]:>8} {result["endpoint"]:<24} {before["median_ms"]:8.2f} -> '
+                    f'{result["median_ms"]:8.2f} ms ({change:+.0%}), queries {before["queries"]} -> {result["queries"]}')
+            if change > tolerance or result['queries'] > before['queries']:
+                regressions.append(line)
+            self.stdout.write(line)
+
+        if regressions:
+            raise CommandError(f'{len(regressions)} regressions against {path}:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS(f'No regressions against {path}'))
@@ -0,0 +1,49 @@
+"""Measure export throughput and memory on a synthetic company"""
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from companytreeAPI import exporter
+from companytreeAPI.synthetic import seed_company
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Seed a company inside a rolled-back transaction and time every export format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', type=int, default=1000000)
+        parser.add_argument('--fan-out', type=int, default=8)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, options):
+        self.stdout.write(f'Seeding {options["employees"]} employees...')
+        company, _ = seed_company('Bench Export', options['employees'], options['fan_out'])
+
+        for file_format in exporter.FORMATS:
+            for compress in (False, True):
+                started = time.perf_counter()
+                written = sum(len(chunk) for chunk in exporter.export(company.id, file_format, compress))
+                seconds = time.perf_counter() - started
+
+                # A second, traced pass: allocation tracing would skew the timing above
+                tracemalloc.start()
+                for _ in exporter.export(company.id, file_format, compress):
+                    pass
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                self.stdout.write(
+                    f'{file_format:<5} gzip={compress!s:<5} {options["employees"] / seconds:>9.0f} rows/s '
+                    f'{written / seconds / 1024 / 1024:>6.1f} MB/s peak allocated {peak / 1024 / 1024:.1f} MB'
+                )
@@ -0,0 +1,94 @@
+"""Measure login throughput of each password hasher across several worker processes"""
+import json
+import multiprocessing
+import random
+import time
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import override_settings
+from companytreeAPI.models import Employee
+from companytreeAPI.synthetic import delete_company, seed_company
+
+PASSWORD = 'bench-password'
+
+
+def preferring(name):
+    """PASSWORD_HASHERS reordered so new passwords are hashed with the named hasher"""
+    preferred = settings.COMPANYTREE_PASSWORD_HASHERS[name]
+    return [preferred] + [path for path in settings.PASSWORD_HASHERS if path != preferred]
+
+
+def log_in(usernames, deadline):
+    """Worker process: log in as random users until the deadline
+    Returns:
+        tuple -- (successful logins, failed logins)
+    """
+    client = Client(HTTP_HOST='localhost')
+    done = failed = 0
+    try:
+        while time.monotonic() < deadline:
+            body = json.dumps({'username': random.choice(usernames), 'password': PASSWORD})
+            response = client.post('/login', body, content_type='application/json')
+            if response.status_code == 200 and json.loads(response.content)['valid']:
+                done += 1
+            else:
+                failed += 1
+    finally:
+        connection.close()
+    return done, failed
+
+
+class Command(BaseCommand):
+    help = 'Seed users and log them in from several processes with each password hasher in turn'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--hashers', default=','.join(settings.COMPANYTREE_PASSWORD_HASHERS), help='Comma separated hasher names')
+
+    def handle(self, *args, **options):
+        names = options['hashers'].split(',')
+        unknown = set(names) - set(settings.COMPANYTREE_PASSWORD_HASHERS)
+        if unknown:
+            raise CommandError(f'Unknown hashers {", ".join(sorted(unknown))}, choose from {", ".join(settings.COMPANYTREE_PASSWORD_HASHERS)}')
+
+        self.stdout.write(f'Seeding {options["users"]} users...')
+        company, employee_ids = seed_company('Bench Login', options['users'])
+        try:
+            user_ids = list(Employee.objects.filter(pk__in=employee_ids).values_list('user_id', flat=True))
+            usernames = list(User.objects.filter(pk__in=user_ids).values_list('username', flat=True))
+            for name in names:
+                # Counting attempts would throttle the benchmark itself
+                with override_settings(PASSWORD_HASHERS=preferring(name), COMPANYTREE_LOGIN_RATE_LIMIT=0):
+                    hasher = get_hasher()
+                    try:
+                        if hasher.library:
+                            hasher._load_library()
+                    except ValueError as error:
+                        self.stdout.write(self.style.WARNING(f'{name}: skipped, {error}'))
+                        continue
+                    User.objects.filter(pk__in=user_ids).update(password=make_password(PASSWORD))
+                    self.run(name, usernames, options)
+        finally:
+            delete_company(company)
+
+    def run(self, name, usernames, options):
+        # Forked workers must not share the parent's connections
+        connections.close_all()
+        deadline = time.monotonic() + options['seconds']
+        started = time.monotonic()
+        with multiprocessing.get_context('fork').Pool(options['workers']) as pool:
+            results = pool.starmap(log_in, [(usernames, deadline)] * options['workers'])
+        seconds = time.monotonic() - started
+
+        done = sum(result[0] for result in results)
+        failed = sum(result[1] for result in results)
+        self.stdout.write(
+            f'{name}: {done / seconds:.0f} logins/s, {options["workers"] * seconds / max(done, 1) * 1000:.1f} ms '
+            f'per login and worker, {failed} failed with {options["workers"]} workers'
+        )
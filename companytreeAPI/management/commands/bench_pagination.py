@@ -0,0 +1,82 @@
+"""Benchmark keyset pagination against limit/offset pagination on a large table"""
+import base64
+import json
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from companytreeAPI.models import Company
+from companytreeAPI.pagination import model_ordering
+from companytreeAPI.views import Companies
+from companytreeAPI.views.company import CompanySerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Time page 1 against a deep page of /companies with keyset and limit/offset pagination'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--page', type=int, default=10000)
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def time(self, call, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - started)
+        return min(timings) * 1000
+
+    def run(self, options):
+        rows, page_size = options['rows'], options['page_size']
+        deep_offset = min((options['page'] - 1) * page_size, rows - page_size)
+
+        self.stdout.write(f'Inserting {rows} companies...')
+        Company.objects.bulk_create(
+            Company(name=f'Company {random.getrandbits(40):010x}') for _ in range(rows)
+        )
+
+        factory = APIRequestFactory()
+        view = Companies.as_view({'get': 'list'})
+        ordering = model_ordering(Company)
+
+        def keyset(offset):
+            params = {'pagination': 'cursor', 'page_size': page_size}
+            if offset:
+                position = list(Company.objects.order_by(*ordering).values_list(*ordering)[offset - 1])
+                params['cursor'] = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+            return lambda: view(factory.get('/companies', params, HTTP_HOST='localhost')).render()
+
+        def limit_offset(offset):
+            def call():
+                request = Request(factory.get('/companies', {'limit': page_size, 'offset': offset}, HTTP_HOST='localhost'))
+                paginator = LimitOffsetPagination()
+                page = paginator.paginate_queryset(Company.objects.all(), request)
+                paginator.get_paginated_response(
+                    CompanySerializer(page, many=True, context={'request': request}).data
+                )
+            return call
+
+        for label, build in (('keyset', keyset), ('limit/offset', limit_offset)):
+            first = self.time(build(0), options['repeat'])
+            deep = self.time(build(deep_offset), options['repeat'])
+            self.stdout.write(
+                f'{label:<13} rows={rows} page 1={first:.2f}ms '
+                f'page {deep_offset // page_size + 1}={deep:.2f}ms'
+            )
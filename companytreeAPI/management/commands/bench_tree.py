@@ -0,0 +1,74 @@
+"""Benchmark the recursive org-chart query against a per-node traversal"""
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from companytreeAPI import hierarchy
+from companytreeAPI.models import Employee
+from companytreeAPI.synthetic import seed_company
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def naive_tree(employee_id, company_id):
+    """Walk the tree the way the client does, one lookup per employee"""
+    root = None
+    pending = [(employee_id, None)]
+    while pending:
+        current_id, parent = pending.pop()
+        employee = Employee.objects.select_related('user').get(pk=current_id, company_id=company_id)
+        node = {'id': employee.id, 'first_name': employee.user.first_name, 'reports': []}
+        if parent is None:
+            root = node
+        else:
+            parent['reports'].append(node)
+        for report_id in Employee.objects.filter(supervisor_id=current_id).values_list('id', flat=True):
+            pending.append((report_id, node))
+    return root
+
+
+class Command(BaseCommand):
+    help = 'Compare GET /employees/{id}/tree against walking the tree one employee at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', type=int, default=5000)
+        parser.add_argument('--fan-out', type=int, default=5)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, options):
+        company, employee_ids = seed_company('Bench Tree', options['employees'], options['fan_out'])
+        root_id = employee_ids[0]
+
+        for label, build in (
+            ('recursive CTE', lambda: hierarchy.nest_reports(hierarchy.subtree_rows(root_id, company.id))),
+            ('naive traversal', lambda: naive_tree(root_id, company.id)),
+        ):
+            timings = []
+            for _ in range(options['repeat']):
+                queries = QueryCounter()
+                with connection.execute_wrapper(queries):
+                    started = time.perf_counter()
+                    build()
+                    timings.append(time.perf_counter() - started)
+            self.stdout.write(
+                f'{label:<16} employees={len(employee_ids)} queries={queries.count} '
+                f'best={min(timings) * 1000:.1f}ms'
+            )
@@ -0,0 +1,45 @@
+"""Export a company's employees as JSON lines or CSV"""
+import resource
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from companytreeAPI import exporter, tenancy
+from companytreeAPI.models import Company
+
+
+class Command(BaseCommand):
+    help = "Stream a company's employees with their user, department and supervisor to a file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, required=True)
+        parser.add_argument('--format', choices=exporter.FORMATS, default=exporter.JSONL)
+        parser.add_argument('--gzip', action='store_true', help='Compress the output on the fly')
+        parser.add_argument('--output', help='File to write, standard output when omitted')
+        parser.add_argument('--chunk-size', type=int, default=exporter.EXPORT_CHUNK_ROWS)
+
+    def handle(self, *args, **options):
+        with tenancy.for_company(options['company']):
+            self.export(options)
+
+    def export(self, options):
+        if not Company.objects.filter(pk=options['company']).exists():
+            raise CommandError(f'Company {options["company"]} does not exist')
+
+        started = time.perf_counter()
+        written = 0
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in exporter.export(options['company'], options['format'], options['gzip'], options['chunk_size']):
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if options['output']:
+                output.close()
+
+        seconds = time.perf_counter() - started
+        total = Company.objects.get(pk=options['company']).employee_set.count()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+        self.stderr.write(
+            f'Exported {total} employees ({written} bytes) in {seconds:.1f}s, '
+            f'{total / seconds if seconds else 0:.0f} rows/s, peak memory {peak} MB'
+        )
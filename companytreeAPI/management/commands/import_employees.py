@@ -0,0 +1,35 @@
+"""Import employees into a company from a CSV or JSON lines file"""
+from django.core.management.base import BaseCommand, CommandError
+from companytreeAPI import importer, tenancy
+from companytreeAPI.models import Company
+
+
+class Command(BaseCommand):
+    help = 'Bulk import employees from CSV (with a header row) or JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--company', type=int, required=True, help='Company id the employees join')
+        parser.add_argument('--format', choices=importer.FORMATS, help='Guessed from the file extension when omitted')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with tenancy.for_company(options['company']):
+            self.import_employees(options)
+
+    def import_employees(self, options):
+        if not Company.objects.filter(pk=options['company']).exists():
+            raise CommandError(f'Company {options["company"]} does not exist')
+
+        file_format = options['format'] or (importer.CSV if options['path'].endswith('.csv') else importer.JSONL)
+        with open(options['path'], 'rb') as stream:
+            result = importer.import_employees(
+                importer.parse(stream, file_format), options['company'], options['batch_size']
+            )
+
+        for error in result.errors:
+            self.stderr.write(f'row {error["row"]}: {error["message"]}')
+        self.stdout.write(
+            f'Imported {result.created} employees with {len(result.errors)} errors '
+            f'in {result.seconds:.1f}s ({result.rows_per_second or 0:.0f} rows/s)'
+        )
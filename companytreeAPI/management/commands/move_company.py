@@ -0,0 +1,246 @@
+"""Move a company to another database while it keeps serving requests"""
+import time
+from contextlib import contextmanager
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from rest_framework.authtoken.models import Token
+from companytreeAPI import cache, changes, counters, search, tenancy
+from companytreeAPI.models import Change, Company, DepartmentCount, Employee, EmployeeHobby
+from companytreeAPI.synthetic import insert_rows
+
+
+def _chunks(ids, size=500):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+@contextmanager
+def snapshot(alias):
+    """Read a database as of one moment inside the block, while others keep writing"""
+    with transaction.atomic(using=alias):
+        if connections[alias].vendor == 'postgresql':
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        yield
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy a company to another database, catch up with the changes made meanwhile, '
+        'hold its writes back for the last ones, switch it over and delete the old copy'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('company', type=int)
+        parser.add_argument('database', help='One of COMPANYTREE_SHARDS')
+        parser.add_argument('--rounds', type=int, default=5, help='Most catch-up rounds before writes are held back')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT')
+
+    def handle(self, *args, **options):
+        company_id, target = options['company'], options['database']
+        if target not in tenancy.databases():
+            raise CommandError(f'{target} is not one of COMPANYTREE_SHARDS: {", ".join(tenancy.databases())}')
+        source = tenancy.database_for(company_id)
+        if source == target:
+            raise CommandError(f'Company {company_id} is already in {target}')
+        if not Company.objects.using(source).filter(pk=company_id).exists():
+            raise CommandError(f'Company {company_id} does not exist')
+        self.batch_size = options['batch_size']
+        self.check_ids(company_id, source, target)
+
+        started = time.perf_counter()
+        tenancy.replicate_departments(target)
+        frozen = False
+        try:
+            # The copy and the cursor it continues from are read from the same snapshot
+            with snapshot(source), transaction.atomic(using=target):
+                cursor = self.cursor(source)
+                copied = self.copy(source, target, *self.rows(company_id, source), company_id)
+            self.stdout.write(f'Copied {copied} rows of company {company_id} from {source} to {target}')
+
+            for number in range(options['rounds']):
+                with snapshot(source), transaction.atomic(using=target):
+                    cursor, changed = self.catch_up(company_id, source, target, cursor)
+                self.stdout.write(f'Catch-up round {number + 1}: {changed} changed rows')
+                if changed < self.batch_size:
+                    break
+
+            # Every process sees the freeze within the registry's time to live
+            tenancy.register(company_id, source, frozen=True)
+            frozen = True
+            held = time.perf_counter()
+            time.sleep(tenancy.tenant_cache.ttl + 1)
+
+            with snapshot(source), transaction.atomic(using=target):
+                cursor, changed = self.catch_up(company_id, source, target, cursor)
+                # Subtree moves rewrite paths and logouts delete tokens without a change log entry
+                self.sync_paths(company_id, source, target)
+                self.sync_tokens(company_id, source, target)
+                # The department counts are not copied, they are counted again from the copied employees
+                with tenancy.using(target):
+                    counters.recount_departments(company_id)
+                # The company's log continues above every cursor its clients got from the old database
+                floor = self.cursor(source)
+                tenancy.advance_sequence(target, Change, floor)
+                changes.record(Company, [(company_id, company_id)], using=target)
+            self.index(company_id, target)
+            tenancy.register(company_id, target, frozen=False, cursor_floor=floor)
+            frozen = False
+        except BaseException:
+            self.stderr.write(f'Moving company {company_id} failed, it stays in {source}')
+            self.delete(company_id, target)
+            if frozen:
+                tenancy.register(company_id, source, frozen=False)
+            raise
+
+        cache.invalidate_company(company_id)
+        self.stdout.write(
+            f'Company {company_id} is in {target}, writes were held back for {time.perf_counter() - held:.1f}s'
+        )
+
+        # Processes that looked the company up before the switch read the old copy until they look again
+        time.sleep(tenancy.tenant_cache.ttl + 1)
+        cache.invalidate_company(company_id)
+        self.delete(company_id, source)
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved company {company_id} from {source} to {target} in {time.perf_counter() - started:.1f}s'
+        ))
+
+    def cursor(self, alias):
+        with tenancy.using(alias):
+            return changes.cursor()
+
+    def rows(self, company_id, alias):
+        """The ids of every row of a company in a database
+        Returns:
+            tuple -- (user ids, employee ids, hobby ids)
+        """
+        employees = list(Employee.objects.using(alias).filter(company_id=company_id).values_list('id', 'user_id'))
+        hobby_ids = EmployeeHobby.objects.using(alias).filter(employee__company_id=company_id).values_list('id', flat=True)
+        return [user_id for _, user_id in employees], [employee_id for employee_id, _ in employees], list(hobby_ids)
+
+    def check_ids(self, company_id, source, target):
+        """Refuse a move whose ids the target database already has or could hand out again"""
+        user_ids, employee_ids, hobby_ids = self.rows(company_id, source)
+        _, end = tenancy.id_range(target)
+        for model, ids in ((User, user_ids), (Company, [company_id]), (Employee, employee_ids), (EmployeeHobby, hobby_ids)):
+            for chunk in _chunks(ids):
+                if model.objects.using(target).filter(pk__in=chunk).exists():
+                    raise CommandError(f'{target} already has {model.__name__} rows with the ids of company {company_id}')
+            if connections[target].vendor == 'sqlite' and end is not None and ids and max(ids) >= end:
+                # SQLite would carry on handing out ids after the largest one copied, in another database's range
+                raise CommandError(f'Company {company_id} has {model.__name__} ids above the range of {target}')
+
+    def copy_rows(self, model, queryset, target):
+        """Insert the rows of a queryset in another database as they are, without signals
+        Returns:
+            int -- number of rows copied
+        """
+        fields = [field for field in model._meta.concrete_fields if not (field.primary_key and model._meta.auto_created)]
+        connection = connections[target]
+        rows = [
+            tuple(field.get_db_prep_save(value, connection) for field, value in zip(fields, row))
+            for row in queryset.values_list(*[field.attname for field in fields])
+        ]
+        with tenancy.using(target):
+            insert_rows(model, [field.attname for field in fields], rows, self.batch_size)
+        return len(rows)
+
+    def copy(self, source, target, user_ids, employee_ids, hobby_ids, company_id=None):
+        """Copy rows by id, with the users' group and permission links and tokens
+        Returns:
+            int -- number of rows copied
+        """
+        copied = 0
+        if company_id is not None:
+            copied += self.copy_rows(Company, Company.objects.using(source).filter(pk=company_id), target)
+        for chunk in _chunks(user_ids):
+            copied += self.copy_rows(User, User.objects.using(source).filter(pk__in=chunk), target)
+            copied += self.copy_rows(Token, Token.objects.using(source).filter(user_id__in=chunk), target)
+            for through in (User.groups.through, User.user_permissions.through):
+                copied += self.copy_rows(through, through.objects.using(source).filter(user_id__in=chunk), target)
+        for chunk in _chunks(employee_ids):
+            copied += self.copy_rows(Employee, Employee.objects.using(source).filter(pk__in=chunk), target)
+        for chunk in _chunks(hobby_ids):
+            copied += self.copy_rows(EmployeeHobby, EmployeeHobby.objects.using(source).filter(pk__in=chunk), target)
+        return copied
+
+    def delete_rows(self, alias, user_ids, employee_ids, hobby_ids, company_id=None):
+        """Delete rows by id with the users' links and tokens, without signals"""
+        tenancy.delete_rows(alias, EmployeeHobby, hobby_ids)
+        tenancy.delete_rows(alias, Employee, employee_ids)
+        for chunk in _chunks(user_ids):
+            tenancy.delete_rows(alias, Token, Token.objects.using(alias).filter(user_id__in=chunk).values_list('key', flat=True))
+            for through in (User.groups.through, User.user_permissions.through):
+                tenancy.delete_rows(alias, through, through.objects.using(alias).filter(user_id__in=chunk).values_list('id', flat=True))
+        tenancy.delete_rows(alias, User, user_ids)
+        if company_id is not None:
+            counts = DepartmentCount.objects.using(alias).filter(company_id=company_id)
+            tenancy.delete_rows(alias, DepartmentCount, counts.values_list('id', flat=True))
+            tenancy.delete_rows(alias, Company, [company_id])
+
+    def catch_up(self, company_id, source, target, cursor):
+        """Copy again the rows changed in the source database since a cursor
+        Run it in a snapshot of the source and a transaction of the target.
+        Returns:
+            tuple -- (cursor of the last change applied, number of changed rows)
+        """
+        latest = {}
+        with tenancy.using(source):
+            more = True
+            while more:
+                try:
+                    page, cursor, more = changes.since(company_id, cursor, self.batch_size)
+                except changes.CursorExpired:
+                    raise CommandError('The change log was pruned during the move, start it again')
+                for kind, rows in page.items():
+                    latest.setdefault(kind, {}).update(rows)
+
+        employee_ids = set(latest.get(changes.EMPLOYEE, {}))
+        hobby_ids = set(latest.get(changes.HOBBY, {}))
+        user_ids = set()
+        # The target's copies of the changed employees go with their users, tokens and hobbies
+        for alias in (source, target):
+            for chunk in _chunks(employee_ids):
+                hobby_ids.update(EmployeeHobby.objects.using(alias).filter(employee_id__in=chunk).values_list('id', flat=True))
+                user_ids.update(Employee.objects.using(alias).filter(pk__in=chunk).values_list('user_id', flat=True))
+        company = changes.COMPANY in latest
+        self.delete_rows(target, user_ids, employee_ids, hobby_ids, company_id if company else None)
+
+        # and are copied again from the source when they are still there
+        self.copy(source, target, user_ids, employee_ids, hobby_ids, company_id if company else None)
+        return cursor, len(employee_ids) + len(hobby_ids) + company
+
+    def sync_paths(self, company_id, source, target):
+        paths = dict(Employee.objects.using(source).filter(company_id=company_id).values_list('id', 'path'))
+        stale = [
+            (paths[employee_id], employee_id)
+            for employee_id, path in Employee.objects.using(target).filter(company_id=company_id).values_list('id', 'path')
+            if paths.get(employee_id, path) != path
+        ]
+        connection = connections[target]
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'UPDATE {quote(Employee._meta.db_table)} SET {quote("path")} = %s WHERE {quote("id")} = %s', stale
+            )
+
+    def sync_tokens(self, company_id, source, target):
+        user_ids, _, _ = self.rows(company_id, target)
+        for chunk in _chunks(user_ids):
+            tenancy.delete_rows(target, Token, Token.objects.using(target).filter(user_id__in=chunk).values_list('key', flat=True))
+            self.copy_rows(Token, Token.objects.using(source).filter(user_id__in=chunk), target)
+
+    def index(self, company_id, alias):
+        search.index_employees(Employee.objects.using(alias).filter(company_id=company_id), alias)
+        search.index_company(Company.objects.using(alias).get(pk=company_id), alias)
+
+    def delete(self, company_id, alias):
+        """Delete every row of a company in a database, its change log and search documents"""
+        with transaction.atomic(using=alias):
+            user_ids, employee_ids, hobby_ids = self.rows(company_id, alias)
+            self.delete_rows(alias, user_ids, employee_ids, hobby_ids, company_id)
+            Change.objects.using(alias).filter(company_id=company_id).delete()
+            search.remove_company(company_id, alias)
@@ -0,0 +1,17 @@
+"""Delete old entries of the change log"""
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from companytreeAPI import changes
+
+
+class Command(BaseCommand):
+    help = 'Delete the change log entries older than some days, clients with older cursors fetch the directory again'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'COMPANYTREE_CHANGE_LOG_DAYS', 30))
+
+    def handle(self, *args, **options):
+        deleted = changes.prune(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write(self.style.SUCCESS(f'{deleted} changes older than {options["days"]} days deleted'))
@@ -0,0 +1,42 @@
+"""Recompute the materialized hierarchy paths of every employee"""
+from django.core.management.base import BaseCommand
+from companytreeAPI import changes, tenancy
+from companytreeAPI.hierarchy import build_paths
+from companytreeAPI.models import Company, Employee
+
+
+class Command(BaseCommand):
+    help = 'Rebuild Employee.path for one or all companies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, help='Only rebuild this company id')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        for alias in tenancy.databases():
+            with tenancy.using(alias):
+                self.rebuild(options)
+
+    def rebuild(self, options):
+        companies = Company.objects.all()
+        if options['company']:
+            companies = companies.filter(pk=options['company'])
+
+        # A company being moved is only rebuilt in the database it is registered in
+        for company_id in tenancy.owned(companies.values_list('id', flat=True)):
+            with tenancy.atomic():
+                rows = list(Employee.objects.filter(company_id=company_id).values_list('id', 'supervisor_id', 'path'))
+                paths, cut = build_paths([(employee_id, supervisor_id) for employee_id, supervisor_id, _ in rows])
+
+                if cut:
+                    self.stderr.write(f'Company {company_id}: supervisor cycle broken at employees {cut}')
+                    changes.update(Employee.objects.filter(pk__in=cut), supervisor_id=None)
+
+                changed = [
+                    Employee(id=employee_id, path=paths[employee_id])
+                    for employee_id, _, path in rows
+                    if paths[employee_id] != path
+                ]
+                Employee.objects.bulk_update(changed, ['path'], batch_size=options['batch_size'])
+
+            self.stdout.write(f'Company {company_id}: {len(changed)} of {len(rows)} paths rebuilt')
@@ -0,0 +1,23 @@
+"""Rebuild the full-text search index from scratch"""
+import time
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+from companytreeAPI import search
+
+
+class Command(BaseCommand):
+    help = 'Drop and rebuild the full-text search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if not search.uses_fts(options['database']):
+            self.stdout.write('This database searches through the ORM, there is no index to rebuild')
+            return
+
+        started = time.perf_counter()
+        with transaction.atomic(using=options['database']):
+            total = search.rebuild(options['database'], options['batch_size'])
+        self.stdout.write(f'Indexed {total} documents in {time.perf_counter() - started:.1f}s')
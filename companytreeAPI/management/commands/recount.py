@@ -0,0 +1,31 @@
+"""Verify and repair the maintained department and report counters"""
+from django.core.management.base import BaseCommand, CommandError
+from companytreeAPI import counters, tenancy
+from companytreeAPI.models import Company
+
+
+class Command(BaseCommand):
+    help = 'Recompute employee counts per department and report counts per employee, repairing any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, help='Only recount the employees of this company')
+        parser.add_argument('--check', action='store_true', help='Report drift without repairing it, failing if any is found')
+
+    def handle(self, *args, **options):
+        repair = not options['check']
+
+        drift = []
+        for alias in tenancy.databases():
+            with tenancy.using(alias), tenancy.atomic():
+                companies = Company.objects.values_list('id', flat=True)
+                if options['company']:
+                    companies = companies.filter(pk=options['company'])
+                # A company being moved is only counted in the database it is registered in
+                for company_id in tenancy.owned(companies):
+                    drift += counters.recount_company(company_id, repair)
+
+        for model, object_id, field, stored, actual in drift:
+            self.stdout.write(f'{model} {object_id} {field}: stored {stored}, actual {actual}')
+        if drift and not repair:
+            raise CommandError(f'{len(drift)} counters have drifted')
+        self.stdout.write(self.style.SUCCESS(f'{len(drift)} counters repaired' if drift else 'All counters are correct'))
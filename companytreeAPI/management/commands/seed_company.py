@@ -0,0 +1,65 @@
+"""Generate realistic synthetic companies for development and benchmarking"""
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from companytreeAPI import search, tenancy
+from companytreeAPI.models import Employee
+from companytreeAPI.synthetic import fan_out_for_depth, seed_company, seed_departments
+
+
+class Command(BaseCommand):
+    help = 'Bulk insert companies with departments, a balanced reporting tree and hobbies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', default='Example Co', help='Company name, numbered when seeding several')
+        parser.add_argument('--companies', type=int, default=1)
+        parser.add_argument('--employees', type=int, default=1000, help='Employees per company')
+        parser.add_argument('--departments', type=int, default=10, help='Departments per company')
+        parser.add_argument('--fan-out', type=int, default=5, help='Direct reports per supervisor')
+        parser.add_argument('--depth', type=int, help='Levels below the top manager, overrides --fan-out')
+        parser.add_argument('--hobbies', type=int, default=2, help='Average hobbies per employee')
+        parser.add_argument('--password', help='Password of every seeded user, unusable when omitted')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed, the same seed gives the same data')
+        parser.add_argument('--batch-size', type=int, help='Rows per executemany call')
+        parser.add_argument('--skip-search-index', action='store_true', help='Leave the search index for later')
+
+    def handle(self, *args, **options):
+        employees = options['employees']
+        if employees < 1:
+            raise CommandError('--employees must be at least 1')
+        fan_out = options['fan_out']
+        if options['depth'] is not None:
+            if options['depth'] < 1 and employees > 1:
+                raise CommandError('--depth must be at least 1')
+            fan_out = fan_out_for_depth(employees, options['depth'])
+        if fan_out < 1:
+            raise CommandError('--fan-out must be at least 1')
+
+        for number in range(options['companies']):
+            name = options['name'] if options['companies'] == 1 else f'{options["name"]} {number + 1}'
+            started = time.perf_counter()
+            database = tenancy.place_company()
+            with transaction.atomic():
+                department_ids = seed_departments(name, options['departments'])
+            # bulk_create skips the signals copying new departments to the other databases
+            for alias in tenancy.databases():
+                tenancy.replicate_departments(alias)
+            with tenancy.using(database), tenancy.atomic():
+                company, _ = seed_company(
+                    name, employees, fan_out,
+                    batch_size=options['batch_size'],
+                    department_ids=department_ids,
+                    hobbies=options['hobbies'],
+                    password=options['password'],
+                    seed=options['seed'] + number,
+                )
+            tenancy.register(company.id, database)
+            seeded = time.perf_counter() - started
+
+            if not options['skip_search_index']:
+                search.index_employees(Employee.objects.using(database).filter(company=company), database)
+            self.stdout.write(self.style.SUCCESS(
+                f'Company {company.id} "{name}" in {database}: {employees} employees with fan-out {fan_out} '
+                f'in {len(department_ids)} departments, seeded in {seeded:.1f}s, '
+                f'{time.perf_counter() - started:.1f}s with the search index'
+            ))
@@ -0,0 +1,243 @@
+"""Per-request query count and latency instrumentation
+
+MetricsMiddleware is opt-in with COMPANYTREE_METRICS. For every request it
+records, per view and action, the number of SQL queries, the time spent in
+the database, the time spent rendering the response body and the size of
+that body. Each response carries the numbers in a Server-Timing header,
+and the totals of this process are served in the Prometheus text format
+by the /metrics view.
+
+A request that runs the same SQL statement COMPANYTREE_METRICS_N_PLUS_ONE
+times or more, which is what a query per row of a list looks like, is
+logged as a warning.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class EndpointMetrics:
+    """Everything recorded for one view and action"""
+
+    def __init__(self):
+        self.requests = Counter()
+        self.duration = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.response_bytes = 0
+
+
+class Registry:
+    """Metrics of this process, keyed by (view, action)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+
+    def record(self, measurement):
+        with self._lock:
+            endpoint = self.endpoints.setdefault((measurement.view, measurement.action), EndpointMetrics())
+            endpoint.requests[measurement.status] += 1
+            endpoint.duration.observe(measurement.duration)
+            endpoint.queries.observe(measurement.query_count)
+            endpoint.db_seconds += measurement.db_seconds
+            endpoint.render_seconds += measurement.render_seconds
+            endpoint.response_bytes += measurement.response_bytes
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format"""
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = []
+
+            def family(name, kind, help_text):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+            def histogram(name, labels, values):
+                for bound, count in zip(values.buckets, values.counts):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {values.count}')
+                lines.append(f'{name}_sum{{{labels}}} {values.sum}')
+                lines.append(f'{name}_count{{{labels}}} {values.count}')
+
+            family('companytree_requests_total', 'counter', 'Requests by view, action and status code')
+            for (view, action), endpoint in endpoints:
+                for status, count in sorted(endpoint.requests.items()):
+                    lines.append(f'companytree_requests_total{{{_labels(view, action)},status="{status}"}} {count}')
+
+            family('companytree_request_duration_seconds', 'histogram', 'Time to answer a request, body included')
+            for (view, action), endpoint in endpoints:
+                histogram('companytree_request_duration_seconds', _labels(view, action), endpoint.duration)
+
+            family('companytree_request_queries', 'histogram', 'SQL queries run per request')
+            for (view, action), endpoint in endpoints:
+                histogram('companytree_request_queries', _labels(view, action), endpoint.queries)
+
+            for name, attribute, help_text in (
+                ('companytree_request_db_seconds_total', 'db_seconds', 'Time spent running SQL queries'),
+                ('companytree_request_render_seconds_total', 'render_seconds', 'Time spent rendering response bodies'),
+                ('companytree_response_bytes_total', 'response_bytes', 'Size of the response bodies'),
+            ):
+                family(name, 'counter', help_text)
+                for (view, action), endpoint in endpoints:
+                    lines.append(f'{name}{{{_labels(view, action)}}} {getattr(endpoint, attribute)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(view, action):
+    return f'view="{view}",action="{action}"'
+
+
+registry = Registry()
+
+
+class Measurement:
+    """What one request cost, filled in while it is served"""
+
+    def __init__(self, request):
+        self.started = time.perf_counter()
+        self.view = 'unresolved'
+        self.action = request.method.lower()
+        self.status = None
+        self.query_count = 0
+        self.statements = Counter()
+        self.streaming = False
+        self.db_seconds = 0.0
+        self.render_started = None
+        self.render_seconds = 0.0
+        self.response_bytes = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        """connection.execute_wrapper hook timing every query"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - started
+            self.query_count += 1
+            # Streamed lists read their rows a chunk per query by design
+            if not self.streaming:
+                self.statements[sql] += 1
+
+    def watch_queries(self):
+        """Context manager timing the queries of every database alias"""
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self))
+        return stack
+
+    def rendered(self, response):
+        """Post-render callback of a template response"""
+        self.render_seconds += time.perf_counter() - self.render_started
+
+    def server_timing(self):
+        return ', '.join((
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.query_count} queries"',
+            f'render;dur={self.render_seconds * 1000:.1f}',
+            f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}',
+        ))
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+        registry.record(self)
+
+        threshold = getattr(settings, 'COMPANYTREE_METRICS_N_PLUS_ONE', 5)
+        repeated = [(count, sql) for sql, count in self.statements.items() if count >= threshold]
+        for count, sql in repeated:
+            logger.warning(
+                'Possible N+1 queries: %s.%s ran the same statement %d times: %s',
+                self.view, self.action, count, sql,
+            )
+
+
+def _stream(measurement, chunks):
+    # A streamed body runs its queries and encoding after the middleware has returned
+    chunks = iter(chunks)
+    try:
+        while True:
+            started = time.perf_counter()
+            db_seconds = measurement.db_seconds
+            with measurement.watch_queries():
+                chunk = next(chunks, None)
+            measurement.render_seconds += time.perf_counter() - started - (measurement.db_seconds - db_seconds)
+            if chunk is None:
+                return
+            measurement.response_bytes += len(chunk)
+            yield chunk
+    finally:
+        measurement.finish()
+
+
+class MetricsMiddleware:
+    """Measure every request and add a Server-Timing header"""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'COMPANYTREE_METRICS', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        measurement = request.companytree_metrics = Measurement(request)
+        with measurement.watch_queries():
+            response = self.get_response(request)
+        measurement.status = response.status_code
+        response['Server-Timing'] = measurement.server_timing()
+
+        if response.streaming:
+            measurement.streaming = True
+            response.streaming_content = _stream(measurement, response.streaming_content)
+        else:
+            measurement.response_bytes = len(response.content)
+            measurement.finish()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # ViewSets are named after their class and map the method to an action
+        measurement = request.companytree_metrics
+        measurement.view = view_func.__name__
+        actions = getattr(view_func, 'actions', None)
+        if actions:
+            measurement.action = actions.get(request.method.lower(), measurement.action)
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook
+        measurement = request.companytree_metrics
+        measurement.render_started = time.perf_counter()
+        response.add_post_render_callback(measurement.rendered)
+        return response
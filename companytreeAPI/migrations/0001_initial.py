@@ -0,0 +1,77 @@
+# Generated by Django 3.0.4 on 2026-10-18 18:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Company',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+            ],
+            options={
+                'verbose_name': 'company',
+                'verbose_name_plural': 'companies',
+                'ordering': ('name',),
+            },
+        ),
+        migrations.CreateModel(
+            name='Department',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('colorHex', models.CharField(max_length=50)),
+            ],
+            options={
+                'verbose_name': 'department',
+                'verbose_name_plural': 'departments',
+                'ordering': ('name',),
+            },
+        ),
+        migrations.CreateModel(
+            name='Employee',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.CharField(max_length=50)),
+                ('location', models.CharField(max_length=50)),
+                ('bio', models.TextField(max_length=500, null=True)),
+                ('image_url', models.URLField(max_length=1000, null=True)),
+                ('tasks', models.CharField(max_length=500, null=True)),
+                ('phone', models.CharField(max_length=30, null=True)),
+                ('slack', models.CharField(max_length=30, null=True)),
+                ('is_admin', models.BooleanField()),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='companytreeAPI.Company')),
+                ('department', models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='companytreeAPI.Department')),
+                ('supervisor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='companytreeAPI.Employee')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': (django.db.models.expressions.OrderBy(django.db.models.expressions.F('id'), nulls_last=True),),
+            },
+        ),
+        migrations.CreateModel(
+            name='EmployeeHobby',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hobby', models.CharField(max_length=50)),
+                ('employee', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='hobbies', to='companytreeAPI.Employee')),
+            ],
+            options={
+                'verbose_name': 'hobby',
+                'verbose_name_plural': 'hobbies',
+                'ordering': ('employee',),
+            },
+        ),
+    ]
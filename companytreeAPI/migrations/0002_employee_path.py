@@ -0,0 +1,32 @@
+# Generated by Django 3.0.4 on 2026-10-18 18:09
+
+from django.db import migrations, models
+from companytreeAPI.hierarchy import build_paths
+
+
+def fill_paths(apps, schema_editor):
+    """Compute the path of every existing employee, cutting supervisor cycles like manage.py rebuild_hierarchy"""
+    Employee = apps.get_model('companytreeAPI', 'Employee')
+    employees = Employee.objects.using(schema_editor.connection.alias)
+    for company_id in employees.order_by().values_list('company_id', flat=True).distinct():
+        paths, cut = build_paths(employees.filter(company_id=company_id).values_list('id', 'supervisor_id'))
+        employees.filter(pk__in=cut).update(supervisor_id=None)
+        employees.bulk_update(
+            [Employee(id=employee_id, path=path) for employee_id, path in paths.items()], ['path'], batch_size=500
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companytreeAPI', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='employee',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=1000),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.4 on 2026-10-18 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companytreeAPI', '0002_employee_path'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='company',
+            index=models.Index(fields=['name', 'id'], name='companytree_name_9b5ac3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='department',
+            index=models.Index(fields=['name', 'id'], name='companytree_name_7d885e_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.0.4 on 2026-10-18 18:09
+
+from collections import Counter
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_counters(apps, schema_editor):
+    """Count the employees of every department and the reports of every employee"""
+    Department = apps.get_model('companytreeAPI', 'Department')
+    Employee = apps.get_model('companytreeAPI', 'Employee')
+    alias = schema_editor.connection.alias
+    employees = Employee.objects.using(alias)
+
+    departments = employees.exclude(department_id=None).values_list('department_id').annotate(Count('id')).order_by()
+    Department.objects.using(alias).bulk_update(
+        [Department(id=department_id, employee_count=count) for department_id, count in departments],
+        ['employee_count'], batch_size=500,
+    )
+
+    # Every employee is one report of each supervisor on their path
+    direct, total = Counter(), Counter()
+    for supervisor_id, path in employees.values_list('supervisor_id', 'path').iterator():
+        direct[supervisor_id] += 1
+        total.update(int(part) for part in path.strip('/').split('/')[:-1])
+    employees.bulk_update(
+        [Employee(id=employee_id, direct_report_count=direct[employee_id], total_report_count=total[employee_id])
+         for employee_id in direct.keys() | total.keys() if employee_id is not None],
+        ['direct_report_count', 'total_report_count'], batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companytreeAPI', '0003_name_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='department',
+            name='employee_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='employee',
+            name='direct_report_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='employee',
+            name='total_report_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
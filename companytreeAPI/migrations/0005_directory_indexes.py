@@ -0,0 +1,29 @@
+# Generated by Django 3.0.4 on 2026-10-18 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companytreeAPI', '0004_counters'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='employee',
+            options={'ordering': ('id',)},
+        ),
+        migrations.AddIndex(
+            model_name='employee',
+            index=models.Index(fields=['company', 'department'], name='companytree_company_68b550_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='employee',
+            index=models.Index(fields=['company', 'supervisor'], name='companytree_company_815fa5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='employeehobby',
+            index=models.Index(fields=['hobby', 'employee'], name='companytree_hobby_2a7452_idx'),
+        ),
+    ]
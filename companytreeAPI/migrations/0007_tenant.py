@@ -0,0 +1,26 @@
+# Generated by Django 3.0.4 on 2026-10-18 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companytreeAPI', '0006_change_log'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tenant',
+            fields=[
+                ('company_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('database', models.CharField(max_length=100)),
+                ('frozen', models.BooleanField(default=False)),
+                ('cursor_floor', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'tenant',
+                'verbose_name_plural': 'tenants',
+            },
+        ),
+    ]
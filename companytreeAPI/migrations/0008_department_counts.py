@@ -0,0 +1,50 @@
+# Generated by Django 3.0.4 on 2026-10-18 18:15
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def fill_counts(apps, schema_editor):
+    """Count the employees of every company in every department"""
+    DepartmentCount = apps.get_model('companytreeAPI', 'DepartmentCount')
+    Employee = apps.get_model('companytreeAPI', 'Employee')
+    alias = schema_editor.connection.alias
+    counts = (
+        Employee.objects.using(alias).exclude(department_id=None)
+        .values_list('company_id', 'department_id').annotate(Count('id')).order_by()
+    )
+    DepartmentCount.objects.using(alias).bulk_create(
+        [DepartmentCount(company_id=company_id, department_id=department_id, employee_count=count)
+         for company_id, department_id, count in counts],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companytreeAPI', '0007_tenant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DepartmentCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('employee_count', models.IntegerField(default=0)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='companytreeAPI.Company')),
+                ('department', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='companytreeAPI.Department')),
+            ],
+            options={
+                'verbose_name': 'department count',
+                'verbose_name_plural': 'department counts',
+                'unique_together': {('company', 'department')},
+            },
+        ),
+        migrations.RunPython(fill_counts, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='department',
+            name='employee_count',
+        ),
+    ]
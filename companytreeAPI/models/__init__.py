@@ -1,4 +1,7 @@
 from .department import Department
+from .department_count import DepartmentCount
 from .employee_hobby import EmployeeHobby
 from .employee import Employee
-from .company import Company
\ No newline at end of file
+from .company import Company
+from .change import Change
+from .tenant import Tenant
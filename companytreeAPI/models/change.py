@@ -0,0 +1,19 @@
+from django.db import models
+
+class Change(models.Model):
+    '''Change Model, one row appended per save or delete of a directory row'''
+    # Departments are shared by every company and are logged without one.
+    # No constraint, so the tombstones outlive a deleted company.
+    company = models.ForeignKey('Company', on_delete=models.DO_NOTHING, null=True, db_constraint=False, related_name='+')
+    kind = models.CharField(max_length=20)
+    object_id = models.IntegerField()
+    deleted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+
+        ordering = ("id", )
+        # The feed reads a company's changes after a cursor
+        indexes = [models.Index(fields=["company", "id"])]
+        verbose_name = ("change")
+        verbose_name_plural = ("changes")
@@ -3,9 +3,12 @@ from django.db import models
 class Company(models.Model):
     '''Company Model'''
     name = models.CharField(max_length=50)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
 
         ordering = ("name", )
+        # Serves the ordering and the keyset pagination that pages through it
+        indexes = [models.Index(fields=["name", "id"])]
         verbose_name = ("company")
         verbose_name_plural = ("companies")
\ No newline at end of file
@@ -4,9 +4,12 @@ class Department(models.Model):
     '''Department Model'''
     name = models.CharField(max_length=50)
     colorHex = models.CharField(max_length=50)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
 
         ordering = ("name", )
+        # Serves the ordering and the keyset pagination that pages through it
+        indexes = [models.Index(fields=["name", "id"])]
         verbose_name = ("department")
         verbose_name_plural = ("departments")
\ No newline at end of file
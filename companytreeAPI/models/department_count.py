@@ -0,0 +1,16 @@
+from django.db import models
+
+class DepartmentCount(models.Model):
+    '''DepartmentCount Model, the employees of one company in a department'''
+    company = models.ForeignKey('Company', on_delete=models.CASCADE, related_name='+')
+    # Departments are shared by every company. No constraint, so a department
+    # can go without touching the counts of companies that never used it.
+    department = models.ForeignKey('Department', on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    # Maintained by companytreeAPI.hierarchy, repaired by manage.py recount.
+    employee_count = models.IntegerField(default=0)
+
+    class Meta:
+
+        unique_together = (("company", "department"), )
+        verbose_name = ("department count")
+        verbose_name_plural = ("department counts")
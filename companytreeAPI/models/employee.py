@@ -2,7 +2,6 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.db.models.expressions import F
 
 class Employee(models.Model):
     '''Employee Model'''
@@ -18,12 +17,27 @@ class Employee(models.Model):
     slack = models.CharField(max_length=30, null=True)
     company = models.ForeignKey('Company', on_delete=models.CASCADE)
     is_admin = models.BooleanField()
+    # Materialized path of supervisor ids from the top of the tree down to
+    # this employee, e.g. "/1/7/42/". Maintained by companytreeAPI.hierarchy.
+    path = models.CharField(max_length=1000, db_index=True, default='', blank=True)
+    # Reports directly below this employee and at every level below them.
+    # Maintained by companytreeAPI.hierarchy, repaired by manage.py recount.
+    direct_report_count = models.IntegerField(default=0)
+    total_report_count = models.IntegerField(default=0)
+    # Bulk updates bypass auto_now, they go through companytreeAPI.changes.update
+    updated_at = models.DateTimeField(auto_now=True)
 
     # def __str__(self):
     #     return f'{self.first_name} {self.last_name}'
 
     class Meta:
-        ordering = (F('id').asc(nulls_last=True),)
-        #Instances of F() act as a reference to a model field within a query. These references can then be used in query filters to compare the values of two different fields on the same model instance.
-        
-        #In this case, order by the date the user joined (by ascending) and null fields last.
\ No newline at end of file
+        # id is never null, and a plain ascending id lets SQLite return the
+        # company's employees in index order instead of sorting them
+        ordering = ("id", )
+        # Every directory query is scoped to a company. These serve the
+        # headcount per department and the walks down the reporting tree
+        # (roots are supervisor_id IS NULL, children are supervisor_id = id).
+        indexes = [
+            models.Index(fields=["company", "department"]),
+            models.Index(fields=["company", "supervisor"]),
+        ]
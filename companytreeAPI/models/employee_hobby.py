@@ -4,9 +4,12 @@ class EmployeeHobby(models.Model):
     '''EmployeeHobby Model'''
     hobby = models.CharField(max_length=50)
     employee = models.ForeignKey('Employee', on_delete=models.DO_NOTHING, related_name="hobbies")
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
 
         ordering = ("employee", )
+        # Finds the employees sharing a hobby without reading the whole table
+        indexes = [models.Index(fields=["hobby", "employee"])]
         verbose_name = ("hobby")
         verbose_name_plural = ("hobbies")
\ No newline at end of file
@@ -0,0 +1,16 @@
+from django.db import models
+
+class Tenant(models.Model):
+    '''Tenant Model, the database a company lives in when several are configured'''
+    # Not a foreign key, the company row is in the tenant's own database
+    company_id = models.IntegerField(primary_key=True)
+    database = models.CharField(max_length=100)
+    # Set while manage.py move_company copies the last changes, writes are refused meanwhile
+    frozen = models.BooleanField(default=False)
+    # Change log cursors below this one were handed out by the previous database
+    cursor_floor = models.BigIntegerField(default=0)
+
+    class Meta:
+
+        verbose_name = ("tenant")
+        verbose_name_plural = ("tenants")
@@ -0,0 +1,161 @@
+"""Pagination classes for the ViewSets"""
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from django.db.models import F, Q
+from django.db.models.expressions import OrderBy
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Paginate by remembering the last row seen instead of counting an offset
+    Every page is a "WHERE (ordering) > (last row) ORDER BY ordering LIMIT n"
+    query, so page 10,000 costs the same as page one. The ordering must end
+    in a unique field and every field is sorted ascending.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def __init__(self, ordering):
+        self.ordering = tuple(ordering)
+        self.page_size = api_settings.PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None, keep=None):
+        """Read one page of queryset
+        Arguments:
+            keep -- optional function taking a list of rows and returning the
+                    ones to show, the page reads on to make up for the others
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        page = list(queryset[:self.page_size + 1])
+        if keep is not None:
+            page = self.refill(queryset, page, keep)
+        self.has_next = len(page) > self.page_size
+        page = page[:self.page_size]
+        self.next_position = self.position(page[-1]) if self.has_next else None
+        return page
+
+    def refill(self, queryset, rows, keep):
+        """Keep the rows keep() accepts, reading after the last row until page_size + 1 are left or none are"""
+        page = []
+        while True:
+            wanted = self.page_size + 1 - len(page)
+            page += keep(rows)
+            if len(page) > self.page_size or len(rows) < wanted:
+                return page
+            rows = list(queryset.filter(self.after(self.position(rows[-1])))[:self.page_size + 1 - len(page)])
+
+    def merge_pages(self, pages):
+        """Merge the pages paginate_queryset() returned for the same request in several databases
+        Arguments:
+            pages -- (page, has_next) of every database
+        Returns:
+            list -- the first page_size rows of all of them, in ordering order
+        """
+        rows = sorted((row for page, _ in pages for row in page), key=self.position)
+        self.has_next = len(rows) > self.page_size or any(has_next for _, has_next in pages)
+        page = rows[:self.page_size]
+        self.next_position = self.position(page[-1]) if self.has_next else None
+        return page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def after(self, position):
+        """Build the filter selecting rows that sort after position
+        The leading ">=" on the first field lets the database answer with a
+        range scan on the ordering index instead of evaluating the OR per row.
+        """
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, position):
+            condition |= equal & Q(**{f'{field}__gt': value})
+            equal &= Q(**{field: value})
+        return Q(**{f'{self.ordering[0]}__gte': position[0]}) & condition
+
+    def position(self, row):
+        if isinstance(row, dict):
+            return [row[field] for field in self.ordering]
+        return [getattr(row, field) for field in self.ordering]
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound('Invalid cursor')
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound('Invalid cursor')
+        return position
+
+    def encode_cursor(self, position):
+        encoded = base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+
+def model_ordering(model):
+    """Fields of a model's Meta.ordering with the primary key appended as a tie-breaker"""
+    fields = []
+    for entry in model._meta.ordering:
+        if isinstance(entry, OrderBy):
+            entry = entry.expression
+        if isinstance(entry, F):
+            entry = entry.name
+        fields.append(entry)
+    if 'id' not in fields:
+        fields.append('id')
+    return tuple(fields)
+
+
+def wants_keyset(request):
+    """Check whether a list request opted in to keyset pagination"""
+    params = request.query_params
+    return KeysetPagination.cursor_query_param in params or params.get('pagination') == 'cursor'
+
+
+def paginator_for(request, ordering):
+    """Pick the paginator a list request asked for
+    Arguments:
+        request -- the DRF request
+        ordering -- fields the keyset paginator sorts by
+    Returns:
+        KeysetPagination when the request has a "cursor" parameter or
+        pagination=cursor, LimitOffsetPagination when it has "limit" or
+        "offset", otherwise None for an unpaginated list
+    """
+    if wants_keyset(request):
+        return KeysetPagination(ordering)
+    params = request.query_params
+    if 'limit' in params or 'offset' in params:
+        return LimitOffsetPagination()
+    return None
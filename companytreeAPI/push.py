@@ -0,0 +1,217 @@
+"""Per-company change events pushed to connected clients
+
+Every change logged by companytreeAPI.changes is published once its
+transaction commits. The backend carries it to the broker of every
+process: LocalBackend hands it straight to this process, which is all a
+single worker and the tests need, and RedisBackend relays it through a
+Redis pub/sub channel when several workers serve clients. The broker fans
+the event out to the subscriptions of its company, or of every company
+of the database it was logged in for the shared departments. Every event
+carries the change-log cursor of the changes it reports, so a client that
+applied it can resume GET /changes from there.
+
+Publishing never waits for a client. Each subscription queues at most
+COMPANYTREE_PUSH_QUEUE_SIZE events; when a client falls that far behind,
+its queued events are swapped for a single resync event, after which it
+catches up from GET /changes with its last cursor.
+
+Clients connect to /events of the ASGI application, see async_views.
+"""
+import asyncio
+import json
+import logging
+import threading
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+CHANGES = 'changes'
+RESYNC = 'resync'
+HEARTBEAT = 'heartbeat'
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class Subscription:
+    """Events of one company waiting to be sent to one client"""
+
+    def __init__(self, company_id, size, database=None):
+        self.company_id = company_id
+        self.database = database
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(size)
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, event):
+        """Queue an event, or a resync in place of everything queued when the client is too far behind"""
+        if self.queue.full():
+            self.dropped += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = {'type': RESYNC}
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        """The next event, or None when none came within timeout seconds"""
+        if not self.queue.empty():
+            return self.queue.get_nowait()
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def _put_all(subscriptions, event):
+    for subscription in subscriptions:
+        subscription.put(event)
+
+
+class Broker:
+    """Subscriptions of this process by company"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, company_id, database=None):
+        """Subscribe the running event loop to a company's events
+        Arguments:
+            database -- alias of the company's database, None to take the shared events of every one
+        """
+        subscription = Subscription(company_id, getattr(settings, 'COMPANYTREE_PUSH_QUEUE_SIZE', 100), database)
+        with self._lock:
+            self._subscriptions.setdefault(company_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.closed = True
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.company_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.company_id, None)
+
+    def count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def deliver(self, company_id, event, database=None):
+        """Queue an event for the subscribers of a company, every company of database when None
+        Safe to call from any thread: subscriptions are only touched on their own event loop.
+        """
+        with self._lock:
+            if company_id is None:
+                targets = [
+                    subscription for subscriptions in self._subscriptions.values() for subscription in subscriptions
+                    if database is None or subscription.database in (None, database)
+                ]
+            else:
+                targets = list(self._subscriptions.get(company_id, ()))
+
+        by_loop = {}
+        for subscription in targets:
+            by_loop.setdefault(subscription.loop, []).append(subscription)
+        current = _running_loop()
+        for loop, subscriptions in by_loop.items():
+            if loop is current:
+                _put_all(subscriptions, event)
+            elif not loop.is_closed():
+                loop.call_soon_threadsafe(_put_all, subscriptions, event)
+
+
+class LocalBackend:
+    """Delivers events to the broker of this process only"""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, company_id, event, database=None):
+        self.broker.deliver(company_id, event, database)
+
+    def listen(self):
+        pass
+
+
+class RedisBackend:
+    """Relays events between processes over a Redis pub/sub channel, needs the redis package
+    COMPANYTREE_PUSH_REDIS_URL locates the server.
+    """
+
+    def __init__(self, broker):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('RedisBackend needs the redis package')
+        self.broker = broker
+        self.client = redis.Redis.from_url(getattr(settings, 'COMPANYTREE_PUSH_REDIS_URL', 'redis://localhost:6379/0'))
+        self.channel = getattr(settings, 'COMPANYTREE_PUSH_CHANNEL', 'companytree:events')
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def publish(self, company_id, event, database=None):
+        self.client.publish(self.channel, json.dumps({'company_id': company_id, 'event': event, 'database': database}))
+
+    def listen(self):
+        """Start relaying the channel to this process' broker, once"""
+        with self._lock:
+            if self._listener is None:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.channel: self._relay})
+                self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _relay(self, message):
+        data = json.loads(message['data'])
+        self.broker.deliver(data['company_id'], data['event'], data.get('database'))
+
+
+_broker = Broker()
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_broker():
+    return _broker
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            path = getattr(settings, 'COMPANYTREE_PUSH_BACKEND', 'companytreeAPI.push.LocalBackend')
+            _backend = import_string(path)(_broker)
+    return _backend
+
+
+def _send(company_id, event, database=None):
+    try:
+        get_backend().publish(company_id, event, database)
+    except Exception:
+        # The change is committed and in the log, clients still get it from /changes
+        logger.exception('Could not publish changes of company %s', company_id)
+
+
+def publish(company_id, changed, using=None, cursor=None, database=None):
+    """Publish changed rows of a company, None for every company, once the transaction commits
+    Arguments:
+        changed -- list of {"kind", "id", "deleted"} dicts
+        using -- database of the transaction to wait for
+        cursor -- change-log cursor of the newest of the changes
+        database -- with company_id None, the database whose companies get the event, None for all
+    """
+    if len(changed) > getattr(settings, 'COMPANYTREE_PUSH_MAX_CHANGES', 100):
+        # A bulk change is cheaper to fetch from /changes than to push row by row
+        event = {'type': RESYNC}
+    else:
+        event = {'type': CHANGES, 'changes': changed}
+    if cursor is not None:
+        event['cursor'] = cursor
+    transaction.on_commit(lambda: _send(company_id, event, database), using=using)
@@ -0,0 +1,245 @@
+"""Full-text search over employees, departments and companies
+
+On SQLite the searchable text lives in an FTS5 virtual table that the
+signal handlers in companytreeAPI.signals keep in sync. Every row's rowid
+packs the object id with its kind, so replacing a document is a primary
+key lookup. Other databases fall back to case-insensitive ORM filters.
+
+Every database of companytreeAPI.tenancy has its own index of the
+companies and employees it holds and of the shared departments. Searches
+go to the database of the current company unless told otherwise.
+"""
+import re
+from django.db import connections, router, DEFAULT_DB_ALIAS
+from django.db.models import Q
+from companytreeAPI.models import Company, Department, Employee, EmployeeHobby
+
+INDEX_TABLE = 'companytreeAPI_search'
+
+EMPLOYEE = 'employee'
+DEPARTMENT = 'department'
+COMPANY = 'company'
+KINDS = {EMPLOYEE: 1, DEPARTMENT: 2, COMPANY: 3}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+
+# Relevance weights of the company_id, title and body columns for bm25()
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+
+# Default number of results a search returns
+SEARCH_LIMIT = 50
+
+
+def _rowid(kind, object_id):
+    return object_id * 4 + KINDS[kind]
+
+
+def uses_fts(using=DEFAULT_DB_ALIAS):
+    return connections[using].vendor == 'sqlite'
+
+
+def ensure_index(using=DEFAULT_DB_ALIAS):
+    """Create the FTS5 table if it does not exist yet"""
+    if not uses_fts(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS "{INDEX_TABLE}" USING fts5('
+            'company_id UNINDEXED, title, body, '
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+
+
+def employee_document(employee, hobbies=None):
+    """Build the (company_id, title, body) document for an employee"""
+    if hobbies is None:
+        hobbies = employee.hobbies.values_list('hobby', flat=True)
+    user = employee.user
+    body = [employee.position, employee.location, employee.bio, employee.tasks, *hobbies]
+    return (
+        employee.company_id,
+        f'{user.first_name} {user.last_name}',
+        ' '.join(part for part in body if part),
+    )
+
+
+def _write(kind, rows, using=DEFAULT_DB_ALIAS, replace=True, chunk_size=1000):
+    """Replace the documents of rows, an iterable of (object_id, company_id, title, body)"""
+    if not uses_fts(using):
+        return
+    chunk = []
+    for object_id, company_id, title, body in rows:
+        chunk.append((_rowid(kind, object_id), company_id, title, body))
+        if len(chunk) == chunk_size:
+            _write_chunk(chunk, using, replace)
+            chunk = []
+    if chunk:
+        _write_chunk(chunk, using, replace)
+
+
+def _write_chunk(rows, using, replace):
+    with connections[using].cursor() as cursor:
+        if replace:
+            cursor.executemany(f'DELETE FROM "{INDEX_TABLE}" WHERE rowid = %s', [(row[0],) for row in rows])
+        cursor.executemany(
+            f'INSERT INTO "{INDEX_TABLE}" (rowid, company_id, title, body) VALUES (%s, %s, %s, %s)', rows
+        )
+
+
+def remove(kind, object_id, using=DEFAULT_DB_ALIAS):
+    if not uses_fts(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM "{INDEX_TABLE}" WHERE rowid = %s', [_rowid(kind, object_id)])
+
+
+def remove_company(company_id, using=DEFAULT_DB_ALIAS):
+    """Drop the documents of a company and of all its employees"""
+    if not uses_fts(using):
+        return
+    remove(COMPANY, company_id, using)
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM "{INDEX_TABLE}" WHERE company_id = %s', [company_id])
+
+
+def _employee_documents(employees, using, batch_size):
+    """Yield (id, company_id, title, body) for an Employee queryset, a batch at a time"""
+    columns = ('id', 'company_id', 'user__first_name', 'user__last_name', 'position', 'location', 'bio', 'tasks')
+    employees = employees.using(using).order_by('id').values_list(*columns)
+    last_id = 0
+    while True:
+        batch = list(employees.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        hobbies = {}
+        for employee_id, hobby in EmployeeHobby.objects.using(using).filter(
+            employee_id__gte=batch[0][0], employee_id__lte=batch[-1][0]
+        ).values_list('employee_id', 'hobby'):
+            hobbies.setdefault(employee_id, []).append(hobby)
+
+        for employee_id, company_id, first_name, last_name, *body in batch:
+            body += hobbies.get(employee_id, ())
+            yield employee_id, company_id, f'{first_name} {last_name}', ' '.join(part for part in body if part)
+        last_id = batch[-1][0]
+
+
+def index_employees(employees, using=DEFAULT_DB_ALIAS, replace=True, batch_size=2000):
+    """Index every employee of a queryset, reading them in batches"""
+    _write(EMPLOYEE, _employee_documents(employees, using, batch_size), using, replace)
+
+
+def index_employee(employee, using=DEFAULT_DB_ALIAS):
+    _write(EMPLOYEE, [(employee.id, *employee_document(employee))], using)
+
+
+def index_department(department, using=DEFAULT_DB_ALIAS):
+    _write(DEPARTMENT, [(department.id, None, department.name, '')], using)
+
+
+def index_company(company, using=DEFAULT_DB_ALIAS):
+    _write(COMPANY, [(company.id, None, company.name, '')], using)
+
+
+def rebuild(using=DEFAULT_DB_ALIAS, batch_size=2000):
+    """Drop and rebuild the whole index
+    Returns:
+        int -- number of documents indexed
+    """
+    if not uses_fts(using):
+        return 0
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS "{INDEX_TABLE}"')
+    ensure_index(using)
+
+    _write(COMPANY, ((company.id, None, company.name, '') for company in Company.objects.using(using)), using, False)
+    _write(DEPARTMENT, ((department.id, None, department.name, '') for department in Department.objects.using(using)), using, False)
+    total = Company.objects.using(using).count() + Department.objects.using(using).count()
+
+    index_employees(Employee.objects.all(), using, replace=False, batch_size=batch_size)
+    return total + Employee.objects.using(using).count()
+
+
+def match_expression(query):
+    """Turn free text into an FTS5 query matching every word as a prefix"""
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search(query, kinds=tuple(KINDS), company_id=None, limit=SEARCH_LIMIT, using=None):
+    """Find the best matches for query
+    Arguments:
+        query -- free text, every word is matched as a prefix
+        kinds -- which of "employee", "department" and "company" to search
+        company_id -- employees outside this company are never returned
+        limit -- maximum number of results
+        using -- database to search, the current company's when omitted
+    Returns:
+        list -- (kind, object_id, title) tuples, best match first
+    """
+    expression = match_expression(query)
+    if not expression:
+        return []
+    if using is None:
+        using = router.db_for_write(Employee)
+    if not uses_fts(using):
+        return _search_orm(query, kinds, company_id, limit, using)
+
+    # Name matches come first. Each phase scores every match and keeps the
+    # best limit of them, so a very common word costs time linear in its
+    # matches but never loses a better hit further down the index.
+    results = _ranked(f'title : ({expression})', kinds, company_id, limit, using)
+    if len(results) < limit:
+        seen = {(kind, object_id) for kind, object_id, _ in results}
+        results += [
+            result for result in _ranked(expression, kinds, company_id, limit, using)
+            if (result[0], result[1]) not in seen
+        ][:limit - len(results)]
+    return results
+
+
+def _ranked(expression, kinds, company_id, limit, using):
+    codes = [KINDS[kind] for kind in kinds]
+    placeholders = ', '.join(['%s'] * len(codes))
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid, title FROM "{INDEX_TABLE}" '
+            f'WHERE "{INDEX_TABLE}" MATCH %s AND (rowid & 3) IN ({placeholders}) '
+            'AND (company_id IS NULL OR company_id = %s) '
+            f'ORDER BY bm25("{INDEX_TABLE}", 0, %s, %s) LIMIT %s',
+            [expression, *codes, company_id, TITLE_WEIGHT, BODY_WEIGHT, limit],
+        )
+        return [(KIND_NAMES[rowid & 3], rowid >> 2, title) for rowid, title in cursor.fetchall()]
+
+
+def _search_orm(query, kinds, company_id, limit, using):
+    """Unranked fallback for databases without FTS5"""
+    results = []
+    if EMPLOYEE in kinds:
+        condition = Q()
+        for word in re.findall(r'\w+', query):
+            condition &= (
+                Q(user__first_name__istartswith=word) | Q(user__last_name__istartswith=word)
+                | Q(position__icontains=word) | Q(location__icontains=word) | Q(bio__icontains=word)
+                | Q(tasks__icontains=word) | Q(hobbies__hobby__icontains=word)
+            )
+        employees = Employee.objects.using(using).filter(condition, company_id=company_id).distinct()
+        results += [
+            (EMPLOYEE, employee_id, f'{first_name} {last_name}')
+            for employee_id, first_name, last_name in employees.values_list('id', 'user__first_name', 'user__last_name')[:limit]
+        ]
+    for kind, model in ((DEPARTMENT, Department), (COMPANY, Company)):
+        if kind in kinds:
+            matches = model.objects.using(using).filter(name__icontains=query)
+            results += [(kind, object_id, name) for object_id, name in matches.values_list('id', 'name')[:limit]]
+    return results[:limit]
+
+
+def ranked_ids(query, kind, company_id=None, limit=SEARCH_LIMIT, using=None):
+    """Ids of the best matches of a single kind, best match first"""
+    return [object_id for _, object_id, _ in search(query, (kind,), company_id, limit, using)]
+
+
+def ranked_values(queryset, ids):
+    """Load ids from a .values() queryset in one query, keeping the order of ids"""
+    rows = {row['id']: row for row in queryset.filter(pk__in=ids)}
+    return [rows[object_id] for object_id in ids if object_id in rows]
@@ -16,4 +16,5 @@ class UserSerializer(serializers.HyperlinkedModelSerializer):
             view_name='user',
             lookup_field='id'
         )
-        fields = ('id', 'username', 'first_name', 'last_name', 'email', 'password')
\ No newline at end of file
+        # Never add password: every response embedding a user would carry its hash
+        fields = ('id', 'username', 'first_name', 'last_name', 'email')
\ No newline at end of file
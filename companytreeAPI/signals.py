@@ -0,0 +1,162 @@
+"""Signal handlers keeping derived data in sync with the models"""
+from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from companytreeAPI import cache, changes, login, search, tenancy
+from companytreeAPI.authentication import token_cache
+from companytreeAPI.models import Company, Department, Employee, EmployeeHobby
+
+# User fields that are part of the directory, saving only the others leaves the employee as it was
+DIRECTORY_USER_FIELDS = ('first_name', 'last_name', 'email', 'is_active')
+
+
+@receiver(pre_save, sender=User)
+def compare_user_fields(sender, instance, using, update_fields, **kwargs):
+    # Logins save the rehashed password and last_login with update_fields, which costs no query here
+    if update_fields is not None:
+        instance._directory_changed = not update_fields.isdisjoint(DIRECTORY_USER_FIELDS)
+    elif instance.pk is None:
+        instance._directory_changed = True
+    else:
+        saved = User.objects.using(using).filter(pk=instance.pk).values_list(*DIRECTORY_USER_FIELDS).first()
+        instance._directory_changed = saved != tuple(getattr(instance, field) for field in DIRECTORY_USER_FIELDS)
+
+
+def directory_unchanged(instance, signal):
+    """Whether a User save left every directory field as it was"""
+    return signal is post_save and not getattr(instance, '_directory_changed', True)
+
+
+@receiver(post_save, sender=Employee)
+def index_saved_employee(sender, instance, using, **kwargs):
+    search.index_employee(instance, using)
+
+
+@receiver(post_delete, sender=Employee)
+def unindex_deleted_employee(sender, instance, using, **kwargs):
+    search.remove(search.EMPLOYEE, instance.id, using)
+
+
+@receiver(post_save, sender=User)
+def index_saved_user(sender, instance, using, created, signal, **kwargs):
+    # A brand new user has no employee row yet, it is indexed with the employee
+    if created or directory_unchanged(instance, signal):
+        return
+    employee = Employee.objects.using(using).select_related('user').filter(user=instance).first()
+    if employee is not None:
+        search.index_employee(employee, using)
+
+
+@receiver(post_save, sender=EmployeeHobby)
+@receiver(post_delete, sender=EmployeeHobby)
+def index_hobby_employee(sender, instance, using, **kwargs):
+    employee = Employee.objects.using(using).select_related('user').filter(pk=instance.employee_id).first()
+    if employee is not None:
+        search.index_employee(employee, using)
+
+
+@receiver(post_save, sender=Department)
+def index_saved_department(sender, instance, using, **kwargs):
+    search.index_department(instance, using)
+
+
+@receiver(post_delete, sender=Department)
+def unindex_deleted_department(sender, instance, using, **kwargs):
+    search.remove(search.DEPARTMENT, instance.id, using)
+
+
+@receiver(post_save, sender=Department)
+def replicate_saved_department(sender, instance, **kwargs):
+    tenancy.replicate_department(instance)
+
+
+@receiver(post_delete, sender=Department)
+def replicate_deleted_department(sender, instance, **kwargs):
+    tenancy.replicate_department(instance, deleted=True)
+
+
+@receiver(post_delete, sender=Company)
+def forget_deleted_company(sender, instance, **kwargs):
+    tenancy.forget(instance.id)
+
+
+@receiver(post_save, sender=Company)
+def index_saved_company(sender, instance, using, **kwargs):
+    search.index_company(instance, using)
+
+
+@receiver(post_delete, sender=Company)
+def unindex_deleted_company(sender, instance, using, **kwargs):
+    search.remove(search.COMPANY, instance.id, using)
+
+
+@receiver(post_save, sender=Employee)
+@receiver(post_delete, sender=Employee)
+def invalidate_employee_company(sender, instance, using, **kwargs):
+    cache.invalidate_company(instance.company_id, using)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_company(sender, instance, using, signal, **kwargs):
+    if directory_unchanged(instance, signal):
+        return
+    company_id = Employee.objects.using(using).filter(user_id=instance.id).values_list('company_id', flat=True).first()
+    cache.invalidate_company(company_id, using)
+
+
+@receiver(post_save, sender=EmployeeHobby)
+@receiver(post_delete, sender=EmployeeHobby)
+def invalidate_hobby_company(sender, instance, using, **kwargs):
+    company_id = Employee.objects.using(using).filter(pk=instance.employee_id).values_list('company_id', flat=True).first()
+    cache.invalidate_company(company_id, using)
+
+
+@receiver(post_save, sender=Department)
+@receiver(post_delete, sender=Department)
+def invalidate_departments(sender, instance, using, **kwargs):
+    cache.invalidate(cache.GLOBAL_SCOPE, using=using)
+
+
+@receiver(post_save, sender=Company)
+@receiver(post_delete, sender=Company)
+def invalidate_company(sender, instance, using, **kwargs):
+    cache.invalidate_company(instance.id, using)
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    token_cache.discard(instance.key)
+    login.forget_token(instance.user_id)
+
+
+@receiver(post_save, sender=Employee)
+@receiver(post_delete, sender=Employee)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user_tokens(sender, instance, **kwargs):
+    token_cache.discard_user(instance.user_id if sender is Employee else instance.id)
+
+
+@receiver(post_save, sender=Employee)
+@receiver(post_save, sender=Department)
+@receiver(post_save, sender=Company)
+@receiver(post_save, sender=EmployeeHobby)
+def log_saved_row(sender, instance, using, **kwargs):
+    changes.record_instance(instance, using=using)
+
+
+@receiver(post_delete, sender=Employee)
+@receiver(post_delete, sender=Department)
+@receiver(post_delete, sender=Company)
+@receiver(post_delete, sender=EmployeeHobby)
+def log_deleted_row(sender, instance, using, **kwargs):
+    changes.record_instance(instance, deleted=True, using=using)
+
+
+@receiver(post_save, sender=User)
+def log_user_employee(sender, instance, created, signal, **kwargs):
+    # Names and email are part of the employee rows
+    if not created and not directory_unchanged(instance, signal):
+        changes.update(Employee.objects.filter(user_id=instance.id))
@@ -0,0 +1,27 @@
+"""Helpers for streaming large responses without holding them in memory"""
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+
+# Rows are encoded and flushed to the client in groups of this size.
+STREAM_CHUNK_ROWS = 500
+
+
+def stream_json_array(rows, chunk_rows=STREAM_CHUNK_ROWS):
+    """Encode an iterable of dicts as a JSON array, a chunk of rows at a time
+    Arguments:
+        rows -- any iterable of JSON serializable dicts, consumed lazily
+    Yields:
+        str -- pieces of the array that concatenate to valid JSON
+    """
+    encoder = DjangoJSONEncoder()
+    buffer = ['[']
+    separator = ''
+    for row in rows:
+        buffer.append(separator)
+        buffer.append(encoder.encode(row))
+        separator = ','
+        if len(buffer) >= chunk_rows * 2:
+            yield ''.join(buffer)
+            buffer = []
+    buffer.append(']')
+    yield ''.join(buffer)
@@ -0,0 +1,217 @@
+"""Synthetic company generator used by seed_company and the benchmark commands"""
+import random
+import secrets
+from itertools import islice
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connections, router
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from companytreeAPI import counters, tenancy
+from companytreeAPI.models import Company, Department, Employee, EmployeeHobby
+
+FIRST_NAMES = (
+    'Ada', 'Alan', 'Barbara', 'Claude', 'Dennis', 'Edsger', 'Frances', 'Grace', 'Hedy', 'Ivan',
+    'Jean', 'Ken', 'Linus', 'Margaret', 'Niklaus', 'Ole', 'Radia', 'Shafi', 'Tim', 'Whitfield',
+)
+LAST_NAMES = (
+    'Allen', 'Backus', 'Cerf', 'Dijkstra', 'Engelbart', 'Floyd', 'Goldwasser', 'Hopper', 'Iverson', 'Johnson',
+    'Kay', 'Lamport', 'Liskov', 'McCarthy', 'Naur', 'Perlman', 'Ritchie', 'Sutherland', 'Thompson', 'Wirth',
+)
+POSITIONS = ('Engineer', 'Designer', 'Analyst', 'Accountant', 'Recruiter', 'Account Executive', 'Support Specialist')
+LOCATIONS = ('Nashville', 'Austin', 'Denver', 'Chicago', 'New York', 'London', 'Berlin', 'Remote')
+HOBBIES = (
+    'baking', 'board games', 'chess', 'climbing', 'cycling', 'drawing', 'fishing', 'gardening', 'guitar',
+    'hiking', 'knitting', 'photography', 'piano', 'pottery', 'reading', 'running', 'sailing', 'skiing',
+    'soccer', 'swimming', 'tennis', 'travel', 'video games', 'woodworking', 'yoga',
+)
+COLORS = ('#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f')
+
+
+def _next_id(model):
+    # The ids of companies moved in from other databases are not this database's to continue
+    first_id, end = tenancy.id_range(router.db_for_write(model))
+    ids = model.objects.filter(id__gte=first_id)
+    if end is not None:
+        ids = ids.filter(id__lt=end)
+    return (ids.order_by('-id').values_list('id', flat=True).first() or first_id) + 1
+
+
+def insert_rows(model, fields, rows, batch_size=None):
+    """Insert tuples of field values with executemany
+    Building a model instance and compiling an INSERT per batch is most of
+    the cost of bulk_create on millions of rows, so values are written as
+    they are. They must already be in their database form.
+    """
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(model._meta.get_field(field).column) for field in fields)
+    sql = f'INSERT INTO {quote(model._meta.db_table)} ({columns}) VALUES ({", ".join(["%s"] * len(fields))})'
+    rows = iter(rows)
+    with connection.cursor() as cursor:
+        while True:
+            batch = list(islice(rows, batch_size or 10000))
+            if not batch:
+                break
+            cursor.executemany(sql, batch)
+
+
+def _reset_sequences(*models):
+    # Explicit ids leave the primary key sequence behind on PostgreSQL
+    for model in models:
+        tenancy.advance_sequence(router.db_for_write(model), model, _next_id(model) - 1)
+
+
+def fan_out_for_depth(employees, depth):
+    """Smallest fan-out whose tree of depth levels below the top manager holds every employee"""
+    fan_out = 1
+    while sum(fan_out ** level for level in range(depth + 1)) < employees:
+        fan_out += 1
+    return fan_out
+
+
+def seed_departments(name, count):
+    """Bulk insert count departments named after the company
+    Returns:
+        list -- the new department ids
+    """
+    names = [f'{name} {index + 1}' for index in range(count)]
+    # bulk_create only hands back ids on PostgreSQL, and an earlier run may have used the same names
+    last_id = Department.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    Department.objects.bulk_create(Department(name=department, colorHex=COLORS[index % len(COLORS)])
+                                   for index, department in enumerate(names))
+    created = Department.objects.filter(id__gt=last_id, name__in=names)
+    return list(created.order_by('id').values_list('id', flat=True))
+
+
+def _departments(employees, fan_out, department_ids):
+    """Give every employee the department of their top-level branch
+    Departments are handed out across the first tree level with at least
+    as many employees as there are departments, and everyone below inherits
+    the department of their ancestor on that level, like real teams.
+    """
+    if not department_ids:
+        return [None] * employees
+    start, size = 0, 1
+    while size < len(department_ids) and start + size < employees:
+        start, size = start + size, size * fan_out
+    stop = start + size
+
+    departments = []
+    for index in range(employees):
+        ancestor = index
+        while ancestor >= stop:
+            ancestor = (ancestor - 1) // fan_out
+        departments.append(department_ids[ancestor % len(department_ids)])
+    return departments
+
+
+def seed_company(name, employees, fan_out=5, batch_size=None, department_ids=(), hobbies=0, password=None, seed=0):
+    """Bulk insert a company whose employees form a balanced reporting tree
+    User and employee ids are assigned here rather than by the database, so
+    the supervisor ids, paths and report counters are all known up front
+    and every row is written once. Nothing else may insert users or
+    employees meanwhile. The rows are not in the change log, clients of a
+    new company start from a full download anyway.
+    Arguments:
+        name -- company name, also used to prefix usernames
+        employees -- total number of employees including the top manager
+        fan_out -- direct reports per supervisor
+        batch_size -- rows per executemany call
+        department_ids -- departments to spread the employees over
+        hobbies -- average number of hobbies per employee
+        password -- password of every user, unusable when omitted
+        seed -- seed of the random names, positions and hobbies
+    Returns:
+        tuple -- (company, list of employee ids in breadth-first order)
+    """
+    rng = random.Random(seed)
+    company = Company.objects.create(name=name)
+    # Hashing once keeps seeding fast, every user gets the same hash
+    password = make_password(password)
+    prefix = f'{name.lower().replace(" ", "_")}_{company.id}_'
+    joined = connections[router.db_for_write(Company)].ops.adapt_datetimefield_value(timezone.now())
+
+    first_user_id = _next_id(User)
+    insert_rows(
+        User,
+        ('id', 'username', 'first_name', 'last_name', 'email', 'password',
+         'is_superuser', 'is_staff', 'is_active', 'date_joined'),
+        (
+            (first_user_id + index, f'{prefix}{index}', rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+             f'{prefix}{index}@example.com', password, False, False, True, joined)
+            for index in range(employees)
+        ),
+        batch_size,
+    )
+    # Every registered user has a token, login hands it out. Same key format as Token.generate_key()
+    insert_rows(
+        Token,
+        ('key', 'user', 'created'),
+        ((secrets.token_hex(20), first_user_id + index, joined) for index in range(employees)),
+        batch_size,
+    )
+
+    first_id = _next_id(Employee)
+    employee_ids = list(range(first_id, first_id + employees))
+
+    # A supervisor always comes before their reports, so walking backwards
+    # finishes every subtree before it is added to its supervisor's
+    direct = [0] * employees
+    total = [0] * employees
+    for index in range(employees - 1, 0, -1):
+        supervisor = (index - 1) // fan_out
+        direct[supervisor] += 1
+        total[supervisor] += 1 + total[index]
+
+    paths = [f'/{first_id}/']
+    for index in range(1, employees):
+        paths.append(f'{paths[(index - 1) // fan_out]}{employee_ids[index]}/')
+
+    departments = _departments(employees, fan_out, list(department_ids))
+
+    def position(index):
+        if index == 0:
+            return 'Chief Executive Officer'
+        return 'Manager' if direct[index] else rng.choice(POSITIONS)
+
+    insert_rows(
+        Employee,
+        ('id', 'user', 'department', 'supervisor', 'position', 'location', 'company', 'is_admin',
+         'path', 'direct_report_count', 'total_report_count', 'updated_at'),
+        (
+            (employee_ids[index], first_user_id + index, departments[index],
+             employee_ids[(index - 1) // fan_out] if index else None, position(index),
+             rng.choice(LOCATIONS), company.id, index == 0, paths[index], direct[index], total[index], joined)
+            for index in range(employees)
+        ),
+        batch_size,
+    )
+    _reset_sequences(User, Employee)
+    counters.count_departments(company.id, departments)
+
+    if hobbies:
+        insert_rows(
+            EmployeeHobby,
+            ('employee', 'hobby', 'updated_at'),
+            (
+                (employee_id, hobby, joined)
+                for employee_id in employee_ids
+                for hobby in rng.sample(HOBBIES, min(rng.randint(0, 2 * hobbies), len(HOBBIES)))
+            ),
+            batch_size,
+        )
+
+    return company, employee_ids
+
+
+def delete_company(company):
+    """Delete a seeded company together with its employees' users and hobbies"""
+    employees = Employee.objects.filter(company=company)
+    user_ids = list(employees.values_list('user_id', flat=True))
+    # supervisor and hobby employee are DO_NOTHING, so unlink the tree and drop hobbies first
+    EmployeeHobby.objects.filter(employee__company=company).delete()
+    employees.update(supervisor=None)
+    for start in range(0, len(user_ids), 500):
+        User.objects.filter(pk__in=user_ids[start:start + 500]).delete()
+    company.delete()
@@ -0,0 +1,409 @@
+"""Tenant sharding: the database each company lives in
+
+Every company lives, with its users, tokens, employees, hobbies and change
+log, in one of the databases listed in COMPANYTREE_SHARDS: separate SQLite
+files locally, PostgreSQL schemas in production. The Tenant registry in
+the default database maps a company to its database. Companies without a
+Tenant row live in the default database, so with a single database there
+is no registry to read at all.
+
+Once the caller of a request is known, activate() points TenantRouter at
+their company's database for the rest of the request. Requests that span
+companies, like the company list, run a query in every database with
+fan_out() and merge the results. While a company moves its rows are in
+two databases, so they keep only the rows own_rows() says the database
+serves. Departments are shared by every company: they are read and
+written in the default database and copied to the others, where employee
+rows join them.
+
+Ids stay unique across databases. Every database after the first hands
+out ids from its own range, COMPANYTREE_SHARD_ID_SPAN apart, so a company
+keeps its ids when manage.py move_company moves it. SQLite hands out ids
+above the largest one a table holds, so there a company can only move to
+a database whose range is above its ids.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from companytreeAPI import db, search
+from companytreeAPI.models import Company, Department, Employee, EmployeeHobby, Tenant
+
+# Default distance between the first ids of neighbouring databases, small
+# enough for PostgreSQL's 32 bit serial columns to hold 21 databases
+ID_SPAN = 10 ** 8
+
+# Models whose ids every database hands out from its own range
+RANGED_MODELS = (User, Company, Employee, EmployeeHobby)
+
+# Models only the default database holds, Department is copied to the others
+SHARED_MODELS = (Tenant, Department)
+
+# Where a company lives, whether writes are held back while it moves, and
+# the oldest change log cursor its database hands out
+TenantInfo = namedtuple('TenantInfo', ('database', 'frozen', 'cursor_floor'))
+
+HOME = TenantInfo(DEFAULT_DB_ALIAS, False, 0)
+
+_current = ContextVar('companytree_tenant', default=None)
+
+
+def databases():
+    """Aliases of every database a company can live in, the default database first"""
+    return list(getattr(settings, 'COMPANYTREE_SHARDS', [DEFAULT_DB_ALIAS]))
+
+
+def sharded():
+    return len(databases()) > 1
+
+
+def id_range(alias):
+    """(first, last + 1) of the ids a database hands out, the last database has no upper bound"""
+    span = getattr(settings, 'COMPANYTREE_SHARD_ID_SPAN', ID_SPAN)
+    aliases = databases()
+    index = aliases.index(alias)
+    return index * span, (index + 1) * span if index < len(aliases) - 1 else None
+
+
+class TenantCache:
+    """In-process LRU of Tenant rows with a time to live
+    A moved company is found in its new database by every process within
+    the time to live, manage.py move_company waits that long between steps.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tenants = OrderedDict()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'COMPANYTREE_TENANT_CACHE_TTL', 5)
+
+    def get(self, company_id):
+        return self.get_many([company_id])[company_id]
+
+    def get_many(self, company_ids):
+        """TenantInfo of several companies, reading the ones not cached from the registry in one query"""
+        tenants, missing = {}, []
+        with self._lock:
+            now = time.monotonic()
+            for company_id in company_ids:
+                entry = self._tenants.get(company_id)
+                if entry is not None and entry[0] >= now:
+                    self._tenants.move_to_end(company_id)
+                    tenants[company_id] = entry[1]
+                else:
+                    missing.append(company_id)
+        if not missing:
+            return tenants
+
+        rows = Tenant.objects.using(DEFAULT_DB_ALIAS).filter(company_id__in=missing)
+        found = {row.company_id: TenantInfo(row.database, row.frozen, row.cursor_floor) for row in rows}
+        with self._lock:
+            expires = time.monotonic() + self.ttl
+            for company_id in missing:
+                tenants[company_id] = found.get(company_id, HOME)
+                self._tenants[company_id] = (expires, tenants[company_id])
+                self._tenants.move_to_end(company_id)
+            while len(self._tenants) > getattr(settings, 'COMPANYTREE_TENANT_CACHE_SIZE', 10000):
+                self._tenants.popitem(last=False)
+        return tenants
+
+    def discard(self, company_id):
+        with self._lock:
+            self._tenants.pop(company_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._tenants.clear()
+
+
+tenant_cache = TenantCache()
+
+
+def tenant(company_id):
+    """The TenantInfo of a company"""
+    if company_id is None or not sharded():
+        return HOME
+    return tenant_cache.get(company_id)
+
+
+def tenants(company_ids):
+    """The TenantInfo of a list of companies, keyed by company id"""
+    if not sharded():
+        return dict.fromkeys(company_ids, HOME)
+    placed = tenant_cache.get_many({company_id for company_id in company_ids if company_id is not None})
+    return {company_id: placed.get(company_id, HOME) for company_id in company_ids}
+
+
+def database_for(company_id):
+    """Alias of the database a company lives in"""
+    return tenant(company_id).database
+
+
+def current():
+    """Alias of the database of the current company, None outside a company"""
+    return _current.get()
+
+
+def activate(alias):
+    """Route the rest of the request to a database, TenantMiddleware resets it afterwards"""
+    _current.set(alias)
+
+
+@contextmanager
+def using(alias):
+    """Route the queries made inside the block to a database"""
+    token = _current.set(alias)
+    try:
+        yield alias
+    finally:
+        _current.reset(token)
+
+
+def for_company(company_id):
+    """Route the queries made inside the block to a company's database"""
+    return using(database_for(company_id))
+
+
+def atomic():
+    """transaction.atomic() on the database of the current company"""
+    return transaction.atomic(using=router.db_for_write(Employee))
+
+
+def fan_out(function):
+    """Call function once with every database current
+    Returns:
+        list -- the result of every call, in COMPANYTREE_SHARDS order
+    """
+    results = []
+    for alias in databases():
+        with using(alias):
+            results.append(function())
+    return results
+
+
+def owned(company_ids, alias=None):
+    """The company ids the registry places in a database, the current one by default
+    While manage.py move_company copies a company both databases hold its
+    rows, and only the one the registry names may serve them.
+    """
+    alias = alias or current() or DEFAULT_DB_ALIAS
+    company_ids = list(company_ids)
+    placed = tenants(company_ids)
+    return [company_id for company_id in company_ids if placed[company_id].database == alias]
+
+
+def own_rows(rows, chunk_size=500):
+    """Yield the company rows, dicts with an "id", that the current database serves
+    rows is a list or a queryset, read chunk_size rows at a time so that a
+    caller taking the first few rows reads little more than those.
+    """
+    start = 0
+    while True:
+        chunk = list(rows[start:start + chunk_size])
+        here = set(owned(row['id'] for row in chunk))
+        yield from (row for row in chunk if row['id'] in here)
+        if len(chunk) < chunk_size:
+            return
+        start += chunk_size
+
+
+def user_database(username):
+    """Alias of the database serving a username, None when no database holds it
+    A user without an employee belongs to no company and lives in the default database.
+    """
+    for alias in databases():
+        users = User.objects.using(alias).filter(username=username).values_list('employee__company_id', flat=True)
+        if any(database_for(company_id) == alias for company_id in users[:1]):
+            return alias
+    return None
+
+
+def taken_usernames(usernames):
+    """The usernames some database already holds"""
+    return {
+        username for alias in databases()
+        for username in User.objects.using(alias).filter(username__in=usernames).values_list('username', flat=True)
+    }
+
+
+def place_company():
+    """The database a new company goes to
+    COMPANYTREE_NEW_COMPANY_DATABASE when it is set, otherwise the database
+    with the fewest employees.
+    """
+    aliases = databases()
+    configured = getattr(settings, 'COMPANYTREE_NEW_COMPANY_DATABASE', None)
+    if configured:
+        return configured
+    if len(aliases) == 1:
+        return aliases[0]
+    return min(aliases, key=lambda alias: Employee.objects.using(alias).count())
+
+
+def register(company_id, alias, **fields):
+    """Record the database of a company in the registry"""
+    if not sharded():
+        return
+    Tenant.objects.using(DEFAULT_DB_ALIAS).update_or_create(company_id=company_id, defaults={'database': alias, **fields})
+    tenant_cache.discard(company_id)
+
+
+def forget(company_id):
+    """Drop a deleted company from the registry"""
+    if not sharded():
+        return
+    Tenant.objects.using(DEFAULT_DB_ALIAS).filter(company_id=company_id).delete()
+    tenant_cache.discard(company_id)
+
+
+def delete_rows(alias, model, ids, chunk_size=500):
+    """Delete rows by primary key with plain SQL, without loading them or sending signals"""
+    connection = connections[alias]
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.pk.column)
+    ids = list(ids)
+    with connection.cursor() as cursor:
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            cursor.execute(f'DELETE FROM {table} WHERE {column} IN ({", ".join(["%s"] * len(chunk))})', chunk)
+
+
+def advance_sequence(alias, model, value):
+    """Make the next id a database hands out for model larger than value, never lowering it"""
+    connection = connections[alias]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s', [value, table, value])
+            cursor.execute(
+                'INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s '
+                'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                [table, value, table],
+            )
+        elif connection.vendor == 'postgresql':
+            cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [connection.ops.quote_name(table), model._meta.pk.column])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(f'SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END FROM {sequence}')
+            if cursor.fetchone()[0] < value:
+                cursor.execute('SELECT setval(%s, %s)', [sequence, value])
+
+
+def replicate_department(department, deleted=False):
+    """Copy a department saved or deleted in the default database to the other databases"""
+    for alias in databases()[1:]:
+        if deleted:
+            delete_rows(alias, Department, [department.id])
+            search.remove(search.DEPARTMENT, department.id, alias)
+            continue
+        copies = Department.objects.using(alias).filter(pk=department.id)
+        # Queryset writes, the signals already ran for the original
+        if not copies.update(name=department.name, colorHex=department.colorHex):
+            Department.objects.using(alias).bulk_create([
+                Department(id=department.id, name=department.name, colorHex=department.colorHex)
+            ])
+        search.index_department(department, alias)
+
+
+def replicate_departments(alias):
+    """Bring the copies of the departments in a database in line with the default database
+    Only the names and colors are copied, the employee counts are read from the default database.
+    Returns:
+        int -- number of departments copied, changed or deleted
+    """
+    if alias == DEFAULT_DB_ALIAS:
+        return 0
+    fields = ('name', 'colorHex')
+    originals = {department.id: department for department in Department.objects.using(DEFAULT_DB_ALIAS).only('id', *fields)}
+    copies = {department.id: department for department in Department.objects.using(alias).only('id', *fields)}
+
+    gone = copies.keys() - originals.keys()
+    delete_rows(alias, Department, gone)
+    for department_id in gone:
+        search.remove(search.DEPARTMENT, department_id, alias)
+
+    new = [department for department_id, department in originals.items() if department_id not in copies]
+    changed = [
+        department for department_id, department in originals.items() if department_id in copies
+        and any(getattr(copies[department_id], field) != getattr(department, field) for field in fields)
+    ]
+    Department.objects.using(alias).bulk_create(
+        [Department(id=department.id, **{field: getattr(department, field) for field in fields}) for department in new],
+        batch_size=500,
+    )
+    Department.objects.using(alias).bulk_update(changed, fields, batch_size=500)
+    for department in new + changed:
+        search.index_department(department, alias)
+    return len(gone) + len(new) + len(changed)
+
+
+def prepare_database(sender, using, **kwargs):
+    """post_migrate receiver starting a database's ids in its range and copying the departments to it"""
+    if using not in databases()[1:]:
+        return
+    first_id, _ = id_range(using)
+    for model in RANGED_MODELS:
+        advance_sequence(using, model, first_id)
+    replicate_departments(using)
+
+
+class TenantRouter:
+    """Route the rows of the current company to its database and the shared models to the default database
+    Outside a company, and for the reads of shared models, ReadAliasRouter decides.
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = _current.get()
+        if alias is None or model in SHARED_MODELS:
+            return None
+        return db.read_alias(alias) if db.is_reading() else alias
+
+    def db_for_write(self, model, **hints):
+        if model in SHARED_MODELS:
+            return DEFAULT_DB_ALIAS
+        return _current.get()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Departments join employees through their copies
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if model_name == Tenant._meta.model_name and app_label == Tenant._meta.app_label:
+            return db == DEFAULT_DB_ALIAS
+        if db in databases():
+            return True
+        return None
+
+
+def _tenant_stream(chunks, alias):
+    # Streamed bodies run their queries after the view has returned
+    chunks = iter(chunks)
+    while True:
+        with using(alias):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+class TenantMiddleware:
+    """Start every request outside any company and end it there, whichever company it activated"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _current.set(None)
+        try:
+            response = self.get_response(request)
+            alias = _current.get()
+        finally:
+            _current.reset(token)
+        if alias is not None and response.streaming:
+            response.streaming_content = _tenant_stream(response.streaming_content, alias)
+        return response
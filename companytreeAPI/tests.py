@@ -1,3 +1,1376 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import json
+import re
+import tempfile
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from companytreeAPI import async_views, bootstrap, cache, changes, counters, db, hierarchy, hobbies, layout, login, metrics, push, streaming, synthetic, tenancy
+from companytreeAPI import search as search_index
+from companytreeAPI.authentication import token_cache
+from companytreeAPI.models import Change, Company, Department, DepartmentCount, Employee, EmployeeHobby, Tenant
 
-# Create your tests here.
+# "SCAN table" without "USING ... INDEX" reads every row of the table
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)$')
+
+
+def query_plan(sql):
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+        return [row[3] for row in cursor.fetchall()]
+
+
+def full_scans(sql):
+    """Tables, or aliases of tables, that SQLite reads in full to answer sql"""
+    tables = {model._meta.db_table for model in apps.get_models()}
+    # SQLite names a table by its alias in the plan, e.g. "employee" e in the recursive queries
+    names = tables | {alias for table, alias in re.findall(r'"(\w+)" (?:AS )?"?(\w+)', sql) if table in tables}
+    return [
+        detail for detail in query_plan(sql)
+        if FULL_SCAN.match(detail) and FULL_SCAN.match(detail).group(1) in names
+    ]
+
+
+def reset_caches():
+    """Forget what earlier tests left in the caches, their rolled back ids come round again"""
+    cache.get_cache().clear()
+    token_cache.clear()
+    tenancy.tenant_cache.clear()
+    with hobbies._indexes_lock:
+        hobbies._indexes.clear()
+    with layout._layouts_lock:
+        layout._layouts.clear()
+
+
+def run_commit_hooks():
+    """Run the on_commit callbacks waiting for the test's transactions, which are rolled back instead"""
+    for alias in connections:
+        callbacks, connections[alias].run_on_commit = connections[alias].run_on_commit, []
+        for _, callback in callbacks:
+            callback()
+
+
+def create_employee(company, username, supervisor=None, department=None, is_admin=False):
+    """An employee placed in the reporting tree the way Employees.create places them"""
+    user = User.objects.create_user(username=username, password='password', first_name=username, last_name='Smith')
+    employee = Employee.objects.create(
+        user=user, company=company, department=department, supervisor=supervisor,
+        position='Engineer', location='Remote', is_admin=is_admin,
+    )
+    hierarchy.attach(employee)
+    return employee
+
+
+class DirectoryTestCase(TestCase):
+    """A company with a manager, signed in as them, and two reports"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='Acme')
+        cls.department = Department.objects.create(name='Engineering', colorHex='#000000')
+        cls.manager = create_employee(cls.company, 'manager', department=cls.department, is_admin=True)
+        cls.lead = create_employee(cls.company, 'lead', cls.manager, cls.department)
+        cls.report = create_employee(cls.company, 'report', cls.lead, cls.department)
+        cls.token = Token.objects.create(user=cls.manager.user)
+
+    def setUp(self):
+        reset_caches()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def read(self, response):
+        """The JSON body of a response, streamed or not"""
+        if response.streaming:
+            return json.loads(b''.join(response.streaming_content))
+        return response.json()
+
+    def update(self, employee, **changes):
+        """PUT an employee with their current fields and the given changes"""
+        data = {
+            'department_id': employee.department_id, 'supervisor_id': employee.supervisor_id,
+            'position': employee.position, 'location': employee.location, 'bio': None, 'image_url': None,
+            'tasks': None, 'phone': None, 'slack': None, 'is_admin': employee.is_admin, **changes,
+        }
+        return self.client.put(f'/employees/{employee.id}', data, format='json')
+
+    def assertReports(self, employee, direct, total):
+        employee.refresh_from_db()
+        self.assertEqual((employee.direct_report_count, employee.total_report_count), (direct, total), employee.user.username)
+
+    def refresh(self, *employees):
+        for employee in employees:
+            employee.refresh_from_db()
+
+
+
+def shape(node, link='reports'):
+    """A tree response reduced to ids, to compare its nesting"""
+    if node is None:
+        return None
+    if link == 'reports':
+        return {node['id']: [shape(report) for report in node['reports']]}
+    return [node['id'], shape(node['supervisor'], link)]
+
+
+class TreeTests(DirectoryTestCase):
+    """Reporting trees come nested from a single recursive query"""
+
+    def tree(self, employee, query=''):
+        return self.client.get(f'/employees/{employee.id}/tree{query}')
+
+    def test_reports_down(self):
+        with CaptureQueriesContext(connection) as queries:
+            tree = self.tree(self.manager).json()
+        self.assertEqual(shape(tree), {self.manager.id: [{self.lead.id: [{self.report.id: []}]}]})
+        self.assertEqual(sum('RECURSIVE' in query['sql'] for query in queries), 1)
+        self.assertEqual((tree['first_name'], tree['depth']), ('manager', 0))
+
+        self.assertEqual(shape(self.tree(self.manager, '?depth=1').json()), {self.manager.id: [{self.lead.id: []}]})
+        self.assertEqual(shape(self.tree(self.report).json()), {self.report.id: []})
+
+    def test_managers_up(self):
+        tree = self.tree(self.report, '?direction=up').json()
+        self.assertEqual(shape(tree, 'supervisor'), [self.report.id, [self.lead.id, [self.manager.id, None]]])
+        self.assertEqual(shape(self.tree(self.report, '?direction=up&depth=1').json(), 'supervisor'), [self.report.id, [self.lead.id, None]])
+
+    def test_bad_requests(self):
+        outsider = create_employee(Company.objects.create(name='Globex'), 'outsider')
+        self.assertEqual(self.tree(outsider).status_code, 404)
+        self.assertEqual(self.client.get('/employees/0/tree').status_code, 404)
+        self.assertEqual(self.tree(self.manager, '?direction=sideways').status_code, 400)
+        self.assertEqual(self.tree(self.manager, '?depth=-1').status_code, 400)
+
+
+class HierarchyTests(DirectoryTestCase):
+    """Materialized paths follow every change of supervisor and never form a cycle"""
+
+    def paths(self):
+        return dict(Employee.objects.values_list('id', 'path'))
+
+    def test_paths_follow_moves_and_deletes(self):
+        other = create_employee(self.company, 'other', self.manager)
+        self.assertEqual(self.update(self.lead, supervisor_id=other.id).status_code, 204)
+        self.refresh(self.lead, self.report)
+        self.assertEqual(self.report.path, f'/{self.manager.id}/{other.id}/{self.lead.id}/{self.report.id}/')
+        self.assertEqual(hierarchy.ancestor_ids(self.report), [self.manager.id, other.id, self.lead.id])
+        self.assertTrue(hierarchy.is_under(self.report, other))
+        self.assertEqual(set(hierarchy.descendants(other)), {self.lead, self.report})
+
+        self.assertEqual(self.client.delete(f'/employees/{self.lead.id}').status_code, 204)
+        self.refresh(self.report)
+        self.assertEqual(self.report.supervisor_id, other.id)
+        self.assertEqual(self.report.path, f'/{self.manager.id}/{other.id}/{self.report.id}/')
+
+    def test_descendants_stop_at_the_prefix(self):
+        # An id that starts with the lead's digits sorts right after the lead's subtree
+        sibling = create_employee(self.company, 'sibling', self.manager)
+        Employee.objects.filter(pk=sibling.pk).update(path=f'{self.lead.path[:-1]}0/')
+        self.assertEqual(set(hierarchy.descendants(self.lead)), {self.report})
+        self.assertEqual(set(hierarchy.descendants(self.manager)), {self.lead, self.report, sibling})
+
+    def test_cycles_are_refused(self):
+        paths = self.paths()
+        response = self.update(self.manager, supervisor_id=self.report.id)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cycle', response.json()['message'])
+        self.assertEqual(self.update(self.lead, supervisor_id=self.lead.id).status_code, 400)
+        for value in ('abc', [1]):
+            response = self.update(self.lead, supervisor_id=value)
+            self.assertEqual((response.status_code, response.json()), (400, {'message': 'supervisor_id must be an integer'}))
+        self.assertEqual(self.paths(), paths)
+        self.refresh(self.manager)
+        self.assertIsNone(self.manager.supervisor_id)
+
+    def test_empty_supervisor_makes_a_top_manager(self):
+        self.assertEqual(self.update(self.lead, supervisor_id='').status_code, 204)
+        self.refresh(self.lead, self.report)
+        self.assertIsNone(self.lead.supervisor_id)
+        self.assertEqual(self.report.path, f'/{self.lead.id}/{self.report.id}/')
+        self.assertReports(self.manager, 0, 0)
+
+    def new_employee(self, username, supervisor_id, **fields):
+        return {
+            'username': username, 'email': f'{username}@example.com', 'password': 'password',
+            'first_name': username, 'last_name': 'Smith', 'department_id': self.department.id,
+            'supervisor_id': supervisor_id, 'position': 'Engineer', 'location': 'Remote', 'bio': None,
+            'image_url': None, 'tasks': None, 'phone': None, 'slack': None, 'is_admin': False, **fields,
+        }
+
+    def test_new_employees_need_a_supervisor_of_their_company(self):
+        outsider = create_employee(Company.objects.create(name='Globex'), 'outsider')
+        for supervisor_id in (outsider.id, 0):
+            response = self.client.post('/employees', self.new_employee('newcomer', supervisor_id), format='json')
+            self.assertEqual((response.status_code, response.json()), (400, {'message': f'Supervisor {supervisor_id} does not exist'}))
+            response = self.client.post('/register', self.new_employee('joiner', supervisor_id, company_id=self.company.id), format='json')
+            self.assertEqual((response.status_code, response.json()), (400, {'message': f'Supervisor {supervisor_id} does not exist'}))
+        self.assertFalse(User.objects.filter(username__in=['newcomer', 'joiner']).exists())
+        self.assertReports(outsider, 0, 0)
+
+        self.assertEqual(self.client.post('/employees', self.new_employee('newcomer', self.lead.id), format='json').status_code, 200)
+        newcomer = Employee.objects.get(user__username='newcomer')
+        self.assertEqual(newcomer.path, f'/{self.manager.id}/{self.lead.id}/{newcomer.id}/')
+        self.assertReports(self.lead, 2, 2)
+
+    def test_rebuild_command(self):
+        paths = self.paths()
+        Employee.objects.update(path='')
+        # A cycle left behind by older data is cut at its lowest id
+        Employee.objects.filter(pk=self.manager.pk).update(supervisor_id=self.report.id)
+
+        call_command('rebuild_hierarchy', stdout=StringIO(), stderr=StringIO())
+
+        self.refresh(self.manager)
+        self.assertIsNone(self.manager.supervisor_id)
+        self.assertEqual(self.paths(), paths)
+
+
+
+class ListTests(DirectoryTestCase):
+    """The unpaginated employee list is streamed a chunk of rows at a time"""
+
+    def test_whole_list_is_streamed(self):
+        create_employee(Company.objects.create(name='Globex'), 'outsider')
+        response = self.client.get('/employees')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        rows = self.read(response)
+        self.assertEqual([row['id'] for row in rows], [self.manager.id, self.lead.id, self.report.id])
+        self.assertEqual((rows[1]['username'], rows[1]['name'], rows[1]['supervisor_id']), ('lead', 'Engineering', self.manager.id))
+
+        self.assertFalse(self.client.get('/employees?limit=2').streaming)
+        pieces = list(streaming.stream_json_array(({'id': n} for n in range(5)), chunk_rows=2))
+        self.assertEqual(len(pieces), 3)
+        self.assertEqual(json.loads(''.join(pieces)), [{'id': n} for n in range(5)])
+        self.assertEqual(json.loads(''.join(streaming.stream_json_array(iter(())))), [])
+
+
+class AuthenticationTests(DirectoryTestCase):
+    """The token cache answers repeat requests and forgets what logouts and edits change"""
+
+    def token_queries(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            status_code = self.client.get(path).status_code
+        return status_code, sum(Token._meta.db_table in query['sql'] for query in queries)
+
+    def test_repeat_requests_are_cached(self):
+        self.assertEqual(self.token_queries(f'/employees/{self.manager.id}'), (200, 1))
+        self.assertEqual(self.token_queries(f'/employees/{self.manager.id}'), (200, 0))
+        self.assertEqual(token_cache.get(self.token.key).principal, (self.manager.user_id, self.manager.id, self.company.id, True))
+
+    def test_logout_evicts_the_token(self):
+        self.assertEqual(self.client.get(f'/employees/{self.manager.id}').status_code, 200)
+        # Fresh instances, the class's are shared by every test
+        Token.objects.get(key=self.token.key).delete()
+        self.assertIsNone(token_cache.get(self.token.key))
+        self.assertEqual(self.client.get(f'/employees/{self.manager.id}').status_code, 401)
+
+    def test_employee_and_user_changes_evict_the_principal(self):
+        self.assertEqual(self.client.get(f'/employees/{self.manager.id}').status_code, 200)
+        manager = Employee.objects.select_related('user').get(pk=self.manager.pk)
+        manager.is_admin = False
+        manager.save()
+        self.assertIsNone(token_cache.get(self.token.key))
+        self.assertEqual(self.client.post('/employees/bulk', 'username,position,location\n', content_type='text/csv').status_code, 403)
+
+        manager.user.is_active = False
+        manager.user.save()
+        self.assertEqual(self.client.get(f'/employees/{self.manager.id}').status_code, 401)
+
+
+
+@override_settings(COMPANYTREE_PBKDF2_ITERATIONS=1000, COMPANYTREE_LOGIN_RATE_LIMIT=3)
+class LoginTests(DirectoryTestCase):
+    """Logins are rate limited per username and upgrade stale password hashes"""
+
+    def login(self, username='manager', password='password'):
+        return self.client.post('/login', {'username': username, 'password': password}, format='json')
+
+    def stored_password(self):
+        return User.objects.get(pk=self.manager.user_id).password
+
+    def test_login_hands_out_the_token(self):
+        self.assertEqual(self.login().json(), {'valid': True, 'token': self.token.key})
+        self.assertEqual(self.login(password='wrong').json(), {'valid': False})
+        # The token is remembered, and forgotten with it on logout
+        with CaptureQueriesContext(connection) as queries:
+            self.login()
+        self.assertFalse(any(Token._meta.db_table in query['sql'] for query in queries))
+        Token.objects.get(key=self.token.key).delete()
+        self.assertIsNone(login.get_cache().get(f'companytree:login-token:{self.manager.user_id}'))
+
+    def test_rate_limit_per_username(self):
+        for _ in range(3):
+            self.assertEqual(self.login(password='wrong').status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.login('MANAGER')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+        # Refused before the password is hashed or the database is read
+        self.assertEqual(len(queries), 0)
+        Token.objects.create(user=self.lead.user)
+        self.assertEqual(self.login('lead').json()['valid'], True)
+
+    def test_stale_hashes_are_upgraded(self):
+        old = self.stored_password()
+        self.assertTrue(old.startswith('pbkdf2_sha256$1000$'))
+        with override_settings(COMPANYTREE_PBKDF2_ITERATIONS=2000):
+            self.assertTrue(self.login().json()['valid'])
+        self.assertTrue(self.stored_password().startswith('pbkdf2_sha256$2000$'))
+
+        User.objects.filter(pk=self.manager.user_id).update(password=make_password('password', hasher='pbkdf2_sha1'))
+        self.assertTrue(self.login().json()['valid'])
+        self.assertTrue(self.stored_password().startswith('pbkdf2_sha256$1000$'))
+
+class FieldsetTests(DirectoryTestCase):
+    """?fields= trims every response, and no response carries a secret"""
+
+    def test_list_reads_only_the_requested_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            rows = self.read(self.client.get('/employees?fields=position'))
+        self.assertEqual(rows, [{'id': employee.id, 'position': 'Engineer'} for employee in (self.manager, self.lead, self.report)])
+        employee_query = [query['sql'] for query in queries if Employee._meta.db_table in query['sql']][-1]
+        self.assertNotIn('"location"', employee_query)
+
+    def test_details_and_pages_are_trimmed(self):
+        self.assertEqual(self.client.get(f'/employees/{self.lead.id}?fields=position').json(), {'id': self.lead.id, 'position': 'Engineer'})
+        page = self.client.get('/employees?pagination=cursor&page_size=2&fields=supervisor_id').json()
+        self.assertEqual(page['results'], [{'id': self.manager.id, 'supervisor_id': None}, {'id': self.lead.id, 'supervisor_id': self.manager.id}])
+        self.assertIsNotNone(page['next'])
+        self.assertEqual(self.client.get('/departments?fields=name').json(), [{'id': self.department.id, 'name': 'Engineering'}])
+
+    def test_secrets_are_never_sent(self):
+        for path in ('/employees', f'/employees/{self.manager.id}', '/employees?pagination=cursor', '/employees?fields=password,user'):
+            body = json.dumps(self.read(self.client.get(path)))
+            self.assertNotIn('password', body, path)
+            self.assertNotIn(self.manager.user.password, body, path)
+            self.assertNotIn(self.token.key, body, path)
+
+class ImportTests(DirectoryTestCase):
+    """Bulk imports from CSV and JSON lines"""
+
+    def post(self, body, content_type='text/csv', query=''):
+        return self.client.post(f'/employees/bulk{query}', body, content_type=content_type)
+
+    @override_settings(COMPANYTREE_IMPORT_HASH_WORKERS=2)
+    def test_passwords_are_hashed(self):
+        body = 'username,position,location,password\nann,Engineer,Remote,secret1\nbob,Engineer,Remote,secret2\ncy,Engineer,Remote,\n'
+        self.assertEqual(self.post(body).json()['created'], 3)
+        users = {user.username: user for user in User.objects.filter(username__in=['ann', 'bob', 'cy'])}
+        self.assertTrue(users['ann'].check_password('secret1'))
+        self.assertTrue(users['bob'].check_password('secret2'))
+        self.assertFalse(users['bob'].check_password('secret1'))
+        self.assertFalse(users['cy'].has_usable_password())
+
+    def employee(self, username):
+        return Employee.objects.select_related('user').get(user__username=username)
+
+    def test_csv_links_supervisors_and_reports_errors(self):
+        body = (
+            'username,position,location,department_id,supervisor_username\n'
+            f'ann,Engineer,Remote,{self.department.id},lead\n'
+            f'bob,Engineer,Remote,{self.department.id},ann\n'
+            ',Engineer,Remote,,\n'
+            'cy,Engineer,Remote,999999,\n'
+            'ann,Engineer,Remote,,\n'
+            'lead,Engineer,Remote,,\n'
+            'dee,Engineer,Remote,,nobody\n'
+        )
+        result = self.post(body, query='?batch_size=2').json()
+
+        self.assertEqual(result['created'], 3)
+        self.assertEqual([(error['row'], error['message']) for error in result['errors']], [
+            (3, 'username is required'),
+            (4, 'department 999999 does not exist'),
+            (5, 'username ann appears more than once'),
+            (6, 'username lead already exists'),
+            (7, 'supervisor nobody does not exist'),
+        ])
+        ann, bob = self.employee('ann'), self.employee('bob')
+        self.assertEqual((ann.supervisor_id, bob.supervisor_id), (self.lead.id, ann.id))
+        self.assertEqual(bob.path, f'{self.lead.path}{ann.id}/{bob.id}/')
+        self.assertReports(self.lead, 2, 3)
+        self.assertEqual(counters.department_counts(self.company.id), {self.department.id: 5})
+
+    def test_jsonl_cuts_cycles(self):
+        body = '\n'.join([
+            json.dumps({'username': 'ann', 'position': 'Engineer', 'location': 'Remote', 'supervisor_username': 'bob'}),
+            '{not json',
+            '[1, 2]',
+            '',
+            json.dumps({'username': 'bob', 'position': 'Engineer', 'location': 'Remote', 'supervisor_username': 'ann'}),
+        ])
+        result = self.post(body, 'application/x-ndjson').json()
+
+        self.assertEqual(result['created'], 2)
+        messages = {error['row']: error['message'] for error in result['errors']}
+        self.assertTrue(messages.pop(2).startswith('Invalid JSON'))
+        self.assertEqual(messages.pop(3), 'Each line must be a JSON object')
+        ann, bob = self.employee('ann'), self.employee('bob')
+        # The cycle is cut at its lowest id, ann's
+        self.assertEqual(messages, {1: f'supervisor of employee {ann.id} formed a cycle and was removed'})
+        self.assertEqual((ann.supervisor_id, bob.supervisor_id), (None, ann.id))
+        self.assertEqual(bob.path, f'/{ann.id}/{bob.id}/')
+
+    def test_command_and_admin_only(self):
+        self.assertEqual(self.post('username,position,location\n').status_code, 400)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.report.user).key}')
+        self.assertEqual(self.post('username,position,location\nann,Engineer,Remote\n').status_code, 403)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as file:
+            file.write('username,position,location\nann,Engineer,Remote\n')
+            file.flush()
+            stdout = StringIO()
+            call_command('import_employees', file.name, company=self.company.id, stdout=stdout, stderr=StringIO())
+        self.assertIn('Imported 1 employees with 0 errors', stdout.getvalue())
+        self.assertEqual(self.employee('ann').company_id, self.company.id)
+
+
+class ExportTests(DirectoryTestCase):
+    """Downloads of every employee of the company, as CSV or JSON lines, gzipped on request"""
+
+    def export(self, query):
+        response = self.client.get(f'/employees/export{query}')
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_csv_and_gzip(self):
+        create_employee(Company.objects.create(name='Globex'), 'outsider')
+
+        response, body = self.export('?output_format=csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="company-{self.company.id}-employees.csv"')
+        rows = list(csv.DictReader(StringIO(body.decode())))
+        self.assertEqual([row['username'] for row in rows], ['manager', 'lead', 'report'])
+        self.assertEqual((rows[2]['supervisor_id'], rows[2]['supervisor_username'], rows[2]['department_name']),
+                         (str(self.lead.id), 'lead', 'Engineering'))
+
+        response, body = self.export('?gzip=1')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertTrue(response['Content-Disposition'].endswith('.jsonl.gz"'))
+        lines = [json.loads(line) for line in gzip.decompress(body).decode().splitlines()]
+        self.assertEqual([line['username'] for line in lines], ['manager', 'lead', 'report'])
+        self.assertNotIn('password', lines[0])
+
+        self.assertEqual(self.client.get('/employees/export?output_format=xml').status_code, 400)
+
+
+class AsgiTests(TransactionTestCase):
+    """The async handlers answer under the same middleware, and with the same answers, as the ViewSets"""
+    # Committed rows, the handlers query from threads of their own, and outside a transaction reads go to the read alias
+    databases = {'default', 'read'}
+
+    def setUp(self):
+        reset_caches()
+        self.company = Company.objects.create(name='Acme')
+        self.department = Department.objects.create(name='Engineering', colorHex='#000000')
+        self.manager = create_employee(self.company, 'manager', department=self.department, is_admin=True)
+        self.lead = create_employee(self.company, 'lead', self.manager, self.department)
+        self.token = Token.objects.create(user=self.manager.user)
+        self.application = async_views.get_application()
+
+    def asgi(self, path, host='testserver', **headers):
+        """Status, headers and body of a GET through the ASGI application"""
+        path, _, query = path.partition('?')
+        headers = {'host': host, 'authorization': f'Token {self.token.key}', **headers}
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+            'headers': [(name.replace('_', '-').encode(), value.encode()) for name, value in headers.items() if value],
+            'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+        }
+        received = [{'type': 'http.request', 'body': b'', 'more_body': False}, {'type': 'http.disconnect'}]
+        messages = []
+
+        async def receive():
+            return received.pop(0) if received else await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+
+        run(self.application(scope, receive, send))
+        headers = {name.decode().lower(): value.decode() for name, value in messages[0]['headers']}
+        return messages[0]['status'], headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+    def wsgi(self, path, **headers):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        response = client.get(path, **{f'HTTP_{name.upper()}': value for name, value in headers.items()})
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response.status_code, response, body
+
+    def test_both_paths_answer_alike(self):
+        for path in ('/employees', f'/employees/{self.lead.id}', f'/employees/{self.manager.id}/tree?depth=1',
+                     '/departments', '/bootstrap', '/employees/0'):
+            reset_caches()
+            with mock.patch.object(async_views, 'run_db', wraps=async_views.run_db) as run_db:
+                status_code, headers, body = self.asgi(path, origin='http://localhost:3000')
+            # An employee the handler does not find is left to the ViewSet
+            self.assertTrue(run_db.called, path)
+            reset_caches()
+            wsgi_status, response, wsgi_body = self.wsgi(path, origin='http://localhost:3000')
+
+            self.assertEqual(status_code, wsgi_status, path)
+            if status_code == 200:
+                data, wsgi_data = json.loads(body), json.loads(wsgi_body)
+                if path == '/bootstrap':
+                    # A version token, the caches were cleared in between
+                    self.assertNotEqual(data.pop('version'), wsgi_data.pop('version'))
+                self.assertEqual(data, wsgi_data, path)
+                # Answered from the entry the ViewSet cached
+                headers = self.asgi(path, origin='http://localhost:3000')[1]
+                for header in ('Content-Type', 'ETag', 'Access-Control-Allow-Origin', 'X-Frame-Options', 'X-Content-Type-Options'):
+                    self.assertEqual(headers.get(header.lower()), response.get(header), (path, header))
+
+        etag = self.asgi('/departments')[1]['etag']
+        self.assertEqual(self.asgi('/departments', if_none_match=etag)[0], 304)
+        self.assertEqual(self.wsgi('/departments', if_none_match=etag)[0], 304)
+
+    def test_hosts_and_tokens_are_checked_by_the_middleware(self):
+        for path in ('/employees', '/events'):
+            self.assertEqual(self.asgi(path, host='evil.example')[0], 400, path)
+        self.assertEqual(self.asgi('/events', authorization='')[0], 401)
+        # A WebSocket refused by the middleware is closed before it is accepted
+        for host, first_message in (('evil.example', 'websocket.close'), ('testserver', 'websocket.accept')):
+            scope = {
+                'type': 'websocket', 'path': '/events', 'query_string': f'token={self.token.key}'.encode(),
+                'headers': [(b'host', host.encode())], 'scheme': 'ws', 'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+            }
+            received = [{'type': 'websocket.connect'}, {'type': 'websocket.disconnect'}]
+            messages = []
+
+            async def receive():
+                return received.pop(0) if received else await asyncio.Event().wait()
+
+            async def send(message):
+                messages.append(message)
+
+            run(self.application(scope, receive, send))
+            self.assertEqual(messages[0]['type'], first_message, host)
+        # Without a token the handler leaves the request to the ViewSet
+        with mock.patch.object(async_views, 'run_db') as run_db, mock.patch('companytreeAPI.views.employee.Employees.list', return_value=HttpResponse(status=418)):
+            self.assertEqual(self.asgi('/employees', authorization='')[0], 418)
+        run_db.assert_not_called()
+
+        status_code, headers, body = self.asgi(f'/events?token={self.token.key}', authorization='', origin='http://localhost:3000')
+        self.assertEqual((status_code, headers['content-type']), (200, 'text/event-stream'))
+        self.assertEqual(headers['access-control-allow-origin'], 'http://localhost:3000')
+        self.assertIn(b'event: ready', body)
+
+    @override_settings(COMPANYTREE_METRICS=True)
+    def test_metrics_count_the_async_requests(self):
+        metrics.registry.reset()
+        self.application = async_views.get_application()
+        status_code, headers, _ = self.asgi('/departments')
+        self.assertEqual(status_code, 200)
+        self.assertIn('Server-Timing', {name.title(): value for name, value in headers.items()})
+        self.assertEqual(list(metrics.registry.endpoints), [('Departments', 'list')])
+        self.assertGreater(metrics.registry.endpoints['Departments', 'list'].queries.sum, 0)
+
+
+class SyntheticTests(TestCase):
+    """The synthetic data generator"""
+
+    def test_seed_departments_returns_only_new_rows(self):
+        first = synthetic.seed_departments('Acme', 3)
+        second = synthetic.seed_departments('Acme', 2)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertGreater(min(second), max(first))
+        self.assertEqual(list(Department.objects.filter(pk__in=second).values_list('name', flat=True)), ['Acme 1', 'Acme 2'])
+
+class BootstrapTests(DirectoryTestCase):
+    """One request for the startup data, and only the sections changed since the client's token"""
+
+    def bootstrap(self, query=''):
+        return self.client.get(f'/bootstrap{query}')
+
+    def test_sections_and_tokens(self):
+        # Leave no invalidation of the fixtures pending
+        run_commit_hooks()
+        with CaptureQueriesContext(connection) as queries:
+            body = self.bootstrap().json()
+        # The token, the company, the departments and their counts, the employees; self is picked out of them
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('SELECT')]), 5)
+        self.assertEqual(list(body), ['version', 'company', 'departments', 'employees', 'self', 'unchanged'])
+        self.assertEqual(body['company']['name'], 'Acme')
+        self.assertEqual(body['departments'], [{'id': self.department.id, 'name': 'Engineering', 'colorHex': '#000000', 'employee_count': 3}])
+        self.assertEqual([row['id'] for row in body['employees']], [self.manager.id, self.lead.id, self.report.id])
+        self.assertEqual(body['self'], body['employees'][0])
+        self.assertEqual(body['unchanged'], [])
+
+        self.assertEqual(self.bootstrap(f'?since={body["version"]}').json(), {'version': body['version'], 'unchanged': list(bootstrap.SECTIONS)})
+
+        # Global changes only leave the company's own sections unchanged
+        Department.objects.create(name='Sales', colorHex='#ffffff')
+        run_commit_hooks()
+        changed = self.bootstrap(f'?since={body["version"]}&include=departments,self').json()
+        self.assertEqual([department['name'] for department in changed['departments']], ['Engineering', 'Sales'])
+        self.assertNotIn('self', changed)
+        self.assertEqual(changed['unchanged'], ['self'])
+
+        self.assertEqual(self.bootstrap('?include=self&fields=position').json()['self'], {'id': self.manager.id, 'position': 'Engineer'})
+
+        self.assertEqual(self.bootstrap('?include=everything').status_code, 400)
+        self.assertEqual(self.bootstrap('?fields=password').status_code, 400)
+
+
+class CacheTests(DirectoryTestCase):
+    """Cached responses follow the committed data"""
+
+    def test_version_moves_on_commit(self):
+        before = cache.version_token(self.company.id)
+        self.report.position = 'Architect'
+        self.report.save()
+        # A request reading before the commit sees the old row, and caches it under the old version
+        self.assertEqual(cache.version_token(self.company.id), before)
+        run_commit_hooks()
+        self.assertNotEqual(cache.version_token(self.company.id), before)
+
+    def test_cached_list_follows_changes(self):
+        first = self.client.get('/employees?fields=id,position')
+        self.assertEqual(self.client.get('/employees?fields=id,position', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        self.report.position = 'Architect'
+        self.report.save()
+        run_commit_hooks()
+
+        response = self.client.get('/employees?fields=id,position', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn({'id': self.report.id, 'position': 'Architect'}, self.read(response))
+
+    def test_only_directory_fields_of_users_invalidate(self):
+        run_commit_hooks()
+        before, cursor = cache.version_token(self.company.id), changes.cursor()
+        user = User.objects.get(pk=self.report.user_id)
+        # What a login saves when it rehashes the password
+        user.set_password('rehashed')
+        user.save(update_fields=['password', 'last_login'])
+        user.save()
+        run_commit_hooks()
+        self.assertEqual((cache.version_token(self.company.id), changes.cursor()), (before, cursor))
+
+        user.first_name = 'Renamed'
+        user.save()
+        run_commit_hooks()
+        self.assertNotEqual(cache.version_token(self.company.id), before)
+        self.assertGreater(changes.cursor(), cursor)
+
+
+class AnalyticsTests(DirectoryTestCase):
+    """Aggregates of the caller's company, with the reporting trees walked in one query"""
+
+    def test_company_aggregates(self):
+        with CaptureQueriesContext(connection) as queries:
+            body = self.client.get('/analytics').json()
+        self.assertEqual(sum('RECURSIVE' in query['sql'] for query in queries), 1)
+        self.assertEqual(body['headcount'], 3)
+        self.assertEqual(body['departments'], [{'department_id': self.department.id, 'name': 'Engineering', 'headcount': 3}])
+        self.assertEqual(body['locations'], [{'location': 'Remote', 'headcount': 3}])
+        self.assertEqual(body['supervisors'], [
+            {'employee_id': self.manager.id, 'direct_reports': 1, 'total_reports': 2},
+            {'employee_id': self.lead.id, 'direct_reports': 1, 'total_reports': 1},
+        ])
+        self.assertEqual(body['depth'], {
+            'max': 2, 'mean': 1.0, 'mean_direct_reports': 1.0,
+            'headcount_by_level': [{'depth': level, 'headcount': 1} for level in range(3)],
+        })
+
+    def test_trees_stay_in_the_company(self):
+        # Older rows can report across companies, the walk must not follow them
+        globex = Company.objects.create(name='Globex')
+        spy = create_employee(globex, 'spy', department=self.department)
+        Employee.objects.filter(pk=spy.pk).update(supervisor_id=self.report.id)
+
+        body = self.client.get('/analytics').json()
+        self.assertEqual(body['headcount'], 3)
+        self.assertEqual([row['employee_id'] for row in body['supervisors']], [self.manager.id, self.lead.id])
+        self.assertEqual(body['depth']['max'], 2)
+        self.assertEqual(counters.recount_company(self.company.id, repair=False), [])
+
+
+class CounterTests(DirectoryTestCase):
+    """Maintained counters follow every move and delete, per company"""
+
+    def department_counts(self):
+        return {row['name']: row['employee_count'] for row in self.client.get('/departments').json()}
+
+    def test_counts_follow_moves_and_deletes(self):
+        sales = Department.objects.create(name='Sales', colorHex='#ffffff')
+        other = create_employee(self.company, 'other', self.manager, self.department)
+        self.assertReports(self.manager, 2, 3)
+
+        self.assertEqual(self.update(self.report, supervisor_id=other.id, department_id=sales.id).status_code, 204)
+        self.assertReports(self.manager, 2, 3)
+        self.assertReports(self.lead, 0, 0)
+        self.assertReports(other, 1, 1)
+        run_commit_hooks()
+        self.assertEqual(self.department_counts(), {'Engineering': 3, 'Sales': 1})
+
+        # The report moves up to the manager
+        self.assertEqual(self.client.delete(f'/employees/{other.id}').status_code, 204)
+        self.assertReports(self.manager, 2, 2)
+        self.report.refresh_from_db()
+        self.assertEqual(self.report.path, f'/{self.manager.id}/{self.report.id}/')
+        run_commit_hooks()
+        self.assertEqual(self.department_counts(), {'Engineering': 2, 'Sales': 1})
+        self.assertEqual(counters.recount_company(self.company.id, repair=False), [])
+
+    def test_counts_are_per_company(self):
+        globex = Company.objects.create(name='Globex')
+        create_employee(globex, 'founder', department=self.department)
+        run_commit_hooks()
+        self.assertEqual(self.department_counts(), {'Engineering': 3})
+
+        global_version = cache.version(cache.GLOBAL_SCOPE)
+        company_version = cache.version(cache.COMPANY_SCOPE, self.company.id)
+        cursor = changes.cursor()
+        create_employee(globex, 'hire', department=self.department)
+        run_commit_hooks()
+
+        # Another company's hire changes nothing this company can read
+        self.assertEqual(cache.version(cache.GLOBAL_SCOPE), global_version)
+        self.assertEqual(cache.version(cache.COMPANY_SCOPE, self.company.id), company_version)
+        self.assertEqual(self.client.get(f'/changes?since={cursor}').json(), {'cursor': cursor, 'more': False})
+        self.assertEqual(counters.department_counts(globex.id), {self.department.id: 2})
+
+    def test_admins_only_edit_their_company(self):
+        globex = Company.objects.create(name='Globex')
+        founder = create_employee(globex, 'founder', department=self.department)
+        hire = create_employee(globex, 'hire', founder, self.department)
+
+        self.assertEqual(self.update(hire, supervisor_id=None, position='Spy').status_code, 404)
+        self.assertEqual(self.client.delete(f'/employees/{hire.id}').status_code, 404)
+
+        hire.refresh_from_db()
+        self.assertEqual((hire.company_id, hire.supervisor_id, hire.position), (globex.id, founder.id, 'Engineer'))
+        self.assertReports(founder, 1, 1)
+        self.assertEqual(counters.recount_company(globex.id, repair=False), [])
+
+    def test_recount_repairs_drift(self):
+        DepartmentCount.objects.filter(company=self.company).update(employee_count=7)
+        Employee.objects.filter(pk=self.manager.pk).update(total_report_count=0)
+
+        drift = counters.recount_company(self.company.id)
+
+        self.assertEqual(sorted((model, field, stored, actual) for model, _, field, stored, actual in drift), [
+            ('Department', f'employee_count in company {self.company.id}', 7, 3),
+            ('Employee', 'total_report_count', 0, 2),
+        ])
+        self.assertReports(self.manager, 1, 2)
+        self.assertEqual(counters.department_counts(self.company.id), {self.department.id: 3})
+        self.assertEqual(counters.recount_company(self.company.id), [])
+
+
+class ReadAliasTests(TransactionTestCase):
+    """The list and retrieve actions read from the read alias, everything else from the default database"""
+    # Outside a transaction, where reads leave the default alias
+    databases = {'default', 'read'}
+
+    def setUp(self):
+        reset_caches()
+        company = Company.objects.create(name='Acme')
+        self.manager = create_employee(company, 'manager', is_admin=True)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.manager.user).key}')
+
+    def aliases(self, method, path, **kwargs):
+        """The aliases that ran the queries of a request"""
+        with CaptureQueriesContext(connections['default']) as default, CaptureQueriesContext(connections['read']) as read:
+            response = getattr(self.client, method)(path, **kwargs)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 300, path)
+        return {alias for alias, queries in (('default', default), ('read', read)) if queries.captured_queries}
+
+    def test_reads_go_to_the_read_alias(self):
+        # Tokens are read outside the action, answer them from the token cache
+        self.client.get('/departments')
+        self.assertEqual(self.aliases('get', '/employees'), {'read'})
+        self.assertEqual(self.aliases('get', f'/employees/{self.manager.id}'), {'read'})
+        self.assertEqual(self.aliases('get', f'/employees/{self.manager.id}/tree'), {'default'})
+        data = {
+            'department_id': None, 'supervisor_id': None, 'position': 'Boss', 'location': 'Remote', 'bio': None,
+            'image_url': None, 'tasks': None, 'phone': None, 'slack': None, 'is_admin': True,
+        }
+        self.assertEqual(self.aliases('put', f'/employees/{self.manager.id}', data=data, format='json'), {'default'})
+        self.assertFalse(db.is_reading())
+
+        with db.reading():
+            self.assertEqual(db.read_alias(), 'read')
+            with transaction.atomic():
+                # A transaction reads its own writes
+                self.assertEqual(db.read_alias(), 'default')
+
+
+class MetricsTests(DirectoryTestCase):
+    """Per-view request metrics, in the Server-Timing header and on /metrics when enabled"""
+
+    def setUp(self):
+        super().setUp()
+        metrics.registry.reset()
+
+    @override_settings(COMPANYTREE_METRICS=True, COMPANYTREE_METRICS_N_PLUS_ONE=100)
+    def test_requests_are_measured(self):
+        # A new client loads the middleware with the settings in effect
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        response = self.client.get('/departments')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", render;dur=[\d.]+, total;dur=[\d.]+$')
+        # Streamed bodies are measured once the client has read them
+        self.read(self.client.get('/employees'))
+        self.client.get('/employees?limit=1')
+
+        endpoint = metrics.registry.endpoints['Employees', 'list']
+        self.assertEqual((endpoint.requests, endpoint.duration.count), ({200: 2}, 2))
+        self.assertGreater(endpoint.response_bytes, 0)
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('companytree_requests_total{view="Employees",action="list",status="200"} 2', body)
+        self.assertIn('companytree_requests_total{view="Departments",action="list",status="200"} 1', body)
+        self.assertIn('# TYPE companytree_request_duration_seconds histogram', body)
+
+        with override_settings(COMPANYTREE_METRICS_N_PLUS_ONE=1), self.assertLogs('companytreeAPI.metrics', 'WARNING') as logs:
+            self.client.get(f'/employees/{self.lead.id}')
+        self.assertIn('Possible N+1 queries: Employees.retrieve', logs.output[0])
+
+    def test_metrics_are_off_by_default(self):
+        response = self.client.get('/departments')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class ChangeFeedTests(DirectoryTestCase):
+    """/changes pages through what changed after a cursor, with tombstones for deleted rows"""
+
+    def changes(self, query):
+        return self.client.get(f'/changes{query}')
+
+    def test_paging_deletes_and_expiry(self):
+        start = self.changes('').json()['cursor']
+        self.assertEqual(self.update(self.lead, position='Lead').status_code, 204)
+        hobby = EmployeeHobby.objects.create(employee=self.report, hobby='Chess')
+        self.assertEqual(self.client.delete(f'/employees/{self.report.id}').status_code, 204)
+
+        page = self.changes(f'?since={start}&limit=1&fields=position').json()
+        self.assertEqual((page['more'], page['employees']), (True, [{'id': self.lead.id, 'position': 'Lead'}]))
+        pages = [page]
+        while pages[-1]['more']:
+            pages.append(self.changes(f'?since={pages[-1]["cursor"]}&limit=1').json())
+        self.assertEqual(pages[-1]['cursor'], changes.cursor())
+
+        # The report and their hobby were deleted after being changed: tombstones only
+        whole = self.changes(f'?since={start}').json()
+        self.assertEqual(whole['deleted'], {'employees': [self.report.id], 'hobbies': [hobby.id]})
+        # The manager's report counters changed with the delete
+        self.assertEqual([row['id'] for row in whole['employees']], [self.manager.id, self.lead.id])
+        self.assertNotIn('hobbies', whole)
+        self.assertEqual(self.changes(f'?since={whole["cursor"]}').json(), {'cursor': whole['cursor'], 'more': False})
+
+        self.assertEqual(self.changes('?since=-1').status_code, 400)
+        self.assertEqual(self.changes('?since=x').status_code, 400)
+        Change.objects.filter(id__lte=whole['cursor'] - 1).delete()
+        response = self.changes(f'?since={start}')
+        self.assertEqual(response.status_code, 410)
+        self.assertIn('no longer kept', response.json()['message'])
+
+    def test_pushed_events_carry_the_cursor(self):
+        with mock.patch.object(push, '_send') as send:
+            self.assertEqual(self.update(self.lead, position='Lead').status_code, 204)
+            run_commit_hooks()
+        company_id, event, _ = send.call_args.args
+        self.assertEqual((company_id, event['type']), (self.lead.company_id, push.CHANGES))
+        self.assertEqual(event['cursor'], changes.cursor())
+        self.assertEqual(self.changes(f'?since={event["cursor"]}').json()['more'], False)
+
+
+class LayoutTests(DirectoryTestCase):
+    """The org chart survives supervisor cycles in the data"""
+
+    def test_update_into_a_cycle_asks_for_a_rebuild(self):
+        tree = layout.Tree([(1, None), (2, 1), (3, 2)])
+        self.assertFalse(tree.update([(1, 3)], []))
+
+    def test_cycle_is_cut_on_rebuild(self):
+        self.assertEqual(self.client.get('/layout').json()['count'], 3)
+        # Written around the hierarchy checks, the way a bad import or a race could leave it
+        changes.update(Employee.objects.filter(pk=self.manager.pk), supervisor_id=self.report.id)
+        run_commit_hooks()
+
+        chart = self.client.get('/layout').json()
+        self.assertEqual(
+            {node['id']: node['supervisor_id'] for node in chart['nodes']},
+            {self.manager.id: None, self.lead.id: self.manager.id, self.report.id: self.lead.id},
+        )
+
+
+class HobbyTests(DirectoryTestCase):
+    """Hobbies come and go with their employees"""
+
+    def test_delete_employee_with_hobbies(self):
+        EmployeeHobby.objects.create(employee=self.report, hobby='Chess')
+        EmployeeHobby.objects.create(employee=self.report, hobby='go')
+        EmployeeHobby.objects.create(employee=self.lead, hobby='chess')
+        self.assertEqual(self.client.get('/hobbies').json(), [{'hobby': 'chess', 'employees': 2}, {'hobby': 'go', 'employees': 1}])
+
+        response = self.client.delete(f'/employees/{self.report.id}')
+        run_commit_hooks()
+
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Employee.objects.filter(pk=self.report.id).exists())
+        self.assertFalse(EmployeeHobby.objects.filter(employee_id=self.report.id).exists())
+        self.assertEqual(self.client.get('/hobbies').json(), [{'hobby': 'chess', 'employees': 1}])
+        self.assertEqual(self.client.get('/hobbies/employees?hobby=chess&fields=id').json(), [{'id': self.lead.id}])
+
+    def batch(self, **body):
+        return self.client.post('/hobbies/batch', body, format='json')
+
+    def test_batch_dedupes_spellings(self):
+        response = self.batch(add=['Chess', '  chess ', 'Go'])
+        self.assertEqual([row['hobby'] for row in response.json()['added']], ['Chess', 'Go'])
+        self.assertEqual(self.batch(add=['GO', 'Tennis']).json()['added'][0]['hobby'], 'Tennis')
+
+        EmployeeHobby.objects.create(employee=self.lead, hobby='Chess')
+        EmployeeHobby.objects.create(employee=self.lead, hobby='CHESS')
+        response = self.batch(employee_id=self.lead.id, add=['go'], remove=['chess'])
+        self.assertEqual((response.json()['removed'], len(response.json()['added'])), (2, 1))
+        run_commit_hooks()
+
+        self.assertEqual(sorted(EmployeeHobby.objects.filter(employee=self.manager).values_list('hobby', flat=True)), ['Chess', 'Go', 'Tennis'])
+        self.assertEqual(list(EmployeeHobby.objects.filter(employee=self.lead).values_list('hobby', flat=True)), ['go'])
+        self.assertEqual(self.client.get('/hobbies').json(), [
+            {'hobby': 'Go', 'employees': 2}, {'hobby': 'Chess', 'employees': 1}, {'hobby': 'Tennis', 'employees': 1},
+        ])
+        self.assertEqual(self.batch(add=['']).status_code, 400)
+
+    def test_only_admins_edit_other_employees(self):
+        hobby = EmployeeHobby.objects.create(employee=self.report, hobby='Chess')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.lead.user).key}')
+
+        self.assertEqual(self.batch(employee_id=self.report.id, add=['Go']).status_code, 403)
+        self.assertEqual(self.client.post('/hobbies', {'employee_id': self.report.id, 'hobby': 'Go'}, format='json').status_code, 403)
+        self.assertEqual(self.client.delete(f'/hobbies/{hobby.id}').status_code, 403)
+        self.assertEqual(list(EmployeeHobby.objects.values_list('hobby', flat=True)), ['Chess'])
+
+        self.assertEqual(self.batch(add=['Go']).status_code, 200)
+        self.assertEqual(list(EmployeeHobby.objects.filter(employee=self.lead).values_list('hobby', flat=True)), ['Go'])
+
+    def test_colleagues_by_shared_hobbies(self):
+        other = create_employee(self.company, 'other', self.manager, self.department)
+        for employee, names in ((self.manager, 'Chess Go Tennis'), (self.lead, 'chess go'), (self.report, 'Chess'), (other, 'tennis')):
+            for name in names.split():
+                EmployeeHobby.objects.create(employee=employee, hobby=name)
+
+        def colleagues(query=''):
+            reset_caches()
+            rows = self.client.get(f'/hobbies/colleagues?fields=id{query}').json()
+            return [(row['id'], row['shared'], row['hobbies']) for row in rows]
+
+        expected = [(self.lead.id, 2, ['Chess', 'Go']), (self.report.id, 1, ['Chess']), (other.id, 1, ['Tennis'])]
+        self.assertEqual(colleagues(), expected)
+        self.assertEqual(colleagues('&limit=2'), expected[:2])
+        self.assertEqual(colleagues(f'&employee={other.id}'), [(self.manager.id, 1, ['Tennis'])])
+        self.assertEqual(self.client.get('/hobbies/colleagues?limit=0').status_code, 400)
+        # Without bitsets kept for any hobby they are packed from the arrays per query
+        with mock.patch.object(hobbies, 'DENSE_RATIO', 0.01):
+            self.assertEqual(colleagues(), expected)
+            self.assertEqual(hobbies.company_index(self.company.id).bitsets, {})
+
+    def test_index_applies_changes(self):
+        EmployeeHobby.objects.create(employee=self.lead, hobby='Chess')
+        run_commit_hooks()
+        index = hobbies.company_index(self.company.id)
+
+        with mock.patch.object(hobbies.HobbyIndex, '_read', autospec=True, side_effect=hobbies.HobbyIndex._read) as read:
+            EmployeeHobby.objects.create(employee=self.report, hobby='chess')
+            EmployeeHobby.objects.filter(employee=self.lead).delete()
+            EmployeeHobby.objects.create(employee=self.manager, hobby='Go')
+            run_commit_hooks()
+            self.assertIs(hobbies.company_index(self.company.id), index)
+            self.assertEqual(read.call_count, 0)
+            self.assertEqual(index.hobbies(), [('Go', 1), ('chess', 1)])
+            self.assertEqual(index.colleagues(self.report.id), [])
+
+            # A pruned cursor reads the company again
+            EmployeeHobby.objects.create(employee=self.manager, hobby='Chess')
+            run_commit_hooks()
+            with mock.patch.object(changes, 'since', side_effect=changes.CursorExpired):
+                hobbies.company_index(self.company.id)
+            self.assertEqual(read.call_count, 1)
+            self.assertEqual(index.hobbies(), [('Chess', 2), ('Go', 1)])
+            self.assertEqual(index.colleagues(self.report.id), [(self.manager.id, ['Chess'])])
+
+
+
+
+# The second database of ShardTests, an in-memory SQLite database handing out ids from SHARD_ID_SPAN
+SHARD = 'shard'
+SHARD_ID_SPAN = 10 ** 6
+
+
+class ShardTests(DirectoryTestCase):
+    """Acme in the default database and Globex in a second one"""
+    databases = {'default', SHARD}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sharded = override_settings(
+            COMPANYTREE_SHARDS=['default', SHARD], COMPANYTREE_SHARD_ID_SPAN=SHARD_ID_SPAN, COMPANYTREE_TENANT_CACHE_TTL=0,
+        )
+        cls.sharded.enable()
+        connections.databases[SHARD] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        connections[SHARD].creation.create_test_db(verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[SHARD].creation.destroy_test_db(':memory:', verbosity=0)
+        del connections[SHARD]
+        del connections.databases[SHARD]
+        cls.sharded.disable()
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        with tenancy.using(SHARD):
+            cls.globex = Company.objects.create(name='Globex')
+            tenancy.register(cls.globex.id, SHARD)
+            cls.hank = create_employee(cls.globex, 'hank', department=cls.department, is_admin=True)
+            Token.objects.create(user=cls.hank.user)
+
+    def login(self, username):
+        response = self.client.post('/login', {'username': username, 'password': 'password'}, format='json')
+        self.assertTrue(response.json()['valid'])
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {response.json()["token"]}')
+        return client
+
+    def company_names(self, query=''):
+        return [company['name'] for company in self.client.get(f'/companies{query}').json()]
+
+    def move(self, company, alias, during=lambda: None):
+        """Run manage.py move_company, calling during() while the company is in both databases"""
+        with mock.patch('companytreeAPI.management.commands.move_company.time.sleep', side_effect=lambda _: during()):
+            call_command('move_company', company.id, alias, stdout=StringIO(), stderr=StringIO())
+        run_commit_hooks()
+        reset_caches()
+
+    def test_routing(self):
+        self.assertEqual(tenancy.user_database('manager'), 'default')
+        self.assertEqual(tenancy.user_database('hank'), SHARD)
+        self.assertFalse(Company.objects.using('default').filter(pk=self.globex.id).exists())
+
+        hank = self.login('hank')
+        self.assertEqual(self.read(hank.get('/employees?fields=id')), [{'id': self.hank.id}])
+        self.assertEqual(hank.get(f'/departments/{self.department.id}').json()['employee_count'], 1)
+        self.assertEqual(self.client.get(f'/departments/{self.department.id}').json()['employee_count'], 3)
+
+    def test_id_ranges(self):
+        self.assertLess(max(self.company.id, self.manager.id, self.manager.user_id), SHARD_ID_SPAN)
+        self.assertGreater(min(self.globex.id, self.hank.id, self.hank.user_id), SHARD_ID_SPAN)
+        self.assertEqual(tenancy.id_range(SHARD), (SHARD_ID_SPAN, None))
+
+        # SQLite would hand out ids after Globex's in the default database's range
+        with self.assertRaisesMessage(CommandError, 'above the range of default'):
+            self.move(self.globex, 'default')
+
+    def test_fan_out_merges_databases(self):
+        self.assertEqual(self.company_names(), ['Acme', 'Globex'])
+        self.assertEqual(self.company_names('?limit=1'), ['Acme'])
+        self.assertEqual(self.company_names('?search=globex'), ['Globex'])
+
+        first = self.client.get('/companies?pagination=cursor&page_size=1').json()
+        second = self.client.get(first['next']).json()
+        self.assertEqual([company['name'] for company in first['results'] + second['results']], ['Acme', 'Globex'])
+        self.assertIsNone(second['next'])
+
+    def test_move_company(self):
+        seen = []
+
+        def during():
+            # Both databases hold Acme, only the registered one answers for it
+            seen.append(Tenant.objects.get(company_id=self.company.id).database)
+            reset_caches()
+            self.assertTrue(Company.objects.using(SHARD).filter(pk=self.company.id).exists())
+            self.assertEqual(self.company_names(), ['Acme', 'Globex'])
+            self.assertEqual(self.company_names('?limit=2'), ['Acme', 'Globex'])
+            page = self.client.get('/companies?pagination=cursor&page_size=1').json()
+            self.assertEqual([company['name'] for company in page['results']], ['Acme'])
+            self.assertEqual([company['name'] for company in self.client.get(page['next']).json()['results']], ['Globex'])
+            self.assertEqual(tenancy.user_database('manager'), seen[-1])
+            self.assertEqual(self.read(self.login('manager').get('/employees?fields=id'))[0], {'id': self.manager.id})
+            call_command('recount', check=True, stdout=StringIO())
+
+        self.move(self.company, SHARD, during)
+
+        self.assertEqual(seen, ['default', SHARD])
+        self.assertFalse(Company.objects.using('default').filter(pk=self.company.id).exists())
+        self.assertEqual(Employee.objects.using(SHARD).filter(company_id=self.company.id).count(), 3)
+        self.assertEqual(self.company_names(), ['Acme', 'Globex'])
+        # The company keeps its ids, so tokens and cursors its clients hold stay valid
+        self.assertEqual(self.read(self.client.get('/employees?fields=id'))[0], {'id': self.manager.id})
+        self.assertEqual(self.client.get(f'/departments/{self.department.id}').json()['employee_count'], 3)
+        self.assertEqual(
+            set(DepartmentCount.objects.using(SHARD).values_list('company_id', 'employee_count')),
+            {(self.company.id, 3), (self.globex.id, 1)},
+        )
+
+@skipUnless(search_index.uses_fts(), 'Ranks with FTS5')
+class SearchTests(TestCase):
+    """Ranking looks at every match, not only the first ones in the index"""
+
+    def test_best_match_after_many_weak_ones(self):
+        filler = ' '.join(['lorem'] * 50)
+        weak = [(object_id, None, f'Office {object_id}', f'widget {filler}') for object_id in range(1, 2001)]
+        search_index._write(search_index.DEPARTMENT, weak)
+        search_index._write(search_index.DEPARTMENT, [(5000, None, 'Warehouse', 'widget widget widget')])
+
+        results = search_index.search('widget', kinds=(search_index.DEPARTMENT,), limit=3)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], (search_index.DEPARTMENT, 5000, 'Warehouse'))
+
+@skipUnless(connection.vendor == 'sqlite', 'Reads SQLite query plans')
+class QueryPlanTests(TestCase):
+    """Every query of the hot read paths must find its rows through an index"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='Acme')
+        cls.department = Department.objects.create(name='Engineering', colorHex='#000000')
+        cls.manager = cls.employee('manager', None, is_admin=True)
+        cls.report = cls.employee('report', cls.manager)
+        EmployeeHobby.objects.create(employee=cls.report, hobby='chess')
+        cls.token = Token.objects.create(user=cls.manager.user)
+
+    @classmethod
+    def employee(cls, username, supervisor, is_admin=False):
+        user = User.objects.create_user(username=username, password='password', first_name=username, last_name='Smith')
+        return Employee.objects.create(
+            user=user, company=cls.company, department=cls.department, supervisor=supervisor,
+            position='Engineer', location='Remote', is_admin=is_admin,
+        )
+
+    def setUp(self):
+        reset_caches()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def assertIndexed(self, queries):
+        self.assertTrue(queries, 'No queries were run')
+        for query in queries:
+            self.assertEqual(full_scans(query['sql']), [], query['sql'])
+
+    def assertRequestIndexed(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200, path)
+        self.assertIndexed(queries.captured_queries)
+
+    def test_detects_full_scans(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(Employee.objects.filter(bio='unindexed'))
+        self.assertEqual(full_scans(queries.captured_queries[0]['sql']), ['SCAN companytreeAPI_employee'])
+
+    def test_employee_list(self):
+        self.assertRequestIndexed('/employees')
+
+    def test_employee_pages(self):
+        self.assertRequestIndexed('/employees?limit=1&offset=1')
+        self.assertRequestIndexed('/employees?pagination=cursor&page_size=1')
+
+    def test_employee_search(self):
+        self.assertRequestIndexed('/employees?search=report')
+        self.assertRequestIndexed('/search?q=engineering')
+
+    def test_employee_detail(self):
+        self.assertRequestIndexed(f'/employees/{self.report.id}')
+
+    def test_reporting_tree(self):
+        self.assertRequestIndexed(f'/employees/{self.manager.id}/tree')
+        self.assertRequestIndexed(f'/employees/{self.report.id}/tree?direction=up')
+
+    def test_bootstrap(self):
+        self.assertRequestIndexed('/bootstrap')
+
+    def test_analytics(self):
+        self.assertRequestIndexed('/analytics')
+
+    def test_department_and_company_pages(self):
+        self.assertRequestIndexed('/departments?pagination=cursor')
+        self.assertRequestIndexed('/companies?pagination=cursor')
+
+    def test_change_feed(self):
+        self.assertRequestIndexed('/changes?since=0')
+
+    def test_layout(self):
+        self.assertRequestIndexed('/layout?fields=first_name')
+
+    def test_hobby_index(self):
+        self.assertRequestIndexed('/hobbies')
+        EmployeeHobby.objects.create(employee=self.manager, hobby='Chess')
+        run_commit_hooks()
+        self.assertRequestIndexed('/hobbies/employees?hobby=chess')
+        self.assertRequestIndexed(f'/hobbies/colleagues?employee={self.report.id}')
+
+    def test_employees_by_hobby(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(EmployeeHobby.objects.filter(hobby='chess').values_list('employee_id', flat=True))
+        self.assertIndexed(queries.captured_queries)
+
+
+SUBSCRIBERS = 5000
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 30))
+
+
+async def until(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+class FakeClient:
+    """One side of a simulated /events connection"""
+
+    def __init__(self, stall_after=None):
+        self.messages = []
+        self.gone = asyncio.Event()
+        self.stall_after = stall_after
+
+    async def receive(self):
+        await self.gone.wait()
+        return {'type': 'http.disconnect'} if self.kind == 'sse' else {'type': 'websocket.disconnect'}
+
+    async def send(self, message):
+        if self.stall_after is not None and len(self.messages) >= self.stall_after:
+            await asyncio.Event().wait()
+        self.messages.append(message)
+
+    def events(self):
+        if self.kind == 'sse':
+            return [message['body'] for message in self.messages[1:] if message.get('body')]
+        return [message['text'] for message in self.messages if 'text' in message]
+
+
+@override_settings(COMPANYTREE_PUSH_BACKEND='companytreeAPI.push.LocalBackend')
+class PushTests(SimpleTestCase):
+    """Change events reach every subscriber without a slow one holding up the others"""
+
+    def test_fan_out_to_thousands_of_subscribers(self):
+        async def scenario():
+            broker = push.Broker()
+            backend = push.LocalBackend(broker)
+            subscriptions = [broker.subscribe(index % 10) for index in range(SUBSCRIBERS)]
+
+            async def read(subscription):
+                # Company 3 gets its employee change and the shared department change
+                count = 2 if subscription.company_id == 3 else 1
+                return [await subscription.get(5) for _ in range(count)]
+
+            readers = [asyncio.ensure_future(read(subscription)) for subscription in subscriptions]
+            await asyncio.sleep(0)
+            employee = {'type': push.CHANGES, 'changes': [{'kind': 'employee', 'id': 1, 'deleted': False}]}
+            department = {'type': push.CHANGES, 'changes': [{'kind': 'department', 'id': 1, 'deleted': False}]}
+            backend.publish(3, employee)
+            backend.publish(None, department)
+            received = await asyncio.gather(*readers)
+
+            for subscription, events in zip(subscriptions, received):
+                expected = [employee, department] if subscription.company_id == 3 else [department]
+                self.assertEqual(events, expected)
+                self.assertTrue(subscription.queue.empty())
+            for subscription in subscriptions:
+                broker.unsubscribe(subscription)
+            self.assertEqual(broker.count(), 0)
+
+        run(scenario())
+
+    @override_settings(COMPANYTREE_PUSH_QUEUE_SIZE=5)
+    def test_slow_subscriber_is_told_to_resync(self):
+        async def scenario():
+            broker = push.Broker()
+            slow = broker.subscribe(1)
+            fast = [broker.subscribe(1) for _ in range(SUBSCRIBERS // 5)]
+
+            async def read(subscription):
+                return [(await subscription.get(5))['id'] for _ in range(50)]
+
+            readers = [asyncio.ensure_future(read(subscription)) for subscription in fast]
+            for event_id in range(50):
+                broker.deliver(1, {'type': push.CHANGES, 'id': event_id})
+                # Bursts shorter than the queue, which the fast readers drain in between
+                if event_id % 4 == 3:
+                    await until(lambda: all(subscription.queue.empty() for subscription in fast))
+
+            for events in await asyncio.gather(*readers):
+                self.assertEqual(events, list(range(50)))
+            self.assertLessEqual(slow.queue.qsize(), 5)
+            self.assertEqual(slow.queue.get_nowait(), {'type': push.RESYNC})
+            self.assertGreater(slow.dropped, 0)
+
+        run(scenario())
+
+    @override_settings(COMPANYTREE_PUSH_HEARTBEAT=0.2)
+    def test_sse_and_websocket_clients(self):
+        async def scenario():
+            broker = push.get_broker()
+            clients = []
+            for index in range(SUBSCRIBERS // 2):
+                client = FakeClient()
+                client.kind = 'sse' if index % 2 else 'websocket'
+                serve = async_views.stream_events if client.kind == 'sse' else async_views.socket_events
+                client.task = asyncio.ensure_future(
+                    serve({}, client.receive, client.send, SimpleNamespace(company_id=index % 2))
+                )
+                clients.append(client)
+            await until(lambda: broker.count() == len(clients))
+
+            push.get_backend().publish(1, {'type': push.CHANGES, 'changes': [{'kind': 'hobby', 'id': 7, 'deleted': True}]})
+            # Everyone has had a heartbeat once a heartbeat follows the change
+            await until(lambda: all(len(client.events()) >= 3 for client in clients))
+            for client in clients:
+                client.gone.set()
+            await asyncio.gather(*(client.task for client in clients))
+            self.assertEqual(broker.count(), 0)
+
+            for client in clients:
+                events = client.events()
+                if client.kind == 'sse':
+                    self.assertEqual(client.messages[0]['type'], 'http.response.start')
+                    self.assertEqual(events[0], b'event: ready\ndata: {"type": "ready"}\n\n')
+                    self.assertIn(b': heartbeat\n\n', events)
+                    changed = [event for event in events if event.startswith(b'event: changes')]
+                else:
+                    events = [json.loads(event) for event in events]
+                    self.assertEqual(events[0], {'type': 'ready'})
+                    self.assertIn({'type': push.HEARTBEAT}, events)
+                    changed = [event for event in events if event['type'] == push.CHANGES]
+                # The change was published to company 1, which the SSE clients are in
+                self.assertEqual(len(changed), 1 if client.kind == 'sse' else 0)
+
+        run(scenario())
+
+    @override_settings(COMPANYTREE_PUSH_HEARTBEAT=0.01, COMPANYTREE_PUSH_SEND_TIMEOUT=0.05)
+    def test_stalled_client_is_dropped(self):
+        async def scenario():
+            broker = push.get_broker()
+            stalled = FakeClient(stall_after=2)
+            stalled.kind = 'sse'
+            await async_views.stream_events({}, stalled.receive, stalled.send, SimpleNamespace(company_id=1))
+            self.assertEqual(broker.count(), 0)
+            self.assertEqual(len(stalled.messages), 2)
+
+        run(scenario())
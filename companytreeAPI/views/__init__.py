@@ -1,4 +1,12 @@
 from .register import register_user, login_user
 from .employee import Employees
 from .company import Companies
-from .department import Departments
\ No newline at end of file
+from .department import Departments
+from .search import Search
+from .cache_stats import DirectoryCacheStats
+from .bootstrap import Bootstrap
+from .analytics import Analytics
+from .metrics import metrics
+from .change import Changes
+from .layout import Layout
+from .employee_hobby import Hobbies
@@ -0,0 +1,20 @@
+"""View module for handling analytics requests"""
+from rest_framework.viewsets import ViewSet
+from rest_framework.response import Response
+from companytreeAPI import analytics
+from companytreeAPI.cache import directory_cache
+from companytreeAPI.fieldsets import SparseFieldsMixin
+
+
+class Analytics(SparseFieldsMixin, ViewSet):
+
+    """Headcount and reporting-structure aggregates of the caller's company"""
+
+    @directory_cache()
+    def list(self, request):
+        """Handle GET requests for the company's aggregates
+        Returns:
+            Response -- JSON headcount per department and location, direct and
+                        total reports per supervisor and tree depth statistics
+        """
+        return Response(analytics.company_analytics(request.auth.principal.company_id))
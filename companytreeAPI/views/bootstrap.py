@@ -0,0 +1,28 @@
+"""View module for handling bootstrap requests"""
+from rest_framework.viewsets import ViewSet
+from rest_framework.response import Response
+from rest_framework import status
+from companytreeAPI import bootstrap
+from companytreeAPI.cache import directory_cache
+
+
+class Bootstrap(ViewSet):
+
+    """Everything the client needs on startup in one request"""
+
+    @directory_cache()
+    def list(self, request):
+        """Handle GET requests for the caller's company, departments, employees and self
+        Query parameters:
+            include -- comma separated sections: company, departments, employees, self
+            fields -- comma separated fields of the employee rows in employees and self
+            since -- version token of an earlier bootstrap, sections unchanged since are skipped
+        Returns:
+            Response -- JSON with the version token, every changed section and the unchanged ones
+        """
+        try:
+            sections, fields, since = bootstrap.parse(self.request.query_params)
+        except bootstrap.BootstrapError as ex:
+            return Response({'message': ex.args[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(bootstrap.build(request.auth.principal, sections, fields, since))
@@ -0,0 +1,17 @@
+"""View module for reporting directory cache statistics"""
+from rest_framework.viewsets import ViewSet
+from rest_framework.response import Response
+from companytreeAPI.fieldsets import SparseFieldsMixin
+from companytreeAPI.cache import stats
+
+
+class DirectoryCacheStats(SparseFieldsMixin, ViewSet):
+
+    """Directory cache hit and miss counters"""
+
+    def list(self, request):
+        """Handle GET requests for the counters of this process
+        Returns:
+            Response -- JSON hits, misses, 304s, invalidations and hit ratio
+        """
+        return Response(stats.as_dict())
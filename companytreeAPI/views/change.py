@@ -0,0 +1,84 @@
+"""View module for handling change feed requests"""
+from django.conf import settings
+from rest_framework.viewsets import ViewSet
+from rest_framework.response import Response
+from rest_framework import status
+from companytreeAPI import changes, fieldsets
+from companytreeAPI.models import Company, Department, Employee, EmployeeHobby
+from companytreeAPI.views.company import CompanySerializer
+from companytreeAPI.views.department import DEPARTMENT_COLUMNS, department_rows
+from companytreeAPI.views.employee import employee_rows
+
+# Response key of each change kind
+SECTIONS = {
+    changes.EMPLOYEE: 'employees',
+    changes.DEPARTMENT: 'departments',
+    changes.COMPANY: 'companies',
+    changes.HOBBY: 'hobbies',
+}
+
+
+def _rows(kind, ids, company_id, fields):
+    """Current rows of the given ids, in the shape of the list endpoints"""
+    if kind == changes.EMPLOYEE:
+        rows, to_rows = employee_rows(Employee.objects.filter(company_id=company_id, pk__in=ids), fields)
+        return list(to_rows(rows))
+    if kind == changes.DEPARTMENT:
+        return department_rows(Department.objects.filter(pk__in=ids).values(*DEPARTMENT_COLUMNS), company_id)
+    if kind == changes.COMPANY:
+        return list(Company.objects.filter(pk__in=ids, pk=company_id).values(*CompanySerializer.Meta.fields))
+    return list(
+        EmployeeHobby.objects.filter(pk__in=ids, employee__company_id=company_id).values('id', 'employee_id', 'hobby')
+    )
+
+
+class Changes(ViewSet):
+
+    """What changed in the caller's company since an earlier sync"""
+
+    def list(self, request):
+        """Handle GET requests for the rows changed after a cursor
+        A client takes the current cursor before its full download, then
+        sends back the cursor of each response to get only what changed.
+        Query parameters:
+            since -- cursor of the previous response, only the current cursor is returned when omitted
+            limit -- most changes to read, "more" is true when others remain
+            fields -- comma separated fields of the employee rows
+        Returns:
+            Response -- JSON cursor, changed rows per kind and deleted ids per kind, 400 or 410 status code
+        """
+        since = self.request.query_params.get('since')
+        if since is None:
+            return Response({'cursor': changes.cursor(), 'more': False})
+
+        default_limit = getattr(settings, 'COMPANYTREE_CHANGE_FEED_LIMIT', 1000)
+        try:
+            since = int(since)
+            limit = min(int(self.request.query_params.get('limit', default_limit)), default_limit)
+            if since < 0 or limit < 1:
+                raise ValueError
+        except ValueError:
+            return Response({'message': 'since and limit must be positive integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        company_id = request.auth.principal.company_id
+        try:
+            latest, cursor, more = changes.since(company_id, since, limit)
+        except changes.CursorExpired as ex:
+            return Response({'message': ex.args[0]}, status=status.HTTP_410_GONE)
+
+        # Empty sections are left out, an edit should sync in a few hundred bytes
+        data = {'cursor': cursor, 'more': more}
+        deleted = {}
+        for kind, states in latest.items():
+            saved = [object_id for object_id, is_deleted in states.items() if not is_deleted]
+            rows = _rows(kind, saved, company_id, fieldsets.requested_fields(request)) if saved else []
+            # Tombstones, and rows deleted by a change past this batch
+            gone = states.keys() - {row['id'] for row in rows}
+            if rows:
+                data[SECTIONS[kind]] = rows
+            if gone:
+                deleted[SECTIONS[kind]] = sorted(gone)
+        if deleted:
+            data['deleted'] = deleted
+
+        return Response(data)
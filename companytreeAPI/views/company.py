@@ -1,5 +1,8 @@
 """View module for handling company requests"""
+import heapq
 import json
+from itertools import islice, zip_longest
+from operator import itemgetter
 from django.http import HttpResponseServerError
 from rest_framework.viewsets import ViewSet
 from rest_framework.response import Response
@@ -7,6 +10,11 @@ from rest_framework import serializers
 from rest_framework import status
 from companytreeAPI.models import Company
 from companytreeAPI.models import Employee
+from companytreeAPI import search as search_index
+from companytreeAPI import tenancy
+from companytreeAPI.cache import directory_cache
+from companytreeAPI.fieldsets import SparseFieldsMixin
+from companytreeAPI.pagination import KeysetPagination, model_ordering, wants_keyset
 from django.contrib.auth.models import User
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
@@ -28,7 +36,7 @@ class CompanySerializer(serializers.HyperlinkedModelSerializer):
         )
         fields = ('id', 'name',)
 
-class Companies(ViewSet):
+class Companies(SparseFieldsMixin, ViewSet):
 
     """Companies"""
 
@@ -41,19 +49,24 @@ class Companies(ViewSet):
         
         new_company = Company()
         new_company.name = request.data["name"]
-        new_company.save()
+        # A new company gets a database of its own choosing, not its creator's
+        database = tenancy.place_company()
+        with tenancy.using(database):
+            new_company.save()
+        tenancy.register(new_company.id, database)
 
         serializer = CompanySerializer(new_company, context={'request': request})
 
         return Response(serializer.data)
 
+    @directory_cache()
     def retrieve(self, request, pk=None):
         """Handle GET requests for single company
         Returns:
             Response -- JSON serialized company instance
         """
         try:
-            company = Company.objects.get(pk=request.auth.user.employee.company_id)
+            company = Company.objects.get(pk=request.auth.principal.company_id)
             serializer = CompanySerializer(company, context={'request': request})
             return Response(serializer.data)
         except Exception as ex:
@@ -61,7 +74,11 @@ class Companies(ViewSet):
 
     @csrf_exempt
     def list(self, request):
-        """Handle GET requests for all employees
+        """Handle GET requests for all companies, asking every database and merging the answers
+        Query parameters:
+            limit -- only the first n companies by name
+            search -- companies whose name matches these words, best match first
+            pagination=cursor, cursor -- return one page using keyset pagination
         Returns:
             Response -- JSON serialized employee instance
         """
@@ -71,21 +88,42 @@ class Companies(ViewSet):
         user = self.request.query_params.get('self')
 
 
+        # keyset pagination, opted into with pagination=cursor
+        # rows are read with .values() in the serializer's field order, which
+        # skips building a model instance and serializer fields per row
+        rows = Company.objects.values(*CompanySerializer.Meta.fields)
+
+        if wants_keyset(request):
+            paginator = KeysetPagination(model_ordering(Company))
+
+            def page():
+                matches = rows
+                if search:
+                    matches = rows.filter(pk__in=search_index.ranked_ids(search, search_index.COMPANY))
+                keep = lambda page: list(tenancy.own_rows(page))
+                return paginator.paginate_queryset(matches, request, view=self, keep=keep), paginator.has_next
+
+            page = paginator.merge_pages(tenancy.fan_out(page))
+            return paginator.get_paginated_response(page)
+
+        by_name = itemgetter('name', 'id')
+        # every database only answers for the companies the registry places in it
         # filter for the 'search companies' view
         if limit:
-            companies = Company.objects.order_by('name')[0:int(limit)]
+            first = lambda: list(islice(tenancy.own_rows(rows.order_by('name', 'id'), int(limit)), int(limit)))
+            companies = heapq.merge(*tenancy.fan_out(first), key=by_name)
+            companies = list(companies)[0:int(limit)]
         elif search:
-            companies = Company.objects.filter(name__contains=search)
+            # best matches first, from the full-text index of every database, taking turns
+            matches = tenancy.fan_out(
+                lambda: list(tenancy.own_rows(search_index.ranked_values(rows, search_index.ranked_ids(search, search_index.COMPANY))))
+            )
+            companies = [row for rank in zip_longest(*matches) for row in rank if row is not None][:search_index.SEARCH_LIMIT]
         # filter for the 'myCompanies' view
         else:
-            companies = Company.objects.all()
+            companies = heapq.merge(*tenancy.fan_out(lambda: list(tenancy.own_rows(rows.order_by('name', 'id')))), key=by_name)
 
-        serializer = CompanySerializer(
-            companies,
-            many=True,
-            context={'request': request}
-            )
-        return Response(serializer.data)
+        return Response(list(companies))
     
     def update(self, request, pk=None):
         """Handle PUT requests for a company
@@ -93,9 +131,8 @@ class Companies(ViewSet):
             Response -- Empty body with 204 status code
         """
         #First, find out if current user has admin access
-        current_user = Employee.objects.get(pk=request.auth.user.employee.id)
-        if current_user.is_admin == True:
-            company_to_update = Company.objects.get(pk=request.auth.user.employee.company_id)
+        if request.auth.principal.is_admin:
+            company_to_update = Company.objects.get(pk=request.auth.principal.company_id)
             company_to_update.name = request.data["name"]
             company_to_update.save()
 
@@ -108,8 +145,7 @@ class Companies(ViewSet):
         """
         try:
             #Find out if current user has admin access
-            current_user = Employee.objects.get(pk=request.auth.user.employee.id)
-            if current_user.is_admin == True:
+            if request.auth.principal.is_admin:
                 company = Company.objects.get(pk=pk)
                 company.delete()
 
@@ -1,2 +0,0 @@
-class Connection:
-    db_path = "/Users/samanthapita/workspace/companytree/companytree_django/db.sqlite3"
\ No newline at end of file
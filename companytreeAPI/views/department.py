@@ -7,27 +7,43 @@ from rest_framework import serializers
 from rest_framework import status
 from companytreeAPI.models import Department
 from companytreeAPI.models import Employee
+from companytreeAPI import counters
+from companytreeAPI import search as search_index
+from companytreeAPI.cache import directory_cache
+from companytreeAPI.fieldsets import SparseFieldsMixin
+from companytreeAPI.pagination import KeysetPagination, model_ordering, wants_keyset
 from django.contrib.auth.models import User
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
 from rest_framework.authtoken.models import Token
 
 
+# Columns of the department rows, the employee count is the caller's company's
+DEPARTMENT_COLUMNS = ('id', 'name', 'colorHex')
+
+
+def department_rows(rows, company_id):
+    """Department .values() rows with the number of employees of a company in each"""
+    counts = counters.department_counts(company_id)
+    return [{**row, 'employee_count': counts.get(row['id'], 0)} for row in rows]
+
+
 class DepartmentSerializer(serializers.HyperlinkedModelSerializer):
     """JSON serializer for departments
     Arguments:
         serializers.HyperlinkedModelSerializer
     """
-    
+    employee_count = serializers.IntegerField(read_only=True, default=0)
+
     class Meta:
         model = Department
         url = serializers.HyperlinkedIdentityField(
             view_name='department',
             lookup_field='id'
         )
-        fields = ('id', 'name', 'colorHex',)
+        fields = ('id', 'name', 'colorHex', 'employee_count',)
 
-class Departments(ViewSet):
+class Departments(SparseFieldsMixin, ViewSet):
 
     """Departments"""
 
@@ -37,8 +53,7 @@ class Departments(ViewSet):
             Response -- JSON serialized Department instance
         """
         #First, find out if current user has admin access
-        current_user = Employee.objects.get(pk=request.auth.user.employee.id)
-        if current_user.is_admin == True:
+        if request.auth.principal.is_admin:
             new_department = Department()
             new_department.name = request.data["name"]
             new_department.colorHex = request.data["colorHex"]
@@ -55,15 +70,21 @@ class Departments(ViewSet):
         """
         try:
             department = Department.objects.get(pk=pk)
+            department.employee_count = counters.department_counts(request.auth.principal.company_id).get(department.id, 0)
             serializer = DepartmentSerializer(department, context={'request': request})
             return Response(serializer.data)
         except Exception as ex:
             return HttpResponseServerError(ex)
 
+    @directory_cache()
     def list(self, request):
         """Handle GET requests for all departments
+        Query parameters:
+            limit -- only the first n departments by name
+            search -- departments whose name matches these words, best match first
+            pagination=cursor, cursor -- return one page using keyset pagination
         Returns:
-            Response -- JSON serialized department instance
+            Response -- JSON serialized department instances with the employees of the caller's company in each
         """
         limit = self.request.query_params.get('limit')
         search = self.request.query_params.get('search')
@@ -71,21 +92,30 @@ class Departments(ViewSet):
         user = self.request.query_params.get('self')
 
 
+        # keyset pagination, opted into with pagination=cursor
+        # rows are read with .values() in the serializer's field order, which
+        # skips building a model instance and serializer fields per row
+        rows = Department.objects.values(*DEPARTMENT_COLUMNS)
+        company_id = request.auth.principal.company_id
+
+        if wants_keyset(request):
+            if search:
+                rows = rows.filter(pk__in=search_index.ranked_ids(search, search_index.DEPARTMENT))
+            paginator = KeysetPagination(model_ordering(Department))
+            page = paginator.paginate_queryset(rows, request, view=self)
+            return paginator.get_paginated_response(department_rows(page, company_id))
+
         # filter for the 'search departments' view
         if limit:
-            departments = Department.objects.order_by('name')[0:int(limit)]
+            departments = rows.order_by('name')[0:int(limit)]
         elif search:
-            departments = Department.objects.filter(name__contains=search)
+            # best matches first, from the full-text index
+            departments = search_index.ranked_values(rows, search_index.ranked_ids(search, search_index.DEPARTMENT))
         # filter for the 'myCompanies' view
         else:
-            departments = Department.objects.all()
+            departments = rows
 
-        serializer = DepartmentSerializer(
-            departments,
-            many=True,
-            context={'request': request}
-            )
-        return Response(serializer.data)
+        return Response(department_rows(departments, company_id))
     
     def update(self, request, pk=None):
         """Handle PUT requests for a department
@@ -93,8 +123,7 @@ class Departments(ViewSet):
             Response -- Empty body with 204 status code
         """
         #First, find out if current user has admin access
-        current_user = Employee.objects.get(pk=request.auth.user.employee.id)
-        if current_user.is_admin == True:
+        if request.auth.principal.is_admin:
             department_to_update = Department.objects.get(pk=pk)
             department_to_update.name = request.data["name"]
             department_to_update.colorHex = request.data["colorHex"]
@@ -109,8 +138,7 @@ class Departments(ViewSet):
         """
         try:
             #Find out if current user has admin access
-            current_user = Employee.objects.get(pk=request.auth.user.employee.id)
-            if current_user.is_admin == True:
+            if request.auth.principal.is_admin:
                 department = Department.objects.get(pk=pk)
                 department.delete()
 
@@ -1,13 +1,19 @@
 """View module for handling employee requests"""
 import json
-import sqlite3
-from .connection import Connection
-from django.http import HttpResponseServerError
+from django.http import HttpResponseServerError, StreamingHttpResponse
 from rest_framework.viewsets import ViewSet
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import serializers
 from rest_framework import status
-from companytreeAPI.models import Employee
+from companytreeAPI.models import Employee, EmployeeHobby
+from companytreeAPI import counters, exporter, fieldsets, hierarchy, importer, tenancy
+from companytreeAPI import search as search_index
+from companytreeAPI.cache import directory_cache
+from companytreeAPI.fieldsets import SparseFieldsMixin
+from companytreeAPI.hierarchy import HierarchyError
+from companytreeAPI.pagination import model_ordering, paginator_for
+from companytreeAPI.streaming import STREAM_CHUNK_ROWS, stream_json_array
 from companytreeAPI.serializers.user import UserSerializer
 from django.contrib.auth.models import User
 from django.utils.decorators import method_decorator
@@ -29,10 +35,49 @@ class EmployeeSerializer(serializers.HyperlinkedModelSerializer):
             view_name='employee',
             lookup_field='id'
         )
-        fields = ('id', 'user', 'department_id', 'supervisor_id', 'position', 'location', 'bio', 'image_url', 'tasks', 'phone', 'slack', 'company_id', 'is_admin',)
+        fields = ('id', 'user', 'department_id', 'supervisor_id', 'position', 'location', 'bio', 'image_url', 'tasks', 'phone', 'slack', 'company_id', 'is_admin', 'direct_report_count', 'total_report_count',)
         # depth = 2
 
-class Employees(ViewSet):
+
+# Directory row field and the Employee lookup it is read from, in output order
+EMPLOYEE_ROW_FIELDS = (
+    ("id", "id"),
+    ("position", "position"),
+    ("location", "location"),
+    ("bio", "bio"),
+    ("image_url", "image_url"),
+    ("phone", "phone"),
+    ("is_admin", "is_admin"),
+    ("department_id", "department_id"),
+    ("user_id", "user_id"),
+    ("slack", "slack"),
+    ("company_id", "company_id"),
+    ("tasks", "tasks"),
+    ("supervisor_id", "supervisor_id"),
+    ("direct_report_count", "direct_report_count"),
+    ("total_report_count", "total_report_count"),
+    ("name", "department__name"),
+    ("colorHex", "department__colorHex"),
+    ("username", "user__username"),
+    ("first_name", "user__first_name"),
+    ("last_name", "user__last_name"),
+    ("email", "user__email"),
+)
+
+
+def employee_rows(employees, fields=None):
+    """Directory rows read straight from .values(), without model instances or serializer fields
+    Arguments:
+        employees -- Employee queryset
+        fields -- row fields to read, all when None; id is always included
+    Returns:
+        tuple -- (values queryset to paginate or iterate, function turning its rows into directory rows)
+    """
+    columns = fieldsets.columns(EMPLOYEE_ROW_FIELDS, fields)
+    return fieldsets.values(employees, columns), lambda rows: fieldsets.rows(rows, columns)
+
+
+class Employees(SparseFieldsMixin, ViewSet):
 
     """Company Employees"""
 
@@ -42,23 +87,12 @@ class Employees(ViewSet):
             Response -- JSON serialized Employees instance
         """
         #First, find out if current user has admin access
-        current_user = Employee.objects.get(pk=request.auth.user.employee.id)
-        if current_user.is_admin == True:
+        if request.auth.principal.is_admin:
             # Load the JSON string of the request body into a dict
             req_body = json.loads(request.body.decode())
-            
-            new_user = User.objects.create_user(
-            username=req_body['username'],
-            email=req_body['email'],
-            password=req_body['password'],
-            first_name=req_body['first_name'],
-            last_name=req_body['last_name']
-            )
-            
+
             new_employee = Employee()
-            new_employee.user = new_user
             new_employee.department_id = request.data["department_id"]
-            new_employee.supervisor_id = request.data["supervisor_id"]
             new_employee.position = request.data["position"]
             new_employee.location = request.data["location"]
             new_employee.bio = request.data["bio"]
@@ -66,9 +100,26 @@ class Employees(ViewSet):
             new_employee.tasks = request.data["tasks"]
             new_employee.phone = request.data["phone"]
             new_employee.slack = request.data["slack"]
-            new_employee.company_id = request.auth.user.employee.company_id
+            new_employee.company_id = request.auth.principal.company_id
             new_employee.is_admin = request.data["is_admin"]
-            new_employee.save()
+
+            # The user, the employee and their place in the hierarchy are saved together or not at all
+            with tenancy.atomic():
+                try:
+                    new_employee.supervisor_id = hierarchy.parse_supervisor_id(request.data["supervisor_id"])
+                    hierarchy.check_supervisor(new_employee, new_employee.supervisor_id)
+                except HierarchyError as ex:
+                    return Response({'message': ex.args[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+                new_employee.user = User.objects.create_user(
+                username=req_body['username'],
+                email=req_body['email'],
+                password=req_body['password'],
+                first_name=req_body['first_name'],
+                last_name=req_body['last_name']
+                )
+                new_employee.save()
+                hierarchy.attach(new_employee)
 
             serializer = EmployeeSerializer(new_employee, context={'request': request})
 
@@ -80,56 +131,144 @@ class Employees(ViewSet):
             Response -- JSON serialized employee instance
         """
         try:
-            employee = Employee.objects.get(pk=pk, company_id=request.auth.user.employee.company_id)
+            employee = Employee.objects.get(pk=pk, company_id=request.auth.principal.company_id)
             serializer = EmployeeSerializer(employee, context={'request': request})
             return Response(serializer.data)
         except Exception as ex:
             return HttpResponseServerError(ex)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Handle POST requests importing many employees at once
+        The body is CSV with a header row or JSON lines, either raw or as a
+        multipart "file" upload. Columns are the fields of create, with
+        supervisor_username in place of supervisor_id.
+        Query parameters:
+            input_format -- "csv" or "jsonl", guessed from the content type when omitted
+            batch_size -- rows per INSERT transaction
+        Returns:
+            Response -- JSON counts, per-row errors and rows per second
+        """
+        if not request.auth.principal.is_admin:
+            return Response({'message': 'Only admins can import employees'}, status=status.HTTP_403_FORBIDDEN)
+
+        # Raw bodies are read straight off the underlying HttpRequest so they
+        # are parsed line by line instead of being loaded whole
+        upload = None
+        if request.content_type.startswith('multipart/form-data'):
+            upload = request.FILES.get('file')
+            if upload is None:
+                return Response({'message': 'Upload the rows as a "file" field'}, status=status.HTTP_400_BAD_REQUEST)
+        stream = upload if upload is not None else request._request
+        content_type = upload.content_type if upload is not None else request.content_type
+        name = upload.name if upload is not None else ''
+
+        file_format = self.request.query_params.get('input_format')
+        if file_format is None:
+            is_csv = 'csv' in content_type or name.endswith('.csv')
+            file_format = importer.CSV if is_csv else importer.JSONL
+
+        try:
+            batch_size = max(1, int(self.request.query_params.get('batch_size', 500)))
+            rows = importer.parse(stream, file_format)
+            result = importer.import_employees(rows, request.auth.principal.company_id, batch_size)
+        except ValueError as ex:
+            return Response({'message': ex.args[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(result.as_dict(), status=status.HTTP_201_CREATED if result.created else status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Handle GET requests for a download of every employee in the company
+        Rows carry the employee with their user, department and supervisor
+        and are streamed from a server-side cursor as they are read.
+        Query parameters:
+            output_format -- "jsonl" (default) or "csv"
+            gzip -- compress the download on the fly when "1" or "true"
+        Returns:
+            StreamingHttpResponse -- the file as an attachment
+        """
+        file_format = self.request.query_params.get('output_format', exporter.JSONL)
+        compress = self.request.query_params.get('gzip', '').lower() in ('1', 'true')
+        company_id = request.auth.principal.company_id
+
+        try:
+            chunks = exporter.export(company_id, file_format, compress)
+        except ValueError as ex:
+            return Response({'message': ex.args[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = StreamingHttpResponse(chunks, content_type=exporter.content_type(file_format, compress))
+        response['Content-Disposition'] = f'attachment; filename="{exporter.filename(company_id, file_format, compress)}"'
+        return response
+
+    @action(detail=True, methods=['get'])
+    def tree(self, request, pk=None):
+        """Handle GET requests for an employee's reporting tree
+        Query parameters:
+            direction -- "down" for everyone reporting to the employee (default),
+                         "up" for their chain of supervisors
+            depth -- number of levels to include, all levels when omitted
+        Returns:
+            Response -- nested JSON tree, 400 or 404 status code
+        """
+        direction = self.request.query_params.get('direction', 'down')
+        depth = self.request.query_params.get('depth')
+
+        if direction not in ('down', 'up'):
+            return Response({'message': 'direction must be "down" or "up"'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if depth is not None:
+            try:
+                depth = int(depth)
+                if depth < 0:
+                    raise ValueError
+            except ValueError:
+                return Response({'message': 'depth must be a non-negative integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        company_id = request.auth.principal.company_id
+        tree = None
+        if pk.isdigit():
+            if direction == 'down':
+                tree = hierarchy.nest_reports(hierarchy.subtree_rows(int(pk), company_id, depth))
+            else:
+                tree = hierarchy.nest_managers(hierarchy.manager_rows(int(pk), company_id, depth))
+
+        if tree is None:
+            return Response({'message': 'Employee matching query does not exist.'}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(tree)
         
         
+    @directory_cache()
     def list(self, request):
-        if request.method == 'GET':
-            with sqlite3.connect(Connection.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                db_cursor = conn.cursor()
-
-                db_cursor.execute(f"SELECT * FROM companytreeAPI_employee as etable JOIN companytreeAPI_department as dtable ON etable.department_id=dtable.id JOIN auth_user as atable ON atable.id=etable.user_id AND company_id={request.auth.user.employee.company_id};")
-                
-                all_employees = []
-                dataset = db_cursor.fetchall()
-                
-                for row in dataset:
-                    employee = Employee()
-                    employee = {
-                        "id": row['id'],
-                        "position": row['position'],
-                        "location": row['location'],
-                        "bio": row['bio'],
-                         "image_url": row['image_url'],
-                        "phone": row['phone'],
-                        "is_admin": row['is_admin'],
-                        "department_id": row['department_id'],
-                        "user_id": row['user_id'],
-                        "slack": row['slack'],
-                        "company_id": row['company_id'],
-                        "tasks": row['tasks'],
-                        "supervisor_id": row['supervisor_id'],
-                        "name": row['name'],
-                        "colorHex": row['colorHex'],
-                        "username": row['username'],
-                        "first_name": row['first_name'],
-                        "last_name": row['last_name'],
-                        "email": row['email'],
-                    }
-                    all_employees.append(employee)
-
-        context = {
-            'all_employees': all_employees
-        }
-        res = json.dumps(all_employees)
-        return Response(res, status=status.HTTP_200_OK)
-        
-        
+        """Handle GET requests for all employees of the current user's company
+        Query parameters:
+            search -- employees matching these words, best match first
+            limit, offset -- return one page using limit/offset pagination
+            pagination=cursor, cursor -- return one page using keyset pagination
+            fields -- comma separated row fields to return
+        Without pagination parameters the whole list is streamed.
+        Returns:
+            Response -- JSON list of employees joined with their department and user
+        """
+        company_id = request.auth.principal.company_id
+        employees, to_rows = employee_rows(
+            Employee.objects.filter(company_id=company_id), fieldsets.requested_fields(request)
+        )
+
+        search = self.request.query_params.get('search')
+        if search:
+            ids = search_index.ranked_ids(search, search_index.EMPLOYEE, company_id=company_id)
+            return Response(list(to_rows(search_index.ranked_values(employees, ids))))
+
+        paginator = paginator_for(request, ordering=model_ordering(Employee))
+        if paginator is not None:
+            page = paginator.paginate_queryset(employees, request, view=self)
+            return paginator.get_paginated_response(list(to_rows(page)))
+
+        rows = to_rows(employees.iterator(chunk_size=STREAM_CHUNK_ROWS))
+        return StreamingHttpResponse(stream_json_array(rows), content_type='application/json')
+
     # def list(self, request):
     #     """Handle GET requests for all employees
     #     Returns:
@@ -159,21 +298,38 @@ class Employees(ViewSet):
             Response -- Empty body with 204 status code
         """
         #First, find out if current user has admin access
-        current_user = Employee.objects.get(pk=request.auth.user.employee.id)
-        if current_user.is_admin == True:
-            employee_to_update = Employee.objects.get(pk=pk)
-            employee_to_update.department_id = request.data["department_id"]
-            employee_to_update.supervisor_id = request.data["supervisor_id"]
-            employee_to_update.position = request.data["position"]
-            employee_to_update.location = request.data["location"]
-            employee_to_update.bio = request.data["bio"]
-            employee_to_update.image_url = request.data["image_url"]
-            employee_to_update.tasks = request.data["tasks"]
-            employee_to_update.phone = request.data["phone"]
-            employee_to_update.slack = request.data["slack"]
-            employee_to_update.company_id = request.auth.user.employee.company.id
-            employee_to_update.is_admin = request.data["is_admin"]
-            employee_to_update.save()
+        if request.auth.principal.is_admin:
+            try:
+                employee_to_update = Employee.objects.get(pk=pk, company_id=request.auth.principal.company_id)
+            except Employee.DoesNotExist as ex:
+                return Response({'message': ex.args[0]}, status=status.HTTP_404_NOT_FOUND)
+
+            with tenancy.atomic():
+                # Moving an employee rewrites the hierarchy paths and report counters of their whole subtree
+                try:
+                    supervisor_id = hierarchy.parse_supervisor_id(request.data["supervisor_id"])
+                    if supervisor_id != employee_to_update.supervisor_id:
+                        hierarchy.move(employee_to_update, supervisor_id)
+                except HierarchyError as ex:
+                    return Response({'message': ex.args[0]}, status=status.HTTP_400_BAD_REQUEST)
+                counters.change_department(employee_to_update, request.data["department_id"])
+
+                employee_to_update.department_id = request.data["department_id"]
+                employee_to_update.supervisor_id = supervisor_id
+                employee_to_update.position = request.data["position"]
+                employee_to_update.location = request.data["location"]
+                employee_to_update.bio = request.data["bio"]
+                employee_to_update.image_url = request.data["image_url"]
+                employee_to_update.tasks = request.data["tasks"]
+                employee_to_update.phone = request.data["phone"]
+                employee_to_update.slack = request.data["slack"]
+                employee_to_update.company_id = request.auth.principal.company_id
+                employee_to_update.is_admin = request.data["is_admin"]
+                # path and the counters are maintained by the hierarchy functions and must not be overwritten
+                employee_to_update.save(update_fields=[
+                    'department', 'supervisor', 'position', 'location', 'bio', 'image_url', 'tasks', 'phone', 'slack', 'company', 'is_admin',
+                    'updated_at',
+                ])
 
             return Response({}, status=status.HTTP_204_NO_CONTENT)
     
@@ -184,10 +340,15 @@ class Employees(ViewSet):
         """
         try:
             #Find out if current user has admin access
-            current_user = Employee.objects.get(pk=request.auth.user.employee.id)
-            if current_user.is_admin == True:
-                employee = Employee.objects.get(pk=pk)
-                employee.delete()
+            if request.auth.principal.is_admin:
+                employee = Employee.objects.get(pk=pk, company_id=request.auth.principal.company_id)
+                with tenancy.atomic():
+                    # Hobby rows hold the employee's row in place, and deleting them through the
+                    # signals takes them out of the hobby index, search index and change log
+                    EmployeeHobby.objects.filter(employee_id=employee.id).delete()
+                    # Direct reports move up to the departing employee's supervisor
+                    hierarchy.detach(employee)
+                    employee.delete()
 
             return Response({}, status=status.HTTP_204_NO_CONTENT)
 
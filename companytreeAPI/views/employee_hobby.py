@@ -0,0 +1,258 @@
+"""View module for handling hobby requests"""
+from rest_framework.viewsets import ViewSet
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework import serializers
+from rest_framework import status
+from companytreeAPI import fieldsets, hobbies, tenancy
+from companytreeAPI.cache import directory_cache
+from companytreeAPI.models import Employee, EmployeeHobby
+from companytreeAPI.views.employee import employee_rows
+
+MAX_HOBBY_LENGTH = EmployeeHobby._meta.get_field('hobby').max_length
+
+
+class EmployeeHobbySerializer(serializers.ModelSerializer):
+    """JSON serializer for hobbies"""
+
+    class Meta:
+        model = EmployeeHobby
+        fields = ('id', 'employee_id', 'hobby')
+
+
+class HobbyError(ValueError):
+    """Raised for a request naming hobbies or employees it may not change"""
+
+    def __init__(self, message, status_code=status.HTTP_400_BAD_REQUEST):
+        super().__init__(message)
+        self.status_code = status_code
+
+    def response(self):
+        return Response({'message': self.args[0]}, status=self.status_code)
+
+
+def _rows_by_id(ids, company_id, fields):
+    """Directory rows of the given employee ids by id"""
+    rows = {}
+    for start in range(0, len(ids), 500):
+        employees = Employee.objects.filter(company_id=company_id, pk__in=ids[start:start + 500])
+        values, to_rows = employee_rows(employees, fields)
+        rows.update((row['id'], row) for row in to_rows(values))
+    return rows
+
+
+def _hobby(value):
+    """A hobby name from the request, stripped of extra whitespace"""
+    if not isinstance(value, str) or not value.split():
+        raise HobbyError('A hobby must be a non-empty string')
+    hobby = ' '.join(value.split())
+    if len(hobby) > MAX_HOBBY_LENGTH:
+        raise HobbyError(f'A hobby is at most {MAX_HOBBY_LENGTH} characters')
+    return hobby
+
+
+def _list(data, name):
+    value = data.get(name) or []
+    if not isinstance(value, list):
+        raise HobbyError(f'{name} must be a list of hobbies')
+    return value
+
+
+class Hobbies(ViewSet):
+
+    """Hobbies of the caller's company and the employees sharing them"""
+
+    def _employee_id(self, employee_id):
+        """The employee whose hobbies the caller changes, the caller unless an admin names another"""
+        principal = self.request.auth.principal
+        if employee_id is None or str(employee_id) == str(principal.employee_id):
+            if principal.employee_id is None:
+                raise HobbyError('Only employees have hobbies')
+            return principal.employee_id
+        if not principal.is_admin:
+            raise HobbyError('Only admins can change the hobbies of other employees', status.HTTP_403_FORBIDDEN)
+        try:
+            employee_id = int(employee_id)
+        except (TypeError, ValueError):
+            raise HobbyError('employee_id must be an integer')
+        if not Employee.objects.filter(pk=employee_id, company_id=principal.company_id).exists():
+            raise HobbyError(f'Employee {employee_id} is not in your company')
+        return employee_id
+
+    def _hobbies(self):
+        return EmployeeHobby.objects.filter(employee__company_id=self.request.auth.principal.company_id)
+
+    @directory_cache()
+    def list(self, request):
+        """Handle GET requests for hobbies
+        Query parameters:
+            employee -- the hobby rows of this employee instead
+        Returns:
+            Response -- JSON list of hobbies with their number of employees, most popular first
+        """
+        employee_id = self.request.query_params.get('employee')
+        if employee_id is not None:
+            try:
+                rows = self._hobbies().filter(employee_id=int(employee_id)).order_by('id')
+            except ValueError:
+                return Response({'message': 'employee must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(rows.values(*EmployeeHobbySerializer.Meta.fields))
+
+        index = hobbies.company_index(request.auth.principal.company_id)
+        with index.lock:
+            counts = index.hobbies()
+        return Response([{'hobby': hobby, 'employees': count} for hobby, count in counts])
+
+    def retrieve(self, request, pk=None):
+        """Handle GET requests for a single hobby row
+        Returns:
+            Response -- JSON serialized hobby, 404 status code
+        """
+        try:
+            hobby = self._hobbies().get(pk=pk)
+        except EmployeeHobby.DoesNotExist as ex:
+            return Response({'message': ex.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        return Response(EmployeeHobbySerializer(hobby).data)
+
+    def create(self, request):
+        """Handle POST operations
+        Body:
+            hobby -- the hobby
+            employee_id -- whose hobby it is, the caller when omitted, other employees for admins only
+        Returns:
+            Response -- JSON serialized hobby with 201 status code, 400 or 403 status code
+        """
+        try:
+            employee_id = self._employee_id(request.data.get('employee_id'))
+            hobby = EmployeeHobby.objects.create(employee_id=employee_id, hobby=_hobby(request.data.get('hobby')))
+        except HobbyError as ex:
+            return ex.response()
+        return Response(EmployeeHobbySerializer(hobby).data, status=status.HTTP_201_CREATED)
+
+    def update(self, request, pk=None):
+        """Handle PUT requests for a hobby row
+        Returns:
+            Response -- Empty body with 204 status code, 400, 403 or 404 status code
+        """
+        try:
+            hobby = self._hobbies().get(pk=pk)
+            self._employee_id(hobby.employee_id)
+            hobby.hobby = _hobby(request.data.get('hobby'))
+        except EmployeeHobby.DoesNotExist as ex:
+            return Response({'message': ex.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        except HobbyError as ex:
+            return ex.response()
+        hobby.save(update_fields=['hobby', 'updated_at'])
+        return Response({}, status=status.HTTP_204_NO_CONTENT)
+
+    def destroy(self, request, pk=None):
+        """Handle DELETE requests for a single hobby row
+        Returns:
+            Response -- 204, 400, 403 or 404 status code
+        """
+        try:
+            hobby = self._hobbies().get(pk=pk)
+            self._employee_id(hobby.employee_id)
+        except EmployeeHobby.DoesNotExist as ex:
+            return Response({'message': ex.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        except HobbyError as ex:
+            return ex.response()
+        hobby.delete()
+        return Response({}, status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """Handle POST requests adding and removing several hobbies of an employee at once
+        Hobbies already listed are not added twice, and every row of a removed
+        hobby goes, whatever its spelling.
+        Body:
+            employee_id -- whose hobbies change, the caller when omitted, other employees for admins only
+            add -- list of hobbies to add
+            remove -- list of hobbies to remove
+        Returns:
+            Response -- JSON added hobby rows and number of removed rows, 400 or 403 status code
+        """
+        try:
+            employee_id = self._employee_id(request.data.get('employee_id'))
+            add = [_hobby(hobby) for hobby in _list(request.data, 'add')]
+            remove = {hobbies.normalize(_hobby(hobby)) for hobby in _list(request.data, 'remove')}
+        except HobbyError as ex:
+            return ex.response()
+
+        with tenancy.atomic():
+            current = EmployeeHobby.objects.select_for_update().filter(employee_id=employee_id)
+            listed = {}
+            for hobby in current:
+                listed.setdefault(hobbies.normalize(hobby.hobby), []).append(hobby)
+
+            removed = 0
+            for key in remove & listed.keys():
+                for hobby in listed.pop(key):
+                    # One by one so the signals keep the search index, caches and change log in step
+                    hobby.delete()
+                    removed += 1
+
+            added = []
+            for hobby in add:
+                key = hobbies.normalize(hobby)
+                if key not in listed:
+                    listed[key] = [EmployeeHobby.objects.create(employee_id=employee_id, hobby=hobby)]
+                    added.append(listed[key][0])
+
+        return Response({'added': EmployeeHobbySerializer(added, many=True).data, 'removed': removed})
+
+    @action(detail=False, methods=['get'])
+    @directory_cache()
+    def employees(self, request):
+        """Handle GET requests for the employees with a hobby
+        Query parameters:
+            hobby -- the hobby, matched case-insensitively
+            fields -- comma separated row fields to return, "id" answers from the index alone
+        Returns:
+            Response -- JSON list of employees ordered by id, 400 status code
+        """
+        hobby = self.request.query_params.get('hobby', '').strip()
+        if not hobby:
+            return Response({'message': 'hobby is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        company_id = request.auth.principal.company_id
+        index = hobbies.company_index(company_id)
+        with index.lock:
+            ids = index.employees_with(hobby).tolist()
+        fields = fieldsets.requested_fields(request)
+        if fields == ('id',):
+            # Straight from the index, without reading the rows
+            return Response([{'id': employee_id} for employee_id in ids])
+        rows = _rows_by_id(ids, company_id, fields)
+        return Response([rows[employee_id] for employee_id in ids if employee_id in rows])
+
+    @action(detail=False, methods=['get'])
+    @directory_cache()
+    def colleagues(self, request):
+        """Handle GET requests for the colleagues sharing most hobbies with an employee
+        Query parameters:
+            employee -- the employee, the caller when omitted
+            limit -- number of colleagues, 10 by default
+            fields -- comma separated row fields to return
+        Returns:
+            Response -- JSON list of employees with their shared hobbies, most shared first, 400 status code
+        """
+        params = self.request.query_params
+        try:
+            employee_id = int(params.get('employee', request.auth.principal.employee_id))
+            limit = int(params.get('limit', hobbies.COLLEAGUE_LIMIT))
+            if not 0 < limit <= 1000:
+                raise ValueError
+        except (TypeError, ValueError):
+            return Response({'message': 'employee must be an integer and limit between 1 and 1000'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        company_id = request.auth.principal.company_id
+        index = hobbies.company_index(company_id)
+        with index.lock:
+            colleagues = index.colleagues(employee_id, limit)
+        rows = _rows_by_id([colleague_id for colleague_id, _ in colleagues], company_id, fieldsets.requested_fields(request))
+        return Response([
+            {**rows[colleague_id], 'shared': len(shared), 'hobbies': shared}
+            for colleague_id, shared in colleagues if colleague_id in rows
+        ])
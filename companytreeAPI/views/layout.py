@@ -0,0 +1,90 @@
+"""View module for handling org chart layout requests"""
+from django.conf import settings
+from rest_framework.viewsets import ViewSet
+from rest_framework.response import Response
+from rest_framework import status
+from companytreeAPI import fieldsets, layout
+from companytreeAPI.cache import directory_cache
+from companytreeAPI.models import Employee
+from companytreeAPI.views.employee import employee_rows
+
+VIEWPORT = ('x0', 'y0', 'x1', 'y1')
+
+
+def _ids(value):
+    return {int(employee_id) for employee_id in value.split(',') if employee_id.strip()}
+
+
+class Layout(ViewSet):
+
+    """Org chart coordinates of the caller's company, laid out on the server"""
+
+    @directory_cache()
+    def list(self, request):
+        """Handle GET requests for the positions of the company's employees
+        x grows to the right and y downwards in pixels, every employee is
+        centred above their direct reports and the whole chart starts at 0, 0.
+        Query parameters:
+            depth -- fold everyone more than depth levels below the top managers into their manager
+            collapse -- comma separated employee ids whose reports are folded into them
+            x0, y0, x1, y1 -- viewport in pixels, only employees inside it and their supervisors are returned
+            fields -- comma separated directory fields joined to every node
+        Returns:
+            Response -- JSON chart size and nodes with id, supervisor_id, x, y and depth,
+                        folded nodes also with hidden employees and hidden levels, 400 status code
+        """
+        params = self.request.query_params
+        try:
+            depth = int(params['depth']) if 'depth' in params else None
+            collapse = _ids(params.get('collapse', ''))
+            viewport = [float(params[name]) for name in VIEWPORT if name in params]
+            if (depth is not None and depth < 0) or len(viewport) not in (0, len(VIEWPORT)):
+                raise ValueError
+        except ValueError:
+            return Response(
+                {'message': 'depth must be an integer of 0 or more, collapse a list of ids and x0, y0, x1, y1 numbers given together'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        width = getattr(settings, 'COMPANYTREE_LAYOUT_NODE_WIDTH', 180)
+        height = getattr(settings, 'COMPANYTREE_LAYOUT_LEVEL_HEIGHT', 120)
+        company_id = request.auth.principal.company_id
+        company_layout = layout.company_layout(company_id)
+        # An incremental refresh changes the tree in place, so it is read under the lock
+        with company_layout.lock:
+            tree, folded = company_layout.view(depth, collapse)
+            if viewport:
+                x0, y0, x1, y1 = viewport
+                shown, positions = tree.window(x0 / width, y0 / height, x1 / width, y1 / height)
+                # Supervisors outside the viewport come along to draw the lines up to them
+                ids = sorted({*shown, *(tree.parents[employee_id] for employee_id in shown)} - {None})
+            else:
+                positions = tree.positions
+                ids = sorted(positions)
+
+            nodes = []
+            for employee_id in ids:
+                x, level = positions[employee_id]
+                node = {
+                    'id': employee_id, 'supervisor_id': tree.parents[employee_id],
+                    'x': x * width, 'y': level * height, 'depth': level,
+                }
+                if employee_id in folded:
+                    node['hidden'], node['hidden_levels'] = folded[employee_id]
+                nodes.append(node)
+            chart = {'width': tree.width * width, 'height': max(tree.height - 1, 0) * height}
+
+        fields = fieldsets.requested_fields(request)
+        if fields is not None and nodes:
+            rows = {}
+            for start in range(0, len(ids), 500):
+                employees = Employee.objects.filter(company_id=company_id, pk__in=ids[start:start + 500])
+                values, to_rows = employee_rows(employees, fields)
+                rows.update((row['id'], row) for row in to_rows(values))
+            nodes = [{**rows.get(node['id'], {}), **node} for node in nodes]
+
+        return Response({
+            **chart,
+            'count': len(nodes),
+            'nodes': nodes,
+        })
@@ -0,0 +1,14 @@
+"""View module for exposing request metrics to Prometheus"""
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from companytreeAPI.metrics import registry
+
+
+def metrics(request):
+    '''Serves the request metrics of this process
+    Method arguments:
+        request -- The full HTTP request object
+    '''
+    if not getattr(settings, 'COMPANYTREE_METRICS', False):
+        raise Http404
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
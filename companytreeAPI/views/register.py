@@ -5,6 +5,9 @@ from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
 from django.views.decorators.csrf import csrf_exempt
 from companytreeAPI.models import Employee
+from companytreeAPI import hierarchy, tenancy
+from companytreeAPI.hierarchy import HierarchyError
+from companytreeAPI.login import remember_token, throttle, token_for
 
 
 @csrf_exempt
@@ -22,13 +25,23 @@ def login_user(request):
         # Use the built-in authenticate method to verify
         username = req_body['username']
         password = req_body['password']
-        authenticated_user = authenticate(username=username, password=password)
+
+        # Refuse before hashing, the password hash is most of the cost of a login
+        retry_after = throttle(username)
+        if retry_after:
+            data = json.dumps({"valid": False, "message": "Too many login attempts, try again later"})
+            response = HttpResponse(data, content_type='application/json', status=429)
+            response['Retry-After'] = str(retry_after)
+            return response
+
+        # The user and their token are in the database of their company
+        with tenancy.using(tenancy.user_database(username) or tenancy.databases()[0]):
+            authenticated_user = authenticate(username=username, password=password)
+            token = token_for(authenticated_user) if authenticated_user is not None else None
 
         # If authentication was successful, respond with their token
         if authenticated_user is not None:
-            token = Token.objects.get(user=authenticated_user)
-            
-            data = json.dumps({"valid": True, "token": token.key})
+            data = json.dumps({"valid": True, "token": token})
             return HttpResponse(data, content_type='application/json')
 
         else:
@@ -47,20 +60,23 @@ def register_user(request):
     # Load the JSON string of the request body into a dict
     req_body = json.loads(request.body.decode())
 
-    # Create a new user by invoking the `create_user` helper method
-    # on Django's built-in User model
-    new_user = User.objects.create_user(
-        username=req_body['username'],
-        email=req_body['email'],
-        password=req_body['password'],
-        first_name=req_body['first_name'],
-        last_name=req_body['last_name']
-    )
+    # Usernames are unique across the databases, login looks them up in all of them
+    if tenancy.taken_usernames([req_body['username']]):
+        data = json.dumps({"message": "That username is taken"})
+        return HttpResponse(data, content_type='application/json', status=400)
+
+    # The user and employee go to the database of their company
+    tenant = tenancy.tenant(req_body['company_id'])
+    if tenant.frozen:
+        data = json.dumps({"message": "The company is moving to another database, try again in a few seconds"})
+        return HttpResponse(data, content_type='application/json', status=503)
+    with tenancy.using(tenant.database):
+        return _register(req_body)
 
-    employee = Employee.objects.create(
-        user=new_user,
+
+def _register(req_body):
+    employee = Employee(
         department_id=req_body['department_id'],
-        supervisor_id=req_body['supervisor_id'],
         position=req_body['position'],
         location=req_body['location'],
         bio=req_body['bio'],
@@ -72,11 +88,33 @@ def register_user(request):
         is_admin=req_body['is_admin']
     )
 
-    # Commit the user to the database by saving it
-    employee.save()
+    # The user, the employee, their place in the hierarchy and their token are saved together or not at all
+    with tenancy.atomic():
+        try:
+            employee.supervisor_id = hierarchy.parse_supervisor_id(req_body['supervisor_id'])
+            hierarchy.check_supervisor(employee, employee.supervisor_id)
+        except HierarchyError as ex:
+            data = json.dumps({"message": ex.args[0]})
+            return HttpResponse(data, content_type='application/json', status=400)
+
+        # Create a new user by invoking the `create_user` helper method
+        # on Django's built-in User model
+        new_user = User.objects.create_user(
+            username=req_body['username'],
+            email=req_body['email'],
+            password=req_body['password'],
+            first_name=req_body['first_name'],
+            last_name=req_body['last_name']
+        )
+
+        # Commit the employee to the database by saving it
+        employee.user = new_user
+        employee.save()
+        hierarchy.attach(employee)
 
-    # Use the REST Framework's token generator on the new user account
-    token = Token.objects.create(user=new_user)
+        # Use the REST Framework's token generator on the new user account
+        token = Token.objects.create(user=new_user)
+    remember_token(new_user.id, token.key)
 
     # Return the token to the client
     data = json.dumps({"token": token.key})
@@ -0,0 +1,43 @@
+"""View module for handling search requests"""
+from rest_framework.viewsets import ViewSet
+from rest_framework.response import Response
+from rest_framework import status
+from companytreeAPI import search as search_index
+from companytreeAPI.fieldsets import SparseFieldsMixin
+
+
+class Search(SparseFieldsMixin, ViewSet):
+
+    """Search across employees, departments and companies"""
+
+    def list(self, request):
+        """Handle GET requests for search results
+        Query parameters:
+            q -- text to search for, every word matches as a prefix
+            type -- comma separated kinds to search: employee, department, company
+            limit -- maximum number of results
+        Returns:
+            Response -- JSON list of matches, best match first
+        """
+        query = self.request.query_params.get('q', '')
+        kinds = self.request.query_params.get('type')
+        kinds = kinds.split(',') if kinds else list(search_index.KINDS)
+
+        if any(kind not in search_index.KINDS for kind in kinds):
+            return Response(
+                {'message': f'type must be one of {", ".join(search_index.KINDS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            limit = min(int(self.request.query_params.get('limit', search_index.SEARCH_LIMIT)), 500)
+        except ValueError:
+            return Response({'message': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = search_index.search(
+            query, kinds, company_id=request.auth.principal.company_id, limit=limit
+        )
+        return Response([
+            {'type': kind, 'id': object_id, 'title': title}
+            for kind, object_id, title in results
+        ])
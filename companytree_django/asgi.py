@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'companytree_django.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# Imported once Django is set up: Django's ASGI handler with the async
+# directory handlers below its middleware, and the /events streams.
+from companytreeAPI.async_views import get_application  # noqa: E402
+
+application = get_application()
@@ -45,7 +45,7 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'companytreeAPI.authentication.CachedTokenAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
@@ -55,6 +55,7 @@ REST_FRAMEWORK = {
 }
 
 MIDDLEWARE = [
+    'companytreeAPI.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -63,6 +64,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'companytreeAPI.tenancy.TenantMiddleware',
+    'companytreeAPI.db.ReadOnlyActionMiddleware',
 ]
 
 CORS_ORIGIN_WHITELIST = (
@@ -94,13 +97,199 @@ WSGI_APPLICATION = 'companytree_django.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
-DATABASES = {
+# SQLite by default. Set COMPANYTREE_DB_ENGINE=postgresql and the
+# COMPANYTREE_DB_* variables below to run on PostgreSQL.
+
+COMPANYTREE_DB_ENGINE = os.environ.get('COMPANYTREE_DB_ENGINE', 'sqlite3')
+
+if COMPANYTREE_DB_ENGINE == 'postgresql':
+    # COMPANYTREE_DB_POOL=1 hands connections out of a per-process pool
+    # instead of opening one per request; CONN_MAX_AGE is then left at 0 so
+    # every request returns its connection to the pool.
+    COMPANYTREE_DB_POOL = os.environ.get('COMPANYTREE_DB_POOL', '') in ('1', 'true')
+    DATABASES = {
+        'default': {
+            'ENGINE': 'companytreeAPI.backends.pooled_postgresql' if COMPANYTREE_DB_POOL else 'django.db.backends.postgresql',
+            'NAME': os.environ.get('COMPANYTREE_DB_NAME', 'companytree'),
+            'USER': os.environ.get('COMPANYTREE_DB_USER', 'companytree'),
+            'PASSWORD': os.environ.get('COMPANYTREE_DB_PASSWORD', ''),
+            'HOST': os.environ.get('COMPANYTREE_DB_HOST', 'localhost'),
+            'PORT': os.environ.get('COMPANYTREE_DB_PORT', '5432'),
+            # Seconds a connection is kept open across requests
+            'CONN_MAX_AGE': 0 if COMPANYTREE_DB_POOL else int(os.environ.get('COMPANYTREE_DB_CONN_MAX_AGE', 60)),
+            'OPTIONS': {
+                # Milliseconds any single statement may run before the server cancels it
+                'options': f"-c statement_timeout={int(os.environ.get('COMPANYTREE_DB_STATEMENT_TIMEOUT', 5000))}",
+            },
+        }
+    }
+    if COMPANYTREE_DB_POOL:
+        DATABASES['default']['OPTIONS'].update(
+            pool_min_size=int(os.environ.get('COMPANYTREE_DB_POOL_MIN_SIZE', 1)),
+            pool_max_size=int(os.environ.get('COMPANYTREE_DB_POOL_MAX_SIZE', 20)),
+            pool_timeout=float(os.environ.get('COMPANYTREE_DB_POOL_TIMEOUT', 30)),
+        )
+    # COMPANYTREE_DB_READ_HOST points the read-only ViewSet actions at a replica
+    if os.environ.get('COMPANYTREE_DB_READ_HOST'):
+        DATABASES['read'] = {
+            **DATABASES['default'],
+            'HOST': os.environ['COMPANYTREE_DB_READ_HOST'],
+            'TEST': {'MIRROR': 'default'},
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('COMPANYTREE_DB_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+        }
+    }
+    # A second connection to the same file for the read-only ViewSet actions
+    DATABASES['read'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+
+    # PRAGMAs run on every new connection (companytreeAPI/db.py)
+    COMPANYTREE_SQLITE_PRAGMAS = {
+        'busy_timeout': 5000,
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+        'temp_store': 'memory',
+    }
+
+# Tenant sharding (companytreeAPI/tenancy.py). Every company lives in one
+# of COMPANYTREE_SHARDS, the default database first. COMPANYTREE_SHARDS=eu,big
+# adds the databases eu and big: db-eu.sqlite3 and db-big.sqlite3 next to
+# the default file on SQLite, and the schemas eu and big, created
+# beforehand, of the same PostgreSQL database. Migrate the default database
+# first, then each of them with manage.py migrate --database, and move
+# companies between them with manage.py move_company.
+COMPANYTREE_SHARDS = ['default'] + [alias.strip() for alias in os.environ.get('COMPANYTREE_SHARDS', '').split(',') if alias.strip()]
+
+# Alias the list and retrieve actions read from, per database, when it is configured
+COMPANYTREE_READ_DATABASES = {'default': 'read'}
+
+for alias in COMPANYTREE_SHARDS[1:]:
+    if COMPANYTREE_DB_ENGINE == 'postgresql':
+        options = DATABASES['default']['OPTIONS']
+        DATABASES[alias] = {**DATABASES['default'], 'OPTIONS': {**options, 'options': f"{options['options']} -c search_path={alias}"}}
+    else:
+        DATABASES[alias] = {
+            **DATABASES['default'],
+            'NAME': os.path.join(os.path.dirname(DATABASES['default']['NAME']), f'db-{alias}.sqlite3'),
+        }
+    if 'read' in DATABASES:
+        DATABASES[f'{alias}_read'] = {
+            **DATABASES[alias],
+            'HOST': DATABASES['read'].get('HOST', ''),
+            'TEST': {'MIRROR': alias},
+        }
+        COMPANYTREE_READ_DATABASES[alias] = f'{alias}_read'
+
+DATABASE_ROUTERS = ['companytreeAPI.tenancy.TenantRouter', 'companytreeAPI.db.ReadAliasRouter']
+
+# Seconds a process keeps using the database it last looked up for a
+# company, and the database new companies go to, the one with the fewest
+# employees when None
+COMPANYTREE_TENANT_CACHE_TTL = 5
+COMPANYTREE_NEW_COMPANY_DATABASE = None
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'BACKEND': os.environ.get('COMPANYTREE_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('COMPANYTREE_CACHE_LOCATION', 'companytree'),
     }
 }
 
+# Cache alias, lifetime in seconds and largest cacheable body in bytes of
+# the directory read cache (companytreeAPI/cache.py)
+COMPANYTREE_DIRECTORY_CACHE = 'default'
+COMPANYTREE_DIRECTORY_CACHE_TIMEOUT = 3600
+COMPANYTREE_DIRECTORY_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+# Seconds a resolved auth token is trusted before it is looked up again,
+# and how many tokens each process keeps
+COMPANYTREE_AUTH_CACHE_TTL = 60
+COMPANYTREE_AUTH_CACHE_SIZE = 10000
+
+# Threads the ASGI directory handlers run their database queries on
+COMPANYTREE_ASGI_DB_THREADS = 8
+
+# Change events pushed to /events clients (companytreeAPI/push.py). The
+# local backend only reaches clients of the same process, run several
+# ASGI workers with companytreeAPI.push.RedisBackend (needs redis).
+# Queued events per client before it is told to resync from /changes,
+# changes per event before a resync is pushed instead, and seconds
+# between heartbeats and before a client that stopped reading is dropped.
+COMPANYTREE_PUSH_BACKEND = os.environ.get('COMPANYTREE_PUSH_BACKEND', 'companytreeAPI.push.LocalBackend')
+COMPANYTREE_PUSH_REDIS_URL = os.environ.get('COMPANYTREE_PUSH_REDIS_URL', 'redis://localhost:6379/0')
+COMPANYTREE_PUSH_QUEUE_SIZE = 100
+COMPANYTREE_PUSH_MAX_CHANGES = 100
+COMPANYTREE_PUSH_HEARTBEAT = 15
+COMPANYTREE_PUSH_SEND_TIMEOUT = 10
+
+# Per-request query and latency metrics (companytreeAPI/metrics.py), served
+# at /metrics, and how many runs of one statement in a request are logged
+# as a possible N+1
+COMPANYTREE_METRICS = os.environ.get('COMPANYTREE_METRICS', '') in ('1', 'true')
+COMPANYTREE_METRICS_N_PLUS_ONE = 5
+
+
+# Password hashing (companytreeAPI/hashers.py). New passwords are hashed
+# with COMPANYTREE_PASSWORD_HASHER: pbkdf2, argon2 (needs argon2-cffi) or
+# bcrypt (needs bcrypt). A login whose stored hash uses another hasher or
+# other costs is rehashed with these.
+COMPANYTREE_PASSWORD_HASHER = os.environ.get('COMPANYTREE_PASSWORD_HASHER', 'pbkdf2')
+COMPANYTREE_PBKDF2_ITERATIONS = int(os.environ.get('COMPANYTREE_PBKDF2_ITERATIONS', 180000))
+COMPANYTREE_ARGON2_TIME_COST = int(os.environ.get('COMPANYTREE_ARGON2_TIME_COST', 2))
+COMPANYTREE_ARGON2_MEMORY_COST = int(os.environ.get('COMPANYTREE_ARGON2_MEMORY_COST', 19456))
+COMPANYTREE_ARGON2_PARALLELISM = int(os.environ.get('COMPANYTREE_ARGON2_PARALLELISM', 1))
+COMPANYTREE_BCRYPT_ROUNDS = int(os.environ.get('COMPANYTREE_BCRYPT_ROUNDS', 10))
+
+# The hashers COMPANYTREE_PASSWORD_HASHER can name
+COMPANYTREE_PASSWORD_HASHERS = {
+    'pbkdf2': 'companytreeAPI.hashers.PBKDF2PasswordHasher',
+    'argon2': 'companytreeAPI.hashers.Argon2PasswordHasher',
+    'bcrypt': 'companytreeAPI.hashers.BCryptSHA256PasswordHasher',
+}
+PASSWORD_HASHERS = [
+    COMPANYTREE_PASSWORD_HASHERS[COMPANYTREE_PASSWORD_HASHER],
+    *(path for name, path in COMPANYTREE_PASSWORD_HASHERS.items() if name != COMPANYTREE_PASSWORD_HASHER),
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+]
+
+# Login attempts allowed per username in each window of seconds, counted
+# in the cache so attempts never write to the database. 0 turns it off.
+# Use a cache shared by every worker process to enforce it across them.
+COMPANYTREE_LOGIN_CACHE = 'default'
+COMPANYTREE_LOGIN_RATE_LIMIT = 10
+COMPANYTREE_LOGIN_RATE_WINDOW = 60
+
+# Seconds login remembers a user's token key
+COMPANYTREE_LOGIN_TOKEN_TTL = 300
+
+# Most changes one /changes response reads, and days of changes kept by
+# manage.py prune_changes. A client whose cursor is older refetches.
+COMPANYTREE_CHANGE_FEED_LIMIT = 1000
+COMPANYTREE_CHANGE_LOG_DAYS = 30
+
+# Pixels between neighbouring employees and between levels of /layout,
+# companies whose layout each process keeps, and most changes applied to
+# a kept layout before it is laid out again from scratch
+COMPANYTREE_LAYOUT_NODE_WIDTH = 180
+COMPANYTREE_LAYOUT_LEVEL_HEIGHT = 120
+COMPANYTREE_LAYOUT_CACHE_SIZE = 32
+COMPANYTREE_LAYOUT_INCREMENTAL_LIMIT = 1000
+
+# Companies whose hobby index each process keeps, and most changes applied
+# to a kept index before the company's hobbies are read again
+COMPANYTREE_HOBBY_CACHE_SIZE = 32
+COMPANYTREE_HOBBY_INCREMENTAL_LIMIT = 1000
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
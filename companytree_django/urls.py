@@ -2,17 +2,25 @@
 from django.urls import include, path
 from rest_framework import routers
 from rest_framework.authtoken.views import obtain_auth_token
-from companytreeAPI.views import register_user, login_user, Employees, Companies, Departments
+from companytreeAPI.views import register_user, login_user, Employees, Companies, Departments, Search, DirectoryCacheStats, Bootstrap, Analytics, Changes, Layout, Hobbies, metrics
 
 router = routers.DefaultRouter(trailing_slash=False)
 router.register(r'employees', Employees, 'employee')
 router.register(r'companies', Companies, 'company')
 router.register(r'departments', Departments, 'department')
+router.register(r'search', Search, 'search')
+router.register(r'directory-cache', DirectoryCacheStats, 'directory-cache')
+router.register(r'bootstrap', Bootstrap, 'bootstrap')
+router.register(r'analytics', Analytics, 'analytics')
+router.register(r'changes', Changes, 'change')
+router.register(r'layout', Layout, 'layout')
+router.register(r'hobbies', Hobbies, 'hobby')
 
 urlpatterns = [
     path('', include(router.urls)),
     path('register', register_user),
     path('login', login_user),
+    path('metrics', metrics),
     path('api-token-auth/', obtain_auth_token),
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 ]